@@ -19,11 +19,12 @@
 '''
 import flask
 from flask import request, Response, abort
+from werkzeug.wsgi import wrap_file
 from multiprocessing import Process
-import sys, random, threading, hmac, hashlib, base64, time, math, os, logger, config
+import sys, io, random, threading, hmac, hashlib, base64, time, math, os, logger, config
 
 from core import Core
-import onionrutils, onionrcrypto
+import onionrutils, onionrcrypto, onionrstorage, onionrarchive
 class API:
     '''
         Main HTTP API (Flask)
@@ -56,7 +57,16 @@ class API:
 
         self.debug = debug
         self._privateDelayTime = 3
+        self._maxTreeRequest = 64 # max prefixes in one getBlockTree or getBlockHashes request
+        self._blockPageSize = 1000 # max hashes in one getBlockHashesSince response
+        # pex and kex send a random sample of at most this many addresses or keys, rather than the whole table
+        self._exchangeSize = config.get('peers', {}).get('exchange_size', 100)
         self._core = Core()
+        # Popular blocks are requested by many peers, keep the most recently served ones in memory (0 turns this off)
+        cacheBytes = config.get('storage', {}).get('cache_bytes', 16 * 1024 * 1024)
+        if cacheBytes > 0:
+            self._core.enableBlockCache(cacheBytes)
+        self._serveCompressed = config.get('storage', {}).get('serve_compressed', True)
         self._crypto = onionrcrypto.OnionrCrypto(self._core)
         self._utils = onionrutils.OnionrUtils(self._core)
         app = flask.Flask(__name__)
@@ -114,6 +124,12 @@ class API:
                 resp = Response('Goodbye')
             elif action == 'stats':
                 resp = Response('me_irl')
+            elif action == 'blockCacheStats':
+                if self._core._blockCache == None:
+                    resp = Response('disabled')
+                else:
+                    stats = self._core._blockCache.getStats()
+                    resp = Response('\n'.join(key + ': ' + str(stats[key]) for key in sorted(stats)))
             else:
                 resp = Response('(O_o) Dude what? (invalid command)')
             endTime = math.floor(time.time())
@@ -141,21 +157,63 @@ class API:
             elif action == 'getDBHash':
                 resp = Response(self._utils.getBlockDBHash())
             elif action == 'getBlockHashes':
-                resp = Response(self._core.getBlockList())
+                if data == None:
+                    resp = Response(self._core.getBlockList())
+                else:
+                    # Only the hashes under the given (comma separated) prefixes, for reconciliation
+                    try:
+                        hashes = []
+                        for prefix in data.split(',')[:self._maxTreeRequest]:
+                            hashes.extend(self._core.getBlocksByPrefix(prefix))
+                    except ValueError:
+                        abort(404)
+                    resp = Response('\n'.join(hashes))
+            elif action == 'getBlockHashesSince':
+                # Hashes added after a sequence number, data is <cursor>[,<limit>]
+                # The first line is <next cursor> <newest sequence number>, then one hash per line
+                try:
+                    args = (data or '').split(',')
+                    cursor = int(args[0])
+                    limit = self._blockPageSize
+                    if len(args) > 1:
+                        limit = max(0, min(int(args[1]), limit))
+                except ValueError:
+                    abort(404)
+                hashes, cursor, head = self._core.getBlocksSince(cursor, limit)
+                resp = Response('\n'.join([str(cursor) + ' ' + str(head)] + hashes))
+            elif action == 'getBlockTree':
+                # Children of nodes in the block reconciliation tree, one line per requested prefix:
+                # <prefix> <digest>:<count> ... (16 children)
+                try:
+                    lines = []
+                    for prefix in (data or '').split(',')[:self._maxTreeRequest]:
+                        children = self._core.getBlockTree(prefix)
+                        lines.append(prefix + ' ' + ' '.join(digest + ':' + str(count) for digest, count in children))
+                except ValueError:
+                    abort(404)
+                resp = Response('\n'.join(lines))
             # setData should be something the communicator initiates, not this api
             elif action == 'getData':
-                resp = self._core.getData(data)
-                if resp == False:
-                    abort(404)
-                    resp = ""
-                resp = Response(resp)
+                opened = False
+                # Blocks stored with zlib go as they are to peers accepting deflate, which is the same format
+                acceptEncoding = [i.split(';')[0].strip() for i in request.headers.get('Accept-Encoding', '').split(',')]
+                if self._serveCompressed and 'deflate' in acceptEncoding:
+                    opened = self._core.openCompressedData(data, 'zlib')
+                if opened != False:
+                    resp = self.blockResponse(*opened)
+                    resp.headers['Content-Encoding'] = 'deflate'
+                else:
+                    opened = self._core.openData(data)
+                    if opened == False:
+                        abort(404)
+                    resp = self.blockResponse(*opened)
             elif action == 'pex':
-                response = ','.join(self._core.listAdders())
+                response = ','.join(self._core.sampleAdders(self._exchangeSize))
                 if len(response) == 0:
                     response = 'none'
                 resp = Response(response)
             elif action == 'kex':
-                response = ','.join(self._core.listPeers())
+                response = ','.join(self._core.samplePeers(self._exchangeSize))
                 if len(response) == 0:
                     response = 'none'
                 resp = Response(response)
@@ -187,12 +245,32 @@ class API:
         if not os.environ.get("WERKZEUG_RUN_MAIN") == "true":
             logger.info('Starting client on ' + self.host + ':' + str(bindPort) + '...')
 
+        # The reloader runs onionr.py again in a child process, which would ask for the storage password a second time
+        useReloader = onionrarchive.getStorageKey() == None
         try:
-            app.run(host=self.host, port=bindPort, debug=True, threaded=True)
+            app.run(host=self.host, port=bindPort, debug=True, threaded=True, use_reloader=useReloader)
         except Exception as e:
             logger.error(str(e))
             logger.fatal('Failed to start client on ' + self.host + ':' + str(bindPort) + ', exiting...')
             exit(1)
+        finally:
+            self._core.close()
+
+    def blockResponse(self, blockFile, length):
+        '''
+            Build a response streaming a block from an open file, without reading all of it into memory
+
+            A file holding exactly the block goes through the WSGI file wrapper, which servers can send with sendfile
+        '''
+        if isinstance(blockFile, io.BytesIO):
+            resp = Response(blockFile.getvalue())
+        elif isinstance(blockFile, io.BufferedReader) and blockFile.tell() == 0 and os.fstat(blockFile.fileno()).st_size == length:
+            resp = Response(wrap_file(request.environ, blockFile), direct_passthrough=True)
+        else:
+            resp = Response(onionrstorage.readChunks(blockFile, length), direct_passthrough=True)
+        resp.headers['Content-Length'] = str(length)
+
+        return resp
 
     def validateHost(self, hostType):
         '''
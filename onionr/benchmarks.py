@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    Benchmarks for comparing implementations, run with ./benchmarks.py [archive size in MB]
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import sys, os, time, shutil, tarfile, tempfile, tracemalloc, simplecrypt, onionrarchive
+
+def makeDirectory(path, size):
+    '''
+        Fill a directory with size bytes of block-like files, half text and half random data
+    '''
+    os.makedirs(os.path.join(path, 'blocks'))
+    fileSize = 256 * 1024
+    for i in range(max(1, size // fileSize)):
+        with open(os.path.join(path, 'blocks', str(i) + '.dat'), 'wb') as blockFile:
+            if i % 2 == 0:
+                blockFile.write(('-txt-benchmark post ' + str(i) + ' ').encode() * (fileSize // 24))
+            else:
+                blockFile.write(os.urandom(fileSize))
+
+    return
+
+def legacyEncrypt(path, archivePath, password):
+    '''
+        The previous dataDirEncrypt: tar to a file, read it all back as a string, encrypt it in one call
+    '''
+    tar = tarfile.open(archivePath + '.tar', 'w')
+    tar.add(path)
+    tar.close()
+    tarData = open(archivePath + '.tar', 'r', encoding='ISO-8859-1').read()
+    encrypted = simplecrypt.encrypt(password, tarData)
+    open(archivePath, 'wb').write(encrypted)
+    os.remove(archivePath + '.tar')
+
+    return
+
+def legacyDecrypt(archivePath, password, destination):
+    '''
+        The previous dataDirDecrypt
+    '''
+    decrypted = simplecrypt.decrypt(password, open(archivePath, 'rb').read())
+    open(archivePath + '.tar', 'wb').write(decrypted)
+    tar = tarfile.open(archivePath + '.tar')
+    tar.extractall(destination)
+    tar.close()
+    os.remove(archivePath + '.tar')
+
+    return
+
+def measure(function, *args):
+    '''
+        Run a function, returns (seconds taken, peak bytes allocated by Python)
+    '''
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - startTime
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return (elapsed, peak)
+
+def benchmarkArchive(size):
+    '''
+        Compare the streaming data directory archive with the previous whole-file simplecrypt one
+    '''
+    workDir = tempfile.mkdtemp(prefix='onionr-benchmark-')
+    oldDir = os.getcwd()
+    try:
+        os.chdir(workDir)
+        makeDirectory('data', size)
+        print('Archiving ' + str(size // (1024 * 1024)) + ' MB data directory')
+        for name, encrypt, decrypt in (('simplecrypt', legacyEncrypt, legacyDecrypt), ('streaming', onionrarchive.encryptDirectory, onionrarchive.decryptDirectory)):
+            encryptTime, encryptPeak = measure(encrypt, 'data', 'archive-' + name, 'password')
+            decryptTime, decryptPeak = measure(decrypt, 'archive-' + name, 'password', 'out-' + name)
+            print('%-12s encrypt %8.2f MB/s  peak %8.1f MB   decrypt %8.2f MB/s  peak %8.1f MB' % (name,
+                size / encryptTime / 1024 / 1024, encryptPeak / 1024 / 1024, size / decryptTime / 1024 / 1024, decryptPeak / 1024 / 1024))
+    finally:
+        os.chdir(oldDir)
+        shutil.rmtree(workDir)
+
+    return
+
+if __name__ == '__main__':
+    size = 32
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    benchmarkArchive(size * 1024 * 1024)
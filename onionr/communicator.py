@@ -19,8 +19,8 @@ and code to operate as a daemon, getting commands from the command queue databas
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
-import sqlite3, requests, hmac, hashlib, time, sys, os, math, logger, urllib.parse, random
-import core, onionrutils, onionrcrypto, onionrproofs, btc, config, onionrplugins as plugins
+import sqlite3, requests, hmac, hashlib, time, sys, os, math, logger, urllib.parse, random, asyncio
+import core, onionrutils, onionrcrypto, onionrproofs, onionrarchive, onionripc, onionrasync, btc, config, onionrplugins as plugins
 
 class OnionrCommunicate:
     def __init__(self, debug, developmentMode):
@@ -35,6 +35,23 @@ class OnionrCommunicate:
         self._crypto = onionrcrypto.OnionrCrypto(self._core)
 
         self.highFailureAmount = 7
+        self.treeRequestSize = 64 # max prefixes per getBlockTree/getBlockHashes request
+        self.treeLeafSize = 32 # fetch a tree node's hashes directly once it has at most this many blocks
+        self.maxSyncPages = 20 # max getBlockHashesSince pages fetched from a peer per lookup
+        self.maxBlockSize = 10000000 # bytes, larger downloads are abandoned
+        self.queueBatchSize = 20 # daemon queue commands taken at once
+        self.pexPeerCount = 5 # random peers asked for new peers and keys each time
+        self.lookupPeerCount = 10 # random peers whose new blocks are fetched each time
+        self.downloadPeerCount = 10 # random peers a missing block is requested from
+        self.minSpeedSample = 16384 # bytes, smaller downloads say more about latency than speed and are not timed
+        self.blockQuota = config.get('storage', {}).get('quota', 0) # bytes of block data to keep, 0 for no limit
+        # Unless disabled, peers are contacted all at once rather than one after another, within these limits
+        communicatorConfig = config.get('communicator', {})
+        self.concurrent = communicatorConfig.get('concurrent', True)
+        self.requestPool = onionrasync.PeerRequestPool(communicatorConfig.get('max_requests', 16), communicatorConfig.get('max_peer_requests', 2))
+        # A block is also requested from another peer if the first has not answered within this percentile of peer latencies
+        self.hedgePercentile = communicatorConfig.get('hedge_percentile', 0.9)
+        self.maxRacingDownloads = 2 # peers a block is requested from at once
         '''
         logger.info('Starting Bitcoin Node... with Tor socks port:' + str(sys.argv[2]))
         try:
@@ -55,6 +72,10 @@ class OnionrCommunicate:
         heartBeatRate = 5
         pexTimer = 5 # How often we should check for new peers
         pexCount = 0
+        retentionTimer = 0
+        retentionRate = 60 # How often we should check the storage quota
+        queueTimer = 0
+        queueCheckRate = 30 # How often we check the daemon queue without being woken, in case a wakeup was lost
         logger.debug('Communicator debugging enabled.')
         torID = open('data/hs/hostname').read()
 
@@ -66,12 +87,29 @@ class OnionrCommunicate:
         # Loads in and starts the enabled plugins
         plugins.reload()
 
+        # daemonQueueAdd wakes us through this socket, so commands are handled straight away rather than polled for
+        queueWakeup = onionripc.WakeupChannel(self._core.queueSocket)
+        queueWakeup.listen()
+        checkQueue = True
+        nextTick = time.monotonic()
+
         while True:
-            command = self._core.daemonQueue()
+            if checkQueue:
+                commands = self._core.daemonQueueBatch(self.queueBatchSize)
+                # A full batch means there may be more waiting
+                checkQueue = len(commands) == self.queueBatchSize
+                if not self.handleCommands(commands):
+                    break
+            if time.monotonic() < nextTick:
+                if not checkQueue:
+                    checkQueue = queueWakeup.wait(nextTick - time.monotonic())
+                continue
             # Process blocks based on a timer
             blockProcessTimer += 1
             heartBeatTimer += 1
             pexCount += 1
+            retentionTimer += 1
+            queueTimer += 1
             if highFailureTimer == highFailureRate:
                 highFailureTimer = 0
                 for i in self.peerData:
@@ -87,96 +125,312 @@ class OnionrCommunicate:
                 self.lookupBlocks()
                 self.processBlocks()
                 blockProcessTimer = 0
-            if command != False:
-                if command[0] == 'shutdown':
-                    logger.info('Daemon recieved exit command.')
-                    break
-            time.sleep(1)
+            if retentionTimer == retentionRate:
+                self.enforceBlockQuota()
+                retentionTimer = 0
+            if queueTimer == queueCheckRate:
+                checkQueue = True
+                queueTimer = 0
+            nextTick = time.monotonic() + 1
+
+        queueWakeup.close()
+        self.requestPool.close()
+        self._core.close()
 
         return
 
-    def getNewPeers(self):
+    def handleCommands(self, commands):
         '''
-            Get new peers
+            Act on commands from the daemon queue (see core.Core.daemonQueueAdd), returns False on shutdown
         '''
-        peersCheck = 5 # Amount of peers to ask for new peers + keys
-        peersChecked = 0
-        peerList = list(self._core.listAdders()) # random ordered list of peers
-        newKeys = []
-        newAdders = []
-        if len(peerList) > 0:
-            maxN = len(peerList) - 1
-        else:
-            peersCheck = 0
-            maxN = 0
+        for command in commands:
+            if command[0] == 'shutdown':
+                logger.info('Daemon recieved exit command.')
+                return False
+            elif command[0] == 'downloadBlock':
+                if self._utils.validateHash(command[1]):
+                    self._core.addToBlockDB(command[1])
+                    # Not added if it was evicted recently
+                    if self._utils.hasBlock(command[1]):
+                        self.downloadBlock(command[1])
+            elif command[0] == 'lookupBlocks':
+                self.lookupBlocks()
+            elif command[0] == 'syncPeer':
+                if self._utils.validateID(command[1]):
+                    self.lookupBlocks([command[1]])
+            elif command[0] == 'getNewPeers':
+                self.getNewPeers()
+            else:
+                logger.warn('Unknown daemon command: ' + str(command[0]))
+
+        return True
+
+    def enforceBlockQuota(self):
+        '''
+            Evict least recently used blocks if stored blocks take more than the storage quota
+        '''
+        if self.blockQuota <= 0:
+            return
+        evicted, reclaimed = self._core.enforceBlockQuota(self.blockQuota)
+        if evicted > 0:
+            logger.info('Evicted ' + str(evicted) + ' blocks to stay under the storage quota, reclaimed ' + str(reclaimed) + ' bytes')
 
-        if len(peerList) > peersCheck:
-            peersCheck = len(peerList)
+        return
 
-        while peersCheck > peersChecked:
-            i = random.randint(0, maxN)
-            logger.info('Using ' + peerList[i] + ' to find new peers')
+    def getNewPeers(self):
+        '''
+            Get new peers and keys from a few random peers
+        '''
+        peerList = self._core.sampleAdders(self.pexPeerCount)
+        if self.concurrent:
+            calls = [(peer, action) for peer in peerList for action in ('pex', 'kex')]
+            logger.info('Using ' + ', '.join(peerList) + ' to find new peers and keys')
+            responses = self.requestPool.run(self.gatherFromPeers(calls, self.exchangeWith))
+            for (peer, action), response in zip(calls, responses):
+                if not response:
+                    continue
+                if action == 'pex':
+                    self._utils.mergeAdders(response)
+                else:
+                    # TODO: Require keys to come with POW token (very large amount of POW)
+                    self._utils.mergeKeys(response)
+            return
+        for peer in peerList:
+            logger.info('Using ' + peer + ' to find new peers')
             try:
-                newAdders = self.performGet('pex', peerList[i], skipHighFailureAddress=True)
+                newAdders = self.performGet('pex', peer, skipHighFailureAddress=True)
                 self._utils.mergeAdders(newAdders)
             except requests.exceptions.ConnectionError:
-                logger.info(peerList[i] + ' connection failed')
+                logger.info(peer + ' connection failed')
                 continue
-            else:
-                try:
-                    logger.info('Using ' + peerList[i] + ' to find new keys')
-                    newKeys = self.performGet('kex', peerList[i], skipHighFailureAddress=True)
-                    # TODO: Require keys to come with POW token (very large amount of POW)
-                    self._utils.mergeKeys(newKeys)
-                except requests.exceptions.ConnectionError:
-                    logger.info(peerList[i] + ' connection failed')
-                    continue
-                else:
-                    peersChecked += 1
+            try:
+                logger.info('Using ' + peer + ' to find new keys')
+                newKeys = self.performGet('kex', peer, skipHighFailureAddress=True)
+                # TODO: Require keys to come with POW token (very large amount of POW)
+                self._utils.mergeKeys(newKeys)
+            except requests.exceptions.ConnectionError:
+                logger.info(peer + ' connection failed')
         return
 
-    def lookupBlocks(self):
+    def exchangeWith(self, peer, action):
         '''
-            Lookup blocks and merge new ones
+            Ask a peer for peers (pex) or keys (kex), returns the response or False
         '''
-        peerList = self._core.listAdders()
-        blocks = ''
-        for i in peerList:
-            lastDB = self._core.getAddressInfo(i, 'DBHash')
-            if lastDB == None:
-                logger.debug('Fetching hash from ' + i + ' No previous known.')
-            else:
-                logger.debug('Fetching hash from ' + str(i) + ', ' + lastDB + ' last known')
-            currentDB = self.performGet('getDBHash', i)
-            if currentDB != False:
-                logger.debug(i + " hash db (from request): " + currentDB)
-            else:
-                logger.warn("Error getting hash db status for " + i)
-            if currentDB != False:
-                if lastDB != currentDB:
-                    logger.debug('Fetching hash from ' + i + ' - ' + currentDB + ' current hash.')
-                    blocks += self.performGet('getBlockHashes', i)
-                if self._utils.validateHash(currentDB):
-                    self._core.setAddressInfo(i, "DBHash", currentDB)
-        if len(blocks.strip()) != 0:
-            logger.debug('BLOCKS:' + blocks)
-        blockList = blocks.split('\n')
+
+        return self.performGet(action, peer, skipHighFailureAddress=True)
+
+    async def gatherFromPeers(self, calls, function):
+        '''
+            Make calls of function (a tuple of arguments each, the peer first) all at once through the request pool
+
+            Returns the results in the same order, None for calls which raised an exception.
+        '''
+        results = await asyncio.gather(*[self.requestPool.call(call[0], function, *call) for call in calls], return_exceptions=True)
+        for call, result in zip(calls, results):
+            if isinstance(result, Exception):
+                logger.warn(function.__name__ + ' failed with peer ' + call[0] + ': ' + str(result))
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    def lookupBlocks(self, peerList=None):
+        '''
+            Lookup blocks and merge new ones, from a few peers (favouring fast and reliable ones) unless given a list
+        '''
+        if peerList == None:
+            peerList = self._core.choosePeers(self.lookupPeerCount)
+        if self.concurrent:
+            results = self.requestPool.run(self.gatherFromPeers([(i,) for i in peerList], self.lookupPeer))
+        else:
+            results = [self.lookupPeer(i) for i in peerList]
+        blockList = []
+        cursors = {} # block cursors to save once the hashes they cover are in our database
+        digests = {} # likewise, peers' block list digests
+        for i, result in zip(peerList, results):
+            if result == None:
+                continue
+            blockList.extend(result[0])
+            if result[1] != None:
+                cursors[i] = result[1]
+            if result[2] != None:
+                digests[i] = result[2]
+        if len(blockList) != 0:
+            logger.debug('BLOCKS:' + '\n'.join(blockList))
+        newBlocks = []
         for i in blockList:
             if len(i.strip()) == 0:
                 continue
-            if self._utils.hasBlock(i):
-                continue
-            logger.debug('Exchanged block (blockList): ' + i)
             if not self._utils.validateHash(i):
                 # skip hash if it isn't valid
                 logger.warn('Hash ' + i + ' is not valid')
                 continue
-            else:
-                logger.debug('Adding ' +  i + ' to hash database...')
-                self._core.addToBlockDB(i)
+            newBlocks.append(i)
+        # One transaction for the whole list, rather than a commit per hash
+        for i in self._core.addBlocksToDB(newBlocks):
+            logger.debug('Exchanged block (blockList): ' + i)
+        for i in cursors:
+            self._core.setAddressInfo(i, 'blockCursor', cursors[i])
+        for i in digests:
+            self._core.setAddressInfo(i, 'DBHash', digests[i])
 
         return
 
+    def lookupPeer(self, peer):
+        '''
+            Check whether a peer's block list changed and if so get the hashes it added
+
+            Returns a tuple of the hash list, the new block cursor (see syncBlockList) and the peer's block list
+            digest to save once the hashes are in our database, which is None unless we now have everything up to
+            that digest (so that the peer is synced again next time if it is not). Returns None on failure.
+        '''
+        lastDB = self._core.getAddressInfo(peer, 'DBHash')
+        if lastDB == None:
+            logger.debug('Fetching hash from ' + peer + ' No previous known.')
+        else:
+            logger.debug('Fetching hash from ' + str(peer) + ', ' + lastDB + ' last known')
+        currentDB = self.performGet('getDBHash', peer)
+        if currentDB == False:
+            logger.warn("Error getting hash db status for " + peer)
+            return None
+        logger.debug(peer + " hash db (from request): " + currentDB)
+        hashes, cursor, complete = [], None, True
+        if lastDB != currentDB and currentDB != self._core.getBlockDigest():
+            logger.debug('Fetching hash from ' + peer + ' - ' + currentDB + ' current hash.')
+            newBlocks = self.syncBlockList(peer)
+            if newBlocks == False:
+                return None
+            hashes, cursor, complete = newBlocks
+        if not complete or not self._utils.validateHash(currentDB):
+            currentDB = None
+
+        return (hashes, cursor, currentDB)
+
+    def syncBlockList(self, peer):
+        '''
+            Get the hashes a peer has added since our last sync with it
+
+            With a saved cursor this pages through getBlockHashesSince. Otherwise (or if the peer's sequence
+            numbers went backwards, meaning it lost its database) the block tree is reconciled instead, after
+            reading the peer's newest sequence number so that later syncs only need the delta.
+            Returns a tuple of the hash list, the new cursor (None if unknown) and whether the list reaches the
+            peer's newest block (it does not if maxSyncPages ran out or a page failed), or False on failure.
+        '''
+        cursor = self._core.getAddressInfo(peer, 'blockCursor')
+        if type(cursor) is int:
+            page = self.getBlockPage(peer, cursor)
+        else:
+            page = self.getBlockPage(peer, 0, 0)
+        if page == False:
+            return False
+        elif page == None:
+            # The peer does not support getBlockHashesSince
+            hashes = self.reconcileBlocks(peer)
+            if hashes == False:
+                return False
+            return (hashes, None, True)
+
+        head = page[2]
+        if type(cursor) is not int or cursor > head:
+            hashes = self.reconcileBlocks(peer)
+            if hashes == False:
+                return False
+            return (hashes, head, True)
+
+        hashes = []
+        complete = False
+        for i in range(self.maxSyncPages):
+            hashes.extend(page[0])
+            if page[1] == cursor or page[1] >= page[2]:
+                cursor = page[1]
+                complete = True
+                break
+            cursor = page[1]
+            page = self.getBlockPage(peer, cursor)
+            if page == False or page == None:
+                break
+        logger.debug('Got ' + str(len(hashes)) + ' new hashes from ' + peer + ', now at ' + str(cursor))
+
+        return (hashes, cursor, complete)
+
+    def getBlockPage(self, peer, cursor, limit=None):
+        '''
+            Request one page of getBlockHashesSince from a peer
+
+            Returns a tuple of (hashes, next cursor, newest sequence number), None if the peer does not
+            support the action, or False on failure.
+        '''
+        data = str(cursor)
+        if limit != None:
+            data += ',' + str(limit)
+        response = self.performGet('getBlockHashesSince', peer, data)
+        if response == False:
+            return False
+        response = response.split('\n')
+        try:
+            cursor, head = response[0].split(' ')
+            cursor = int(cursor)
+            head = int(head)
+        except ValueError:
+            return None
+
+        return ([i for i in response[1:] if i != ''], cursor, head)
+
+    def reconcileBlocks(self, peer):
+        '''
+            Find the hashes a peer has that we may not, by walking down only the parts of the block
+            tree (see core.Core.getBlockTree) where its digests differ from ours
+
+            Each level of the tree costs one request per treeRequestSize differing nodes, so traffic
+            grows with the difference between the block lists rather than their size.
+            Returns a list of hashes, or False if the peer could not be reached.
+        '''
+        hexDigits = '0123456789abcdef'
+        pending = [''] # tree nodes to compare with the peer, the root first
+        leaves = [] # tree nodes small enough to fetch the hashes of
+        while len(pending) > 0:
+            batch = pending[:self.treeRequestSize]
+            pending = pending[self.treeRequestSize:]
+            response = self.performGet('getBlockTree', peer, ','.join(batch))
+            if response == False:
+                return False
+            if response == '':
+                # The peer does not support reconciliation, fall back to its full list
+                logger.debug(peer + ' does not support getBlockTree, fetching all hashes')
+                response = self.performGet('getBlockHashes', peer)
+                if response == False:
+                    return False
+                return response.split('\n')
+            for line in response.split('\n'):
+                line = line.split(' ')
+                prefix = line[0]
+                remoteChildren = line[1:]
+                if prefix not in batch or len(remoteChildren) != 16:
+                    continue
+                localChildren = self._core.getBlockTree(prefix)
+                for i in range(16):
+                    try:
+                        digest, count = remoteChildren[i].split(':')
+                        count = int(count)
+                    except ValueError:
+                        continue
+                    if count == 0 or digest == localChildren[i][0]:
+                        continue
+                    child = prefix + hexDigits[i]
+                    if count <= self.treeLeafSize or len(child) == 63:
+                        leaves.append(child)
+                    else:
+                        pending.append(child)
+
+        hashes = []
+        while len(leaves) > 0:
+            batch = leaves[:self.treeRequestSize]
+            leaves = leaves[self.treeRequestSize:]
+            response = self.performGet('getBlockHashes', peer, ','.join(batch))
+            if response == False:
+                return False
+            hashes.extend(response.split('\n'))
+        logger.debug('Reconciled block list with ' + peer + ', ' + str(len(hashes)) + ' candidate hashes')
+
+        return hashes
+
     def processBlocks(self):
         '''
             Work with the block database and download any missing blocks
@@ -184,41 +438,118 @@ class OnionrCommunicate:
             This is meant to be called from the communicator daemon on its timer.
         '''
 
-        for i in self._core.getBlockList(True).split("\n"):
-            if i != "":
-                logger.warn('UNSAVED BLOCK: ' + i)
-                data = self.downloadBlock(i)
+        hashes = [i for i in self._core.getBlockList(True).split("\n") if i != ""]
+        for i in hashes:
+            logger.warn('UNSAVED BLOCK: ' + i)
+        if self.concurrent:
+            hedgeDelay = self._core.peerLatencyPercentile(self.hedgePercentile)
+            self.requestPool.run(self.downloadBlocksAsync(hashes, hedgeDelay))
+        else:
+            for i in hashes:
+                self.downloadBlock(i)
 
         return
 
     def downloadBlock(self, hash):
         '''
-            Download a block from random order of peers
+            Download a block from peers, favouring fast and reliable ones, until one sends a valid copy
         '''
 
-        peerList = self._core.listAdders()
-        blocks = ''
+        if self.concurrent:
+            self.requestPool.run(self.downloadBlockAsync(hash))
+            return
+        peerList = self._core.choosePeers(self.downloadPeerCount)
         for i in peerList:
-            hasher = hashlib.sha3_256()
-            data = self.performGet('getData', i, hash)
-            if data == False or len(data) > 10000000:
-                continue
-            hasher.update(data.encode())
-            digest = hasher.hexdigest()
-            if type(digest) is bytes:
-                digest = digest.decode()
-            if digest == hash.strip():
-                self._core.setData(data)
-                if data.startswith('-txt-'):
-                    self._core.setBlockType(hash, 'txt')
-                logger.info('Successfully obtained data for ' + hash)
-                if len(data) < 120:
-                    logger.debug('Block text:\n' + data)
-            else:
-                logger.warn("Failed to validate " + hash)
+            if self.fetchBlock(i, hash):
+                break
 
         return
 
+    async def downloadBlocksAsync(self, hashes, hedgeDelay=None):
+        '''
+            Download blocks all at once through the request pool
+        '''
+
+        await asyncio.gather(*[self.downloadBlockAsync(i, hedgeDelay) for i in hashes])
+
+        return
+
+    async def downloadBlockAsync(self, hash, hedgeDelay=None):
+        '''
+            Download a block from peers through the request pool, so many blocks can be downloaded at once
+
+            Stops at the first valid copy. If a peer has not answered within hedgeDelay seconds (by default the
+            hedgePercentile latency of all peers) the block is requested from the next peer as well, and
+            whichever request loses is cancelled.
+        '''
+
+        if hedgeDelay == None:
+            hedgeDelay = self._core.peerLatencyPercentile(self.hedgePercentile)
+        peerList = self._core.choosePeers(self.downloadPeerCount)
+        fetch = lambda peer, attempt: self.fetchBlock(peer, hash, attempt)
+        if not await self.requestPool.race(peerList, fetch, hedgeDelay, self.maxRacingDownloads):
+            logger.warn('Could not get ' + hash + ' from any of ' + str(len(peerList)) + ' peers')
+
+        return
+
+    def fetchBlock(self, peer, hash, attempt=None):
+        '''
+            Request a block from one peer and save it if it is valid, returns whether it was saved
+
+            With an attempt (see onionrasync.Attempt), the answer is reported to it and the download stops
+            without saving anything if it is cancelled.
+        '''
+        # performGet leaves streamed requests for us to record, one outcome each, timed from before connecting
+        requestStart = time.monotonic()
+        resp = self.performGet('getData', peer, hash, stream=True)
+        if resp == False:
+            self._core.recordPeerRequest(peer, False, time.monotonic() - requestStart)
+            return False
+        # Hashed while it is written to disk, and only kept if it matches
+        startTime = time.monotonic()
+        latency = startTime - requestStart
+        stream = resp.raw
+        try:
+            resp.raw.decode_content = True
+            if attempt != None:
+                attempt.answer()
+                stream = onionrasync.CancellableStream(resp.raw, attempt)
+            dataHash = self._core.setDataStream(stream, expectedHash=hash, maxSize=self.maxBlockSize)
+        except onionrasync.Cancelled:
+            logger.debug('Stopped downloading ' + hash + ' from ' + peer + ', another peer sent it first')
+            # It did answer, only later than another peer
+            self._core.recordPeerRequest(peer, True, latency)
+            return False
+        except (requests.exceptions.RequestException, requests.packages.urllib3.exceptions.HTTPError) as e:
+            logger.warn('Downloading ' + hash + ' from ' + peer + ' failed: ' + str(e))
+            self._core.recordPeerRequest(peer, False, time.monotonic() - requestStart)
+            return False
+        finally:
+            resp.close()
+        if dataHash == False:
+            # Sent something other than the block
+            self._core.recordPeerRequest(peer, False, time.monotonic() - requestStart)
+        else:
+            self._core.recordPeerRequest(peer, True, latency)
+            if resp.raw.tell() >= self.minSpeedSample:
+                self._core.recordPeerSpeed(peer, resp.raw.tell(), time.monotonic() - startTime)
+        opened = False
+        if dataHash != False:
+            opened = self._core.openData(dataHash)
+        if opened == False:
+            logger.warn("Failed to validate " + hash)
+            return False
+        blockFile, length = opened
+        with blockFile:
+            start = blockFile.read(min(length, 120))
+        if start.startswith(b'-txt-'):
+            self._core.setBlockType(hash, 'txt')
+        logger.info('Successfully obtained data for ' + hash)
+        if length < 120:
+            logger.debug('Block text:\n' + start.decode(errors='replace'))
+
+        return True
+
     def urlencode(self, data):
         '''
             URL encodes the data
@@ -226,9 +557,12 @@ class OnionrCommunicate:
 
         return urllib.parse.quote_plus(data)
 
-    def performGet(self, action, peer, data=None, skipHighFailureAddress=False, peerType='tor'):
+    def performGet(self, action, peer, data=None, skipHighFailureAddress=False, peerType='tor', stream=False):
         '''
             Performs a request to a peer through Tor or i2p (currently only Tor)
+
+            With stream, the body is not read: the response object is returned (if the request succeeded) for the caller to read and close.
+            The caller then records the request's outcome (see core.recordPeerRequest), once it knows whether the body was good
         '''
 
         if not peer.endswith('.onion') and not peer.endswith('.onion/'):
@@ -250,8 +584,23 @@ class OnionrCommunicate:
                 logger.debug('Skipping ' + peer + ' because of high failure rate')
             else:
                 logger.debug('Contacting ' + peer + ' on port ' + socksPort)
-                r = requests.get(url, headers=headers, proxies=proxies, timeout=(15, 30))
-                retData = r.text
+                startTime = time.monotonic()
+                try:
+                    r = requests.get(url, headers=headers, proxies=proxies, timeout=(15, 30), stream=stream)
+                except requests.exceptions.RequestException:
+                    if not stream:
+                        self._core.recordPeerRequest(peer, False, time.monotonic() - startTime)
+                    raise
+                # Kept in the address database, so choosePeers can favour peers which answer quickly
+                if not stream:
+                    self._core.recordPeerRequest(peer, r.ok, time.monotonic() - startTime)
+                if stream:
+                    retData = r
+                    if not r.ok:
+                        r.close()
+                        retData = False
+                else:
+                    retData = r.text
         except requests.exceptions.RequestException as e:
             logger.warn(action + " failed with peer " + peer + ": " + str(e))
             retData = False
@@ -276,6 +625,11 @@ try:
 except IndexError:
     pass
 if shouldRun:
+    # onionr.py sends the storage key on stdin when storage encryption is set up, see Onionr.daemon
+    if os.path.exists(os.path.join('data', onionrarchive.keyFileName)):
+        storageKey = sys.stdin.readline().strip()
+        if storageKey:
+            onionrarchive.setStorageKey(bytes.fromhex(storageKey))
     try:
         OnionrCommunicate(debug, developmentMode)
     except KeyboardInterrupt:
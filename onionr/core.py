@@ -17,12 +17,12 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
-import sqlite3, os, sys, time, math, base64, tarfile, getpass, simplecrypt, hashlib, nacl, logger
+import sqlite3, os, sys, io, time, math, base64, random, tarfile, getpass, simplecrypt, hashlib, nacl, threading, logger, config
 #from Crypto.Cipher import AES
 #from Crypto import Random
 import netcontroller
 
-import onionrutils, onionrcrypto, btc
+import onionrutils, onionrcrypto, onionrdatabase, onionrstorage, onionrbloom, onionrarchive, onionripc, onionrpeercache, btc
 
 if sys.version_info < (3, 6):
     try:
@@ -37,24 +37,501 @@ class Core:
             Initialize Core Onionr library
         '''
         self.queueDB = 'data/queue.db'
+        self.queueSocket = 'data/queue.sock' # the communicator listens here for wakeups when commands are queued
         self.peerDB = 'data/peers.db'
         self.blockDB = 'data/blocks.db'
         self.blockDataLocation = 'data/blocks/'
+        self.blockPackLocation = 'data/packs/'
         self.addressDB = 'data/address.db'
+        self.blockFilterFile = 'data/blocks.bloom'
+        self.blockFilterCapacity = 100000 # minimum number of hashes the block filter is sized for
+        self.blockFilterRefresh = 1 # seconds between checks for blocks added by other processes
+        self.removedBlockLog = 10000 # removals remembered for other processes' block caches
+        self.cacheableBlockSize = 64 * 1024 # openData streams larger blocks from disk instead of caching them
+        self.accessFlushInterval = 60 # seconds between writes of block access times to the database
+        self.evictedBlockLifetime = 30 * 24 * 60 * 60 # seconds an evicted block is kept from being added back
+        self.quotaLowWatermark = 0.9 # enforceBlockQuota evicts down to this fraction of the quota
+        self.peerScoreDecay = 0.95 # weight of an address' earlier successes and failures after each new request
+        self.peerAverageWeight = 0.2 # weight of the newest request in an address' average latency and speed
+        self.peerDefaultLatency = 5 # seconds, assumed for addresses which have not answered yet
+        self.peerCandidateFactor = 3 # choosePeers picks from a random sample and the best scores, each this many times larger than asked for
+        # peerScore in SQL, the addersScore index is on this same expression so the best addresses are found without a scan
+        self._peerScoreSQL = ('(max(coalesce(success, 0), 0) + 1.0) / (max(coalesce(success, 0), 0) + max(coalesce(failure, 0), 0) + 2.0)'
+            + ' / max(coalesce(nullif(latency, 0), ' + str(float(self.peerDefaultLatency)) + '), 0.1)')
+        self._blockCache = None
+        self.blockTreeDepth = 3 # hex characters of a hash used to pick its bucket, so 16^3 buckets
 
         if not os.path.exists('data/'):
             os.mkdir('data/')
         if not os.path.exists('data/blocks/'):
             os.mkdir('data/blocks/')
+
+        # Long-lived per-thread database connections, see onionrdatabase.DatabaseManager
+        self._db = onionrdatabase.DatabaseManager()
+        self._fileStorage = onionrstorage.FileBlockStore(self.blockDataLocation)
+
+        # storage.backend picks where block data goes: 'file' (one file per block) or 'pack' (append-only segment files)
+        if not config.get_config() and os.path.exists(config.get_config_file()):
+            config.reload()
+        # storage.compression is 'none', 'zlib' or 'lzma', for newly saved blocks (hashes are always of the uncompressed block)
+        self.blockCompression = config.get('storage', {}).get('compression', 'none')
+        if not self.blockCompression in onionrstorage.blockCodecs:
+            logger.warn('Unknown block compression ' + str(self.blockCompression) + ', storing blocks uncompressed')
+            self.blockCompression = 'none'
+        if config.get('storage', {}).get('backend', 'file') == 'pack':
+            self._storage = onionrstorage.PackBlockStore(self.blockPackLocation, self._db)
+        else:
+            self._storage = self._fileStorage
+
+        # Schema upgrades for each database, migrations[n] upgrades from version n to n + 1
+        self._migrations = {
+            self.blockDB: [self._migrateBlockDBKeys, self._migrateBlockDBBinaryHashes, self._migrateBlockDBDigest, self._migrateBlockDBTree, self._migrateBlockDBSequence, self._migrateBlockDBRemovals, self._migrateBlockDBRetention],
+            self.peerDB: [self._migratePeerDBKeys],
+            self.queueDB: [self._migrateQueueDBPriority],
+            self.addressDB: [self._migrateAddressDBKeys, self._migrateAddressDBCursor, self._migrateAddressDBLatency, self._migrateAddressDBScore]
+        }
+
         if not os.path.exists(self.blockDB):
             self.createBlockDB()
-            
+        self.migrateDatabases()
+
+        # Bloom filter of known block hashes, so hasBlock can skip the database for blocks we don't have
+        self._blockFilterLock = threading.Lock()
+        self._loadBlockFilter()
+
+        # Block read times, written to the database in batches for eviction, see enforceBlockQuota
+        self._blockAccesses = {}
+        self._blockAccessLock = threading.Lock()
+        self._blockAccessFlushed = time.monotonic()
+
+        self._queueWakeup = onionripc.WakeupChannel(self.queueSocket)
+
+        # Peer and address rows are read once and kept in memory, changes are written through to the database
+        self._peerCache = onionrpeercache.RecordCache(self._db, self.peerDB, 'peers', onionrpeercache.PeerRecord, {'pubkey': 'ID'})
+        self._addressCache = onionrpeercache.RecordCache(self._db, self.addressDB, 'adders', onionrpeercache.AddressRecord)
+
         self._utils = onionrutils.OnionrUtils(self)
         # Initialize the crypto object
         self._crypto = onionrcrypto.OnionrCrypto(self)
 
         return
 
+    def close(self):
+        '''
+            Close all database connections, call before exiting or moving the data directory
+        '''
+        self.flushBlockAccesses()
+        self.saveBlockFilter()
+        self._peerCache.close()
+        self._addressCache.close()
+        self._storage.close()
+        self._db.close()
+
+        return
+
+    def migrateDatabases(self):
+        '''
+            Upgrade existing databases to the current schema, run on startup
+        '''
+        for path, migrations in self._migrations.items():
+            if os.path.exists(path):
+                self._db.migrate(path, migrations)
+
+        return
+
+    def _migrateBlockDBKeys(self, c):
+        '''
+            Schema version 1: primary key on hash (keeping the saved copy of duplicates) and lookup indexes
+        '''
+        c.execute('ALTER TABLE hashes RENAME TO hashesOld;')
+        c.execute('''CREATE TABLE hashes(
+            hash text primary key not null,
+            dateReceived int,
+            decrypted int,
+            dataType text,
+            dataFound int,
+            dataSaved int);
+        ''')
+        c.execute('''INSERT OR IGNORE INTO hashes (hash, dateReceived, decrypted, dataType, dataFound, dataSaved)
+            SELECT hash, dateReceived, decrypted, dataType, dataFound, dataSaved FROM hashesOld ORDER BY dataSaved DESC, rowid;''')
+        c.execute('DROP TABLE hashesOld;')
+        c.execute('CREATE INDEX hashesDataSaved ON hashes(dataSaved);')
+        c.execute('CREATE INDEX hashesDataType ON hashes(dataType);')
+        c.execute('CREATE INDEX hashesDateReceived ON hashes(dateReceived);')
+
+        return
+
+    def _migrateBlockDBBinaryHashes(self, c):
+        '''
+            Schema version 2: store hashes as raw 32 byte blobs instead of 64 character hex text
+        '''
+        c.execute('ALTER TABLE hashes RENAME TO hashesOld;')
+        c.execute('DROP INDEX hashesDataSaved;')
+        c.execute('DROP INDEX hashesDataType;')
+        c.execute('DROP INDEX hashesDateReceived;')
+        c.execute('''CREATE TABLE hashes(
+            hash blob primary key not null,
+            dateReceived int,
+            decrypted int,
+            dataType text,
+            dataFound int,
+            dataSaved int);
+        ''')
+        def convertRows(rows):
+            for row in rows:
+                try:
+                    yield (self._hashKey(row[0]),) + row[1:]
+                except (ValueError, TypeError, AttributeError):
+                    logger.warn('Dropping invalid hash from block database: ' + str(row[0]))
+        oldRows = c.connection.cursor()
+        oldRows.execute('SELECT hash, dateReceived, decrypted, dataType, dataFound, dataSaved FROM hashesOld;')
+        c.executemany('INSERT OR IGNORE INTO hashes (hash, dateReceived, decrypted, dataType, dataFound, dataSaved) VALUES(?, ?, ?, ?, ?, ?);', convertRows(oldRows))
+        oldRows.close()
+        c.execute('DROP TABLE hashesOld;')
+        c.execute('CREATE INDEX hashesDataSaved ON hashes(dataSaved);')
+        c.execute('CREATE INDEX hashesDataType ON hashes(dataType);')
+        c.execute('CREATE INDEX hashesDateReceived ON hashes(dateReceived);')
+
+        return
+
+    def _migrateBlockDBDigest(self, c):
+        '''
+            Schema version 3: incrementally maintained digest of the block set
+        '''
+        c.execute('CREATE TABLE digest(id integer primary key check (id = 0), setSum blob not null, blockCount int not null);')
+        setSum = 0
+        blockCount = 0
+        for row in c.execute('SELECT hash FROM hashes;').fetchall():
+            setSum += int.from_bytes(row[0], 'big')
+            blockCount += 1
+        c.execute('INSERT INTO digest (id, setSum, blockCount) VALUES(0, ?, ?);', ((setSum % 2 ** 256).to_bytes(32, 'big'), blockCount))
+
+        return
+
+    def _migrateBlockDBTree(self, c):
+        '''
+            Schema version 4: per-bucket digests, the leaves of the tree used for block list reconciliation
+        '''
+        c.execute('CREATE TABLE buckets(bucket integer primary key, setSum blob not null, blockCount int not null);')
+        buckets = {}
+        for row in c.execute('SELECT hash FROM hashes;').fetchall():
+            bucket = buckets.setdefault(self._hashBucket(row[0]), [0, 0])
+            bucket[0] += int.from_bytes(row[0], 'big')
+            bucket[1] += 1
+        c.executemany('INSERT INTO buckets (bucket, setSum, blockCount) VALUES(?, ?, ?);', ((bucket, (value[0] % 2 ** 256).to_bytes(32, 'big'), value[1]) for bucket, value in buckets.items()))
+
+        return
+
+    def _migrateBlockDBSequence(self, c):
+        '''
+            Schema version 5: insertion sequence numbers, so peers can ask for the hashes added since a cursor
+        '''
+        c.execute('ALTER TABLE hashes ADD COLUMN seq int;')
+        c.execute('UPDATE hashes SET seq = rowid;')
+        c.execute('CREATE INDEX hashesSeq ON hashes(seq);')
+        c.execute('ALTER TABLE digest ADD COLUMN lastSeq int not null default 0;')
+        c.execute('UPDATE digest SET lastSeq = (SELECT coalesce(max(seq), 0) FROM hashes);')
+
+        return
+
+    def _migrateBlockDBRemovals(self, c):
+        '''
+            Schema version 6: log of removed blocks, so other processes can drop them from their caches
+        '''
+        c.execute('CREATE TABLE removed(seq integer primary key autoincrement, hash blob not null);')
+
+        return
+
+    def _migrateBlockDBRetention(self, c):
+        '''
+            Schema version 7: block sizes, access times and self inserted flags for evicting blocks, and evicted hashes
+
+            Older databases store self inserted blocks the same as saved ones (dataSaved = 1), so every saved block
+            from before the upgrade is treated as self inserted and never evicted
+        '''
+        c.execute('ALTER TABLE hashes ADD COLUMN dataSize int;')
+        c.execute('ALTER TABLE hashes ADD COLUMN lastAccessed int;')
+        c.execute('ALTER TABLE hashes ADD COLUMN selfInsert int not null default 0;')
+        c.execute('UPDATE hashes SET lastAccessed = dateReceived, selfInsert = dataSaved;')
+        c.execute('CREATE INDEX hashesLastAccessed ON hashes(lastAccessed);')
+        c.execute('CREATE TABLE evicted(hash blob primary key not null, dateEvicted int not null);')
+
+        return
+
+    def _hashBucket(self, key):
+        '''
+            Return the bucket (leaf of the reconciliation tree) a block hash key belongs to
+        '''
+        return int.from_bytes(key[:2], 'big') >> (16 - 4 * self.blockTreeDepth)
+
+    def _updateBlockDigest(self, c, keys, removed=False):
+        '''
+            Add (or remove) block hash keys to the block set digest and bucket digests, as part of the cursor's transaction
+
+            A digest is the sum of the hashes modulo 2^256 plus the number of blocks, so it does not depend
+            on insertion order or on how sqlite lays out its pages.
+        '''
+        sign = -1 if removed else 1
+        totalSum = 0
+        totalCount = 0
+        buckets = {}
+        for key in keys:
+            value = sign * int.from_bytes(key, 'big')
+            bucket = buckets.setdefault(self._hashBucket(key), [0, 0])
+            bucket[0] += value
+            bucket[1] += sign
+            totalSum += value
+            totalCount += sign
+        if totalCount == 0:
+            return
+
+        for bucket, delta in buckets.items():
+            c.execute('INSERT OR IGNORE INTO buckets (bucket, setSum, blockCount) VALUES(?, ?, 0);', (bucket, bytes(32)))
+            setSum, blockCount = c.execute('SELECT setSum, blockCount FROM buckets WHERE bucket = ?;', (bucket,)).fetchone()
+            setSum = (int.from_bytes(setSum, 'big') + delta[0]) % 2 ** 256
+            c.execute('UPDATE buckets SET setSum = ?, blockCount = ? WHERE bucket = ?;', (setSum.to_bytes(32, 'big'), blockCount + delta[1], bucket))
+        setSum, blockCount = c.execute('SELECT setSum, blockCount FROM digest WHERE id = 0;').fetchone()
+        setSum = (int.from_bytes(setSum, 'big') + totalSum) % 2 ** 256
+        c.execute('UPDATE digest SET setSum = ?, blockCount = ? WHERE id = 0;', (setSum.to_bytes(32, 'big'), blockCount + totalCount))
+
+        return
+
+    def _digestHash(self, setSum, blockCount):
+        '''
+            Hash a set sum (32 bytes, or an int) and block count into a hex digest
+        '''
+        if type(setSum) is int:
+            setSum = (setSum % 2 ** 256).to_bytes(32, 'big')
+        hasher = hashlib.sha3_256()
+        hasher.update(setSum + blockCount.to_bytes(8, 'big'))
+
+        return hasher.hexdigest()
+
+    def getBlockDigest(self):
+        '''
+            Return the content digest of our block set as a hex sha3_256 hash
+
+            Two nodes holding the same blocks always have the same digest, and reading it is a single row lookup
+        '''
+        with self._db.transaction(self.blockDB) as c:
+            setSum, blockCount = c.execute('SELECT setSum, blockCount FROM digest WHERE id = 0;').fetchone()
+
+        return self._digestHash(setSum, blockCount)
+
+    def getBlockTree(self, prefix):
+        '''
+            Return the 16 children of a node in the block reconciliation tree
+
+            The tree is keyed by hex prefixes of block hashes, the children of prefix are prefix + 0..f.
+            Each child is a (digest, block count) tuple, with the digest truncated to 16 hex characters.
+            Nodes down to blockTreeDepth come from the buckets table, deeper ones from the hashes in range.
+        '''
+        prefix = self._validatePrefix(prefix)
+        children = [[0, 0] for i in range(16)]
+        with self._db.transaction(self.blockDB) as c:
+            if len(prefix) < self.blockTreeDepth:
+                shift = 4 * (self.blockTreeDepth - len(prefix) - 1)
+                low = int(prefix.ljust(self.blockTreeDepth, '0'), 16)
+                high = int(prefix.ljust(self.blockTreeDepth, 'f'), 16)
+                for bucket, setSum, blockCount in c.execute('SELECT bucket, setSum, blockCount FROM buckets WHERE bucket BETWEEN ? AND ?;', (low, high)):
+                    child = children[(bucket >> shift) & 0xf]
+                    child[0] += int.from_bytes(setSum, 'big')
+                    child[1] += blockCount
+            else:
+                low = bytes.fromhex(prefix.ljust(64, '0'))
+                high = bytes.fromhex(prefix.ljust(64, 'f'))
+                for row in c.execute('SELECT hash FROM hashes WHERE hash BETWEEN ? AND ?;', (low, high)):
+                    child = children[int(row[0].hex()[len(prefix)], 16)]
+                    child[0] += int.from_bytes(row[0], 'big')
+                    child[1] += 1
+
+        return [(self._digestHash(setSum, blockCount)[:16], blockCount) for setSum, blockCount in children]
+
+    def getBlocksSince(self, cursor, limit):
+        '''
+            Return up to limit hashes added after the sequence number cursor
+
+            Returns a tuple of the hash list, the cursor to continue from and the newest sequence number
+        '''
+        with self._db.transaction(self.blockDB) as c:
+            head = c.execute('SELECT lastSeq FROM digest WHERE id = 0;').fetchone()[0]
+            rows = c.execute('SELECT hash, seq FROM hashes WHERE seq > ? ORDER BY seq LIMIT ?;', (cursor, limit)).fetchall()
+        if len(rows) > 0:
+            cursor = rows[-1][1]
+
+        return ([row[0].hex() for row in rows], cursor, head)
+
+    def getBlocksByPrefix(self, prefix):
+        '''
+            Return a list of the hashes we have which start with a hex prefix (a leaf of the reconciliation tree)
+        '''
+        prefix = self._validatePrefix(prefix)
+        low = bytes.fromhex(prefix.ljust(64, '0'))
+        high = bytes.fromhex(prefix.ljust(64, 'f'))
+        with self._db.transaction(self.blockDB) as c:
+            retData = [row[0].hex() for row in c.execute('SELECT hash FROM hashes WHERE hash BETWEEN ? AND ?;', (low, high))]
+
+        return retData
+
+    def _validatePrefix(self, prefix):
+        '''
+            Normalize a hex hash prefix, raising ValueError if it is not one
+        '''
+        prefix = prefix.strip().lower()
+        if len(prefix) >= 64 or prefix.strip('0123456789abcdef') != '':
+            raise ValueError('Invalid hash prefix')
+        return prefix
+
+    def _loadBlockFilter(self):
+        '''
+            Load the saved block filter and add blocks inserted since it was saved, or rebuild it
+        '''
+        with self._blockFilterLock:
+            saved = onionrbloom.BloomFilter.load(self.blockFilterFile)
+            with self._db.transaction(self.blockDB) as c:
+                if saved != None:
+                    self._blockFilter, self._blockFilterSeq, self._blockFilterSeqKey = saved
+                    # The newest block it covers must still be there, otherwise the file belongs to another (or a reset) block database
+                    if self._blockFilterSeq > 0:
+                        row = c.execute('SELECT hash FROM hashes WHERE seq = ?;', (self._blockFilterSeq,)).fetchone()
+                        if row == None or row[0] != self._blockFilterSeqKey:
+                            saved = None
+                if saved == None:
+                    self._rebuildBlockFilter(c)
+                else:
+                    self._catchUpBlockFilter(c)
+            self._blockFilterChecked = time.monotonic()
+
+        return
+
+    def _rebuildBlockFilter(self, c):
+        '''
+            Build the block filter from every hash in the block database (must hold self._blockFilterLock)
+        '''
+        blockCount = c.execute('SELECT blockCount FROM digest WHERE id = 0;').fetchone()[0]
+        blockCount += c.execute('SELECT COUNT() FROM evicted;').fetchone()[0]
+        self._blockFilter = onionrbloom.BloomFilter(max(self.blockFilterCapacity, blockCount * 2))
+        # Evicted hashes are included so addBlocksToDB looks them up, and does not add them back
+        for row in c.execute('SELECT hash FROM evicted;'):
+            self._blockFilter.add(row[0])
+        self._blockFilterSeq = 0
+        self._blockFilterSeqKey = bytes(32)
+        self._catchUpBlockFilter(c)
+
+        return
+
+    def _catchUpBlockFilter(self, c):
+        '''
+            Add blocks inserted (by any process) since the filter was last updated (must hold self._blockFilterLock)
+        '''
+        for key, seq in c.execute('SELECT hash, seq FROM hashes WHERE seq > ? ORDER BY seq;', (self._blockFilterSeq,)).fetchall():
+            self._blockFilter.add(key)
+            self._blockFilterSeq = seq
+            self._blockFilterSeqKey = key
+        if self._blockFilter.isFull():
+            self._rebuildBlockFilter(c)
+
+        return
+
+    def _mayHaveBlock(self, key):
+        '''
+            Return False if a block hash key is definitely not in the block database, True if it may be
+        '''
+        with self._blockFilterLock:
+            if time.monotonic() - self._blockFilterChecked >= self.blockFilterRefresh:
+                with self._db.transaction(self.blockDB) as c:
+                    self._catchUpBlockFilter(c)
+                self._blockFilterChecked = time.monotonic()
+
+            return self._blockFilter.check(key)
+
+    def saveBlockFilter(self):
+        '''
+            Save the block filter, so the next start does not have to rebuild it
+        '''
+        with self._blockFilterLock:
+            try:
+                self._blockFilter.save(self.blockFilterFile, self._blockFilterSeq, self._blockFilterSeqKey)
+            except OSError as e:
+                logger.warn('Failed to save block filter: ' + str(e))
+
+        return
+
+    def _hashKey(self, hash):
+        '''
+            Convert a hex block hash to the raw 32 byte key stored in blocks.db
+        '''
+        key = bytes.fromhex(hash.strip())
+        if len(key) != 32:
+            raise ValueError('Block hashes must be 32 bytes')
+        return key
+
+    def _migratePeerDBKeys(self, c):
+        '''
+            Schema version 1: primary key on ID, the oldest entry of duplicates is kept
+        '''
+        c.execute('ALTER TABLE peers RENAME TO peersOld;')
+        c.execute('''CREATE TABLE peers(
+            ID text primary key not null,
+            name text,
+            adders text,
+            blockDBHash text,
+            forwardKey text,
+            dateSeen not null,
+            bytesStored int,
+            trust int);
+        ''')
+        c.execute('''INSERT OR IGNORE INTO peers (ID, name, adders, blockDBHash, forwardKey, dateSeen, bytesStored, trust)
+            SELECT ID, name, adders, blockDBHash, forwardKey, dateSeen, bytesStored, trust FROM peersOld ORDER BY rowid;''')
+        c.execute('DROP TABLE peersOld;')
+
+        return
+
+    def _migrateAddressDBCursor(self, c):
+        '''
+            Schema version 2: the last block sequence number synced from each address
+        '''
+        c.execute('ALTER TABLE adders ADD COLUMN blockCursor int;')
+
+        return
+
+    def _migrateAddressDBLatency(self, c):
+        '''
+            Schema version 3: average response time of each address, see recordPeerRequest
+        '''
+        c.execute('ALTER TABLE adders ADD COLUMN latency real;')
+
+        return
+
+    def _migrateAddressDBScore(self, c):
+        '''
+            Schema version 4: index of each address' score, see bestAdders
+        '''
+        c.execute('CREATE INDEX addersScore ON adders(' + self._peerScoreSQL + ');')
+
+        return
+
+    def _migrateAddressDBKeys(self, c):
+        '''
+            Schema version 1: primary key on address, the oldest entry of duplicates is kept
+        '''
+        c.execute('ALTER TABLE adders RENAME TO addersOld;')
+        c.execute('''CREATE TABLE adders(
+            address text primary key not null,
+            type int,
+            knownPeer text,
+            speed int,
+            success int,
+            DBHash text,
+            failure int
+            );
+        ''')
+        c.execute('''INSERT OR IGNORE INTO adders (address, type, knownPeer, speed, success, DBHash, failure)
+            SELECT address, type, knownPeer, speed, success, DBHash, failure FROM addersOld ORDER BY rowid;''')
+        c.execute('DROP TABLE addersOld;')
+
+        return
+
     def addPeer(self, peerID, name=''):
         '''
             Adds a public key to the key database (misleading function name)
@@ -64,36 +541,58 @@ class Core:
         # This function simply adds a peer to the DB
         if not self._utils.validatePubKey(peerID):
             return False
-        conn = sqlite3.connect(self.peerDB)
-        c = conn.cursor()
         t = (peerID, name, 'unknown')
-        c.execute('INSERT INTO peers (id, name, dateSeen) VALUES(?, ?, ?);', t)
-        conn.commit()
-        conn.close()
+        with self._db.transaction(self.peerDB) as c:
+            c.execute('INSERT OR IGNORE INTO peers (id, name, dateSeen) VALUES(?, ?, ?);', t)
         return True
 
+    def addPeers(self, peerIDs):
+        '''
+            Add many public keys to the key database in one transaction, skipping invalid ones
+
+            Returns the number of keys which were not already known
+        '''
+        peerIDs = [(peerID, '', 'unknown') for peerID in peerIDs if self._utils.validatePubKey(peerID)]
+        if len(peerIDs) == 0:
+            return 0
+        with self._db.transaction(self.peerDB) as c:
+            c.executemany('INSERT OR IGNORE INTO peers (id, name, dateSeen) VALUES(?, ?, ?);', peerIDs)
+            added = c.rowcount
+
+        return added
+
     def addAddress(self, address):
         '''Add an address to the address database (only tor currently)'''
         if self._utils.validateID(address):
-            conn = sqlite3.connect(self.addressDB)
-            c = conn.cursor()
             t = (address, 1)
-            c.execute('INSERT INTO adders (address, type) VALUES(?, ?);', t)
-            conn.commit()
-            conn.close()
+            with self._db.transaction(self.addressDB) as c:
+                c.execute('INSERT OR IGNORE INTO adders (address, type) VALUES(?, ?);', t)
             return True
         else:
             return False
 
+    def addAddresses(self, addresses):
+        '''
+            Add many addresses to the address database in one transaction, skipping invalid ones
+
+            Returns the number of addresses which were not already known
+        '''
+        addresses = [(address, 1) for address in addresses if self._utils.validateID(address)]
+        if len(addresses) == 0:
+            return 0
+        with self._db.transaction(self.addressDB) as c:
+            c.executemany('INSERT OR IGNORE INTO adders (address, type) VALUES(?, ?);', addresses)
+            added = c.rowcount
+
+        return added
+
     def removeAddress(self, address):
         '''Remove an address from the address database'''
         if self._utils.validateID(address):
-            conn = sqlite3.connect(self.addressDB)
-            c = conn.cursor()
             t = (address,)
-            c.execute('Delete from adders where address=?;', t)
-            conn.commit()
-            conn.close()
+            with self._db.transaction(self.addressDB) as c:
+                c.execute('Delete from adders where address=?;', t)
+            self._addressCache.forget(address)
             return True
         else:
             return False 
@@ -106,68 +605,90 @@ class Core:
                 1: I2P b32 address
                 2: Tor v2 (like facebookcorewwwi.onion)
                 3: Tor v3
+
+            speed, success, failure and latency are decayed averages kept by recordPeerRequest and recordPeerSpeed
         '''
-        conn = sqlite3.connect(self.addressDB)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE adders(
-            address text,
-            type int,
-            knownPeer text,
-            speed int,
-            success int,
-            DBHash text,
-            failure int
-            );
-        ''')
-        conn.commit()
-        conn.close()
+        with self._db.transaction(self.addressDB) as c:
+            c.execute('''CREATE TABLE adders(
+                address text primary key not null,
+                type int,
+                knownPeer text,
+                speed int,
+                success int,
+                DBHash text,
+                failure int,
+                blockCursor int,
+                latency real
+                );
+            ''')
+            c.execute('CREATE INDEX addersScore ON adders(' + self._peerScoreSQL + ');')
+            self._db.setVersion(c, len(self._migrations[self.addressDB]))
 
     def createPeerDB(self):
         '''
             Generate the peer sqlite3 database and populate it with the peers table.
         '''
         # generate the peer database
-        conn = sqlite3.connect(self.peerDB)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE peers(
-            ID text not null,
-            name text,
-            adders text,
-            blockDBHash text,
-            forwardKey text,
-            dateSeen not null,
-            bytesStored int,
-            trust int);
-        ''')
-        conn.commit()
-        conn.close()
+        with self._db.transaction(self.peerDB) as c:
+            c.execute('''CREATE TABLE peers(
+                ID text primary key not null,
+                name text,
+                adders text,
+                blockDBHash text,
+                forwardKey text,
+                dateSeen not null,
+                bytesStored int,
+                trust int);
+            ''')
+            self._db.setVersion(c, len(self._migrations[self.peerDB]))
         return
 
     def createBlockDB(self):
         '''
             Create a database for blocks
 
-            hash - the hash of a block
+            hash - the hash of a block, stored as 32 raw bytes (hex is only used outside of the database)
             dateReceived - the date the block was recieved, not necessarily when it was created
             decrypted - if we can successfully decrypt the block (does not describe its current state)
             dataType - data type of the block
             dataFound - if the data has been found for the block
             dataSaved - if the data has been saved for the block
+            seq - insertion sequence number, never reused, for peers syncing with getBlockHashesSince
+            dataSize - bytes the block's data takes in storage (null if not known yet)
+            lastAccessed - the date the block's data was last read, for evicting the least recently used blocks
+            selfInsert - if we created the block, these are never evicted
+
+            The digest table holds a single row with the running digest of the block set, see getBlockDigest,
+            and the buckets table the digests of the leaves of the reconciliation tree, see getBlockTree.
+            The removed table logs the most recently removed blocks, see getBlocksRemovedSince, and the evicted
+            table holds blocks evicted to stay under the storage quota, see enforceBlockQuota
         '''
         if os.path.exists(self.blockDB):
             raise Exception("Block database already exists")
-        conn = sqlite3.connect(self.blockDB)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE hashes(
-            hash text not null,
-            dateReceived int,
-            decrypted int,
-            dataType text,
-            dataFound int,
-            dataSaved int);
-        ''')
-        conn.commit()
-        conn.close()
+        with self._db.transaction(self.blockDB) as c:
+            c.execute('''CREATE TABLE hashes(
+                hash blob primary key not null,
+                dateReceived int,
+                decrypted int,
+                dataType text,
+                dataFound int,
+                dataSaved int,
+                seq int,
+                dataSize int,
+                lastAccessed int,
+                selfInsert int not null default 0);
+            ''')
+            c.execute('CREATE INDEX hashesDataSaved ON hashes(dataSaved);')
+            c.execute('CREATE INDEX hashesDataType ON hashes(dataType);')
+            c.execute('CREATE INDEX hashesDateReceived ON hashes(dateReceived);')
+            c.execute('CREATE INDEX hashesSeq ON hashes(seq);')
+            c.execute('CREATE INDEX hashesLastAccessed ON hashes(lastAccessed);')
+            c.execute('CREATE TABLE digest(id integer primary key check (id = 0), setSum blob not null, blockCount int not null, lastSeq int not null default 0);')
+            c.execute('INSERT INTO digest (id, setSum, blockCount) VALUES(0, ?, 0);', (bytes(32),))
+            c.execute('CREATE TABLE buckets(bucket integer primary key, setSum blob not null, blockCount int not null);')
+            c.execute('CREATE TABLE removed(seq integer primary key autoincrement, hash blob not null);')
+            c.execute('CREATE TABLE evicted(hash blob primary key not null, dateEvicted int not null);')
+            self._db.setVersion(c, len(self._migrations[self.blockDB]))
 
         return
 
@@ -179,76 +700,437 @@ class Core:
         '''
         if not os.path.exists(self.blockDB):
             raise Exception('Block db does not exist')
-        if self._utils.hasBlock(newHash):
-            return
-        conn = sqlite3.connect(self.blockDB)
-        c = conn.cursor()
+        if not self._utils.validateHash(newHash):
+            raise Exception('Invalid hash')
+        self.addBlocksToDB((newHash,), selfInsert)
+
+        return
+
+    def addBlocksToDB(self, hashes, selfInsert=False):
+        '''
+            Add many hex hash values to the block db in one transaction
+
+            Invalid, already known and recently evicted hashes are skipped, returns the list of hashes which were added
+        '''
+        if not os.path.exists(self.blockDB):
+            raise Exception('Block db does not exist')
+        keys = {}
+        for hash in hashes:
+            try:
+                keys[self._hashKey(hash)] = None
+            except (ValueError, TypeError, AttributeError):
+                continue
         currentTime = math.floor(time.time())
         if selfInsert:
             selfInsert = 1
         else:
             selfInsert = 0
-        data = (newHash, currentTime, 0, '', 0, selfInsert)
-        c.execute('INSERT INTO hashes VALUES(?, ?, ?, ?, ?, ?);', data)
-        conn.commit()
-        conn.close()
 
-        return
+        # Hashes missing from the block filter are definitely new, only possible hits need to be looked up
+        with self._db.transaction(self.blockDB) as c:
+            maybeKnown = [key for key in keys if self._mayHaveBlock(key)]
+            for key in self._knownBlockKeys(c, maybeKnown) + self._knownBlockKeys(c, maybeKnown, 'evicted'):
+                del keys[key]
+        if len(keys) == 0:
+            return []
+        with self._db.transaction(self.blockDB, immediate=True) as c:
+            # Check again under the write lock, in case another process added some of them in the meantime
+            for key in self._knownBlockKeys(c, list(keys)):
+                del keys[key]
+            if len(keys) == 0:
+                return []
+            # Nothing else can insert while this transaction holds the write lock, so these sequence numbers are ours
+            lastSeq = c.execute('SELECT lastSeq FROM digest WHERE id = 0;').fetchone()[0]
+            rows = [(key, currentTime, 0, '', 0, selfInsert, lastSeq + i + 1, currentTime, selfInsert) for i, key in enumerate(keys)]
+            c.executemany('INSERT INTO hashes (hash, dateReceived, decrypted, dataType, dataFound, dataSaved, seq, lastAccessed, selfInsert) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);', rows)
+            c.execute('UPDATE digest SET lastSeq = ? WHERE id = 0;', (lastSeq + len(rows),))
+            self._updateBlockDigest(c, keys)
+        # Seen by this process right away, other processes pick them up on their next refresh
+        with self._blockFilterLock:
+            for key in keys:
+                self._blockFilter.add(key)
+
+        return [key.hex() for key in keys]
+
+    def _knownBlockKeys(self, c, keys, table='hashes'):
+        '''
+            Return which of a list of block hash keys are in the block database (or another table keyed by hash)
+        '''
+        known = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            known.extend(row[0] for row in c.execute('SELECT hash FROM ' + table + ' WHERE hash IN (' + ','.join('?' * len(chunk)) + ');', chunk))
+
+        return known
 
     def getData(self,hash):
         '''
             Simply return the data associated to a hash
         '''
-        try:
-            dataFile = open(self.blockDataLocation + hash + '.dat')
-            data = dataFile.read()
-            dataFile.close()
-        except FileNotFoundError:
-            data = False
+        data = self.getDataBytes(hash)
+        if data != False:
+            data = data.decode()
 
         return data
 
+    def getDataBytes(self, hash):
+        '''
+            Return the raw bytes of a block, or False if it is not stored
+        '''
+        if not self._utils.validateHash(hash):
+            return False
+        hash = hash.strip().lower()
+        self._recordAccess(hash)
+        data = None
+        if self._blockCache != None:
+            self._syncBlockCache()
+            data = self._blockCache.get(hash)
+        if data == None:
+            data = self._storage.read(hash)
+            if data == False and self._storage is not self._fileStorage:
+                # Saved before switching to the packfile backend, and not yet moved by migrateBlockStorage
+                data = self._fileStorage.read(hash)
+            if data != False:
+                try:
+                    data = onionrstorage.decodeBlock(data, onionrarchive.getStorageKey())
+                except onionrarchive.ArchiveError as e:
+                    logger.warn('Could not decrypt block ' + hash + ': ' + str(e))
+                    return False
+            if data != False and self._blockCache != None:
+                self._blockCache.put(hash, data)
+
+        return data
+
+    def openData(self, hash):
+        '''
+            Open a block for reading without holding all of it in memory
+
+            Returns a tuple of a file object positioned at the start of the block and the block's length, or False if
+            it is not stored. Read no more than the length from the file, and close it when done. With the block cache
+            on, small blocks are read (and cached) and returned as an io.BytesIO.
+        '''
+        if not self._utils.validateHash(hash):
+            return False
+        hash = hash.strip().lower()
+        self._recordAccess(hash)
+        if self._blockCache != None:
+            self._syncBlockCache()
+            data = self._blockCache.get(hash)
+            if data != None:
+                return (io.BytesIO(data), len(data))
+        opened = self._openStored(hash)
+        if opened == False:
+            return False
+        try:
+            opened = onionrstorage.openBlock(*opened, onionrarchive.getStorageKey())
+        except onionrarchive.ArchiveError as e:
+            logger.warn('Could not decrypt block ' + hash + ': ' + str(e))
+            return False
+        if self._blockCache == None or opened[1] > self.cacheableBlockSize:
+            return opened
+        with opened[0] as blockFile:
+            data = blockFile.read(opened[1])
+        self._blockCache.put(hash, data)
+
+        return (io.BytesIO(data), len(data))
+
+    def openCompressedData(self, hash, codec):
+        '''
+            Open a block stored compressed with codec, for sending it on without decompressing it
+
+            Returns a tuple of a file object positioned at the compressed data and its length, or False if the block
+            is not stored, is not stored with that codec, or is encrypted
+        '''
+        if not self._utils.validateHash(hash):
+            return False
+        opened = self._openStored(hash.strip().lower())
+        if opened == False:
+            return False
+        blockFile, storedLength = opened
+        headerData = blockFile.read(onionrstorage.blockHeader.size)
+        header = onionrstorage.readHeader(headerData)
+        if header == None or header[0] != codec or onionrstorage.isEncrypted(headerData):
+            blockFile.close()
+            return False
+
+        return (blockFile, storedLength - onionrstorage.blockHeader.size)
+
+    def _openStored(self, hash):
+        '''
+            Open a block as stored (possibly compressed), returns a tuple of the file and the stored length, or False
+        '''
+        opened = self._storage.open(hash)
+        if opened == False and self._storage is not self._fileStorage:
+            opened = self._fileStorage.open(hash)
+
+        return opened
+
     def setData(self, data):
         '''
-            Set the data assciated with a hash
+            Set the data assciated with a hash, data can be str or bytes
+        '''
+        if type(data) is str:
+            data = data.encode()
+
+        return self.setDataStream(io.BytesIO(data))
+
+    def setDataStream(self, stream, expectedHash=None, maxSize=None):
+        '''
+            Store a block read from a file object, hashing it while it is written to a temporary file
+
+            The block is only moved into place once it is complete, and if it matches expectedHash (when given).
+            Returns the block's hash, or False if it did not match or was larger than maxSize bytes
         '''
-        data = data.encode()
         hasher = hashlib.sha3_256()
-        hasher.update(data)
-        dataHash = hasher.hexdigest()
-        if type(dataHash) is bytes:
-            dataHash = dataHash.decode()
-        blockFileName = self.blockDataLocation + dataHash + '.dat'
-        if os.path.exists(blockFileName):
-            pass # TODO: properly check if block is already saved elsewhere
-            #raise Exception("Data is already set for " + dataHash)
-        else:
-            blockFile = open(blockFileName, 'w')
-            blockFile.write(data.decode())
-            blockFile.close()
+        size = 0
+        tempFile, tempPath = self._storage.createTemp()
+        try:
+            # The hash is always of the block itself, whether or not it is stored compressed (or encrypted)
+            writer = onionrstorage.BlockWriter(tempFile, self.blockCompression, onionrarchive.getStorageKey())
+            with tempFile:
+                while True:
+                    chunk = stream.read(65536)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if maxSize != None and size > maxSize:
+                        return False
+                    hasher.update(chunk)
+                    writer.write(chunk)
+                writer.close()
+            dataHash = hasher.hexdigest()
+            if expectedHash != None and dataHash != expectedHash.strip().lower():
+                return False
+            storedSize = os.path.getsize(tempPath)
+            self._storage.commitTemp(dataHash, tempPath)
+            tempPath = None
+        finally:
+            if tempPath != None:
+                os.remove(tempPath)
 
-        conn = sqlite3.connect(self.blockDB)
-        c = conn.cursor()
-        c.execute("UPDATE hashes SET dataSaved=1 WHERE hash = '" + dataHash + "';")
-        conn.commit()
-        conn.close()
+        with self._db.transaction(self.blockDB) as c:
+            c.execute('UPDATE hashes SET dataSaved=1, dataSize = ?, lastAccessed = ? WHERE hash = ?;', (storedSize, math.floor(time.time()), self._hashKey(dataHash)))
 
         return dataHash
 
+    def removeBlock(self, hash):
+        '''
+            Remove a block from the block database and delete its data
+        '''
+        if not self._utils.validateHash(hash):
+            raise ValueError('Invalid block hash')
+        self.removeBlocks((hash,))
+
+        return
+
+    def removeBlocks(self, hashes, evict=False):
+        '''
+            Remove blocks from the block database in one transaction, then delete their data
+
+            With evict, the hashes are remembered for evictedBlockLifetime so peers advertising them do not get them
+            added back. Returns the list of hashes which were removed
+        '''
+        keys = {}
+        for hash in hashes:
+            try:
+                keys[self._hashKey(hash)] = None
+            except (ValueError, TypeError, AttributeError):
+                continue
+        with self._db.transaction(self.blockDB, immediate=True) as c:
+            keys = self._knownBlockKeys(c, list(keys))
+            if len(keys) == 0:
+                return []
+            c.executemany('DELETE FROM hashes WHERE hash = ?;', [(key,) for key in keys])
+            self._updateBlockDigest(c, keys, removed=True)
+            c.executemany('INSERT INTO removed (hash) VALUES(?);', [(key,) for key in keys])
+            c.execute('DELETE FROM removed WHERE seq <= ?;', (c.execute('SELECT max(seq) FROM removed;').fetchone()[0] - self.removedBlockLog,))
+            if evict:
+                currentTime = math.floor(time.time())
+                c.executemany('INSERT OR REPLACE INTO evicted (hash, dateEvicted) VALUES(?, ?);', [(key, currentTime) for key in keys])
+        # Files can't be part of the transaction, so they go once the rows are gone and nothing points at them
+        hashes = [key.hex() for key in keys]
+        for hash in hashes:
+            if self._blockCache != None:
+                self._blockCache.invalidate(hash)
+            self._storage.delete(hash)
+            if self._storage is not self._fileStorage:
+                self._fileStorage.delete(hash)
+
+        return hashes
+
+    def enforceBlockQuota(self, quota):
+        '''
+            Evict the least recently read blocks until the stored block data fits in quota bytes
+
+            Blocks we created are never evicted. Evicts down to quotaLowWatermark of the quota, so it does not run
+            again for every new block.
+            Returns a tuple of the number of blocks evicted and the number of bytes they took
+        '''
+        self.flushBlockAccesses()
+        self._fillBlockSizes()
+        with self._db.transaction(self.blockDB) as c:
+            c.execute('DELETE FROM evicted WHERE dateEvicted < ?;', (math.floor(time.time()) - self.evictedBlockLifetime,))
+            total = c.execute('SELECT coalesce(sum(dataSize), 0) FROM hashes WHERE dataSaved = 1;').fetchone()[0]
+        if total <= quota:
+            return (0, 0)
+        target = total - int(quota * self.quotaLowWatermark)
+        evictCount = 0
+        evictedBytes = 0
+        while evictedBytes < target:
+            with self._db.transaction(self.blockDB) as c:
+                rows = c.execute('SELECT hash, dataSize FROM hashes WHERE dataSaved = 1 AND selfInsert = 0 ORDER BY lastAccessed LIMIT 1000;').fetchall()
+            chosen = []
+            for key, size in rows:
+                if evictedBytes >= target:
+                    break
+                chosen.append(key.hex())
+                evictedBytes += size or 0
+            if len(chosen) == 0:
+                logger.warn('Blocks we created take more than the storage quota, not evicting them')
+                break
+            evictCount += len(self.removeBlocks(chosen, evict=True))
+        if evictCount > 0:
+            self.compactBlockStorage()
+
+        return (evictCount, evictedBytes)
+
+    def _fillBlockSizes(self):
+        '''
+            Record the stored size of saved blocks where it is not known yet (blocks saved before sizes were tracked)
+        '''
+        while True:
+            with self._db.transaction(self.blockDB) as c:
+                keys = [row[0] for row in c.execute('SELECT hash FROM hashes WHERE dataSaved = 1 AND dataSize IS NULL LIMIT 1000;')]
+            if len(keys) == 0:
+                break
+            sizes = []
+            for key in keys:
+                opened = self._openStored(key.hex())
+                if opened == False:
+                    sizes.append((0, key))
+                else:
+                    opened[0].close()
+                    sizes.append((opened[1], key))
+            with self._db.transaction(self.blockDB) as c:
+                c.executemany('UPDATE hashes SET dataSize = ? WHERE hash = ?;', sizes)
+
+        return
+
+    def _recordAccess(self, hash):
+        '''
+            Note that a block was read, access times are written in batches by flushBlockAccesses
+        '''
+        with self._blockAccessLock:
+            self._blockAccesses[hash] = math.floor(time.time())
+        if time.monotonic() - self._blockAccessFlushed >= self.accessFlushInterval:
+            self.flushBlockAccesses()
+
+        return
+
+    def flushBlockAccesses(self):
+        '''
+            Write recorded block access times to the block database
+        '''
+        with self._blockAccessLock:
+            accesses = self._blockAccesses
+            self._blockAccesses = {}
+            self._blockAccessFlushed = time.monotonic()
+        if len(accesses) == 0:
+            return
+        rows = []
+        for hash, accessTime in accesses.items():
+            try:
+                rows.append((accessTime, self._hashKey(hash)))
+            except ValueError:
+                pass
+        with self._db.transaction(self.blockDB) as c:
+            c.executemany('UPDATE hashes SET lastAccessed = ? WHERE hash = ?;', rows)
+
+        return
+
+    def getBlocksRemovedSince(self, cursor):
+        '''
+            Return the hashes removed after the removal log position cursor, and the position to continue from
+
+            The hash list is None if the log no longer goes back that far, then any of our blocks may have been removed.
+        '''
+        with self._db.transaction(self.blockDB) as c:
+            oldest, newest = c.execute('SELECT min(seq), max(seq) FROM removed;').fetchone()
+            if newest == None:
+                return ([], cursor)
+            if oldest > cursor + 1:
+                return (None, newest)
+            rows = c.execute('SELECT hash FROM removed WHERE seq > ? ORDER BY seq;', (cursor,)).fetchall()
+
+        return ([row[0].hex() for row in rows], max(cursor, newest))
+
+    def enableBlockCache(self, maxBytes):
+        '''
+            Keep up to maxBytes of recently read blocks in memory for getData
+        '''
+        self._blockCache = onionrstorage.BlockCache(maxBytes)
+        self._blockCacheCursor = self.getBlocksRemovedSince(0)[1]
+        self._blockCacheChecked = time.monotonic()
+
+        return self._blockCache
+
+    def _syncBlockCache(self):
+        '''
+            Drop blocks which other processes have removed from the block cache, at most once every blockFilterRefresh seconds
+        '''
+        if time.monotonic() - self._blockCacheChecked < self.blockFilterRefresh:
+            return
+        self._blockCacheChecked = time.monotonic()
+        removed, self._blockCacheCursor = self.getBlocksRemovedSince(self._blockCacheCursor)
+        if removed == None:
+            self._blockCache.clear()
+        else:
+            for hash in removed:
+                self._blockCache.invalidate(hash)
+
+        return
+
+    def compactBlockStorage(self):
+        '''
+            Reclaim space left by removed blocks, returns the number of bytes reclaimed
+        '''
+        return self._storage.compact()
+
+    def migrateBlockStorage(self):
+        '''
+            Move block files from the old flat directory into the sharded layout, or into the packfiles
+            if that backend is configured. Returns the number of blocks moved
+        '''
+        moved = self._fileStorage.migrate()
+        if self._storage is not self._fileStorage:
+            moved = 0
+            for hash in list(self._fileStorage.listBlocks()):
+                self._storage.write(hash, self._fileStorage.read(hash))
+                self._fileStorage.delete(hash)
+                moved += 1
+                if moved % 10000 == 0:
+                    logger.info('Packed ' + str(moved) + ' blocks...')
+
+        return moved
+
     def dataDirEncrypt(self, password):
         '''
             Encrypt the data directory on Onionr shutdown
         '''
-        if os.path.exists('data.tar'):
-            os.remove('data.tar')
-        tar = tarfile.open("data.tar", "w")
-        for name in ['data']:
-            tar.add(name)
-        tar.close()
-        tarData = open('data.tar', 'r',  encoding = "ISO-8859-1").read()
-        encrypted = simplecrypt.encrypt(password, tarData)
-        open('data-encrypted.dat', 'wb').write(encrypted)
-        os.remove('data.tar')
+        # Checkpoints the WAL journals so the archive holds complete databases
+        self.close()
+        onionrarchive.encryptDirectory('data', 'data-encrypted.dat', password)
+
+        return
+
+    def dataDirLock(self):
+        '''
+            Encrypt the databases and keys in the data directory on Onionr shutdown, when storage encryption is unlocked
+
+            Blocks are already encrypted as they are stored, so only small files are encrypted here
+        '''
+        self.close()
+        onionrarchive.lockDataDirectory(onionrarchive.getStorageKey())
 
         return
 
@@ -258,6 +1140,20 @@ class Core:
         '''
         if not os.path.exists('data-encrypted.dat'):
             return (False, 'encrypted archive does not exist')
+        self.close()
+        if not onionrarchive.isArchive('data-encrypted.dat'):
+            return self._legacyDataDirDecrypt(password)
+        try:
+            onionrarchive.decryptDirectory('data-encrypted.dat', password)
+        except onionrarchive.ArchiveError as e:
+            return (False, str(e))
+
+        return (True, '')
+
+    def _legacyDataDirDecrypt(self, password):
+        '''
+            Decrypt a data directory archive written by older versions (simplecrypt over the whole tar file)
+        '''
         data = open('data-encrypted.dat', 'rb').read()
         try:
             decrypted = simplecrypt.decrypt(password, data)
@@ -271,45 +1167,84 @@ class Core:
 
         return (True, '')
 
+    def createQueueDB(self):
+        '''
+            Create the daemon queue database
+
+            Commands are taken highest priority first, then in the order they were added
+        '''
+        with self._db.transaction(self.queueDB) as c:
+            # Another process may have just created it
+            c.execute('''CREATE TABLE IF NOT EXISTS commands
+                        (id integer primary key autoincrement, command text, data text, date text, priority int not null default 0)''')
+            c.execute('CREATE INDEX IF NOT EXISTS commandsPriority ON commands(priority DESC, id);')
+            self._db.setVersion(c, len(self._migrations[self.queueDB]))
+
+        return
+
+    def _migrateQueueDBPriority(self, c):
+        '''
+            Schema version 1: command priorities
+        '''
+        # Older versions of daemonQueueAdd could leave an empty database with no table, if it ran before daemonQueue
+        if c.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'commands';").fetchone()[0] == 0:
+            c.execute('''CREATE TABLE commands
+                        (id integer primary key autoincrement, command text, data text, date text, priority int not null default 0)''')
+        else:
+            c.execute('ALTER TABLE commands ADD COLUMN priority int not null default 0;')
+        c.execute('CREATE INDEX IF NOT EXISTS commandsPriority ON commands(priority DESC, id);')
+
+        return
+
     def daemonQueue(self):
         '''
             Gives commands to the communication proccess/daemon by reading an sqlite3 database
 
             This function intended to be used by the client. Queue to exchange data between "client" and server.
+            Returns the next command as a tuple of (command, data, date, id), or False if there are none.
+        '''
+        commands = self.daemonQueueBatch(1)
+        if len(commands) == 0:
+            return False
+
+        return commands[0]
+
+    def daemonQueueBatch(self, limit):
+        '''
+            Take up to limit commands from the daemon queue in one transaction, highest priority first
+
+            Returns a list of (command, data, date, id) tuples
         '''
-        retData = False
         if not os.path.exists(self.queueDB):
-            conn = sqlite3.connect(self.queueDB)
-            c = conn.cursor()
-            # Create table
-            c.execute('''CREATE TABLE commands
-                        (id integer primary key autoincrement, command text, data text, date text)''')
-            conn.commit()
-        else:
-            conn = sqlite3.connect(self.queueDB)
-            c = conn.cursor()
-            for row in c.execute('SELECT command, data, date, min(ID) FROM commands group by id'):
-                retData = row
-                break
-            if retData != False:
-                c.execute('DELETE FROM commands WHERE id=?;', (retData[3],))
-        conn.commit()
-        conn.close()
+            self.createQueueDB()
+            return []
+        # Immediate, so two processes taking commands never both get the same one
+        with self._db.transaction(self.queueDB, immediate=True) as c:
+            commands = c.execute('SELECT command, data, date, id FROM commands ORDER BY priority DESC, id LIMIT ?;', (limit,)).fetchall()
+            c.executemany('DELETE FROM commands WHERE id=?;', [(command[3],) for command in commands])
 
-        return retData
+        return commands
 
-    def daemonQueueAdd(self, command, data=''):
+    def daemonQueueAdd(self, command, data='', priority=0):
         '''
             Add a command to the daemon queue, used by the communication daemon (communicator.py)
+
+            Commands with a higher priority are taken first. The communicator understands:
+                shutdown - exit
+                downloadBlock (data is a block hash) - fetch a block now, rather than on the next timer
+                lookupBlocks - fetch peers' new block lists now
+                syncPeer (data is a peer address) - fetch one peer's new block list now
+                getNewPeers - ask peers for more peers now
         '''
         # Intended to be used by the web server
         date = math.floor(time.time())
-        conn = sqlite3.connect(self.queueDB)
-        c = conn.cursor()
-        t = (command, data, date)
-        c.execute('INSERT INTO commands (command, data, date) VALUES(?, ?, ?)', t)
-        conn.commit()
-        conn.close()
+        t = (command, data, date, priority)
+        if not os.path.exists(self.queueDB):
+            self.createQueueDB()
+        with self._db.transaction(self.queueDB) as c:
+            c.execute('INSERT INTO commands (command, data, date, priority) VALUES(?, ?, ?, ?)', t)
+        # The command is in the database first, so a lost wakeup only delays it until the communicator next checks
+        self._queueWakeup.notify()
 
         return
 
@@ -317,31 +1252,28 @@ class Core:
         '''
             Clear the daemon queue (somewhat dangerous)
         '''
-        conn = sqlite3.connect(self.queueDB)
-        c = conn.cursor()
         try:
-            c.execute('delete from commands;')
-            conn.commit()
+            with self._db.transaction(self.queueDB) as c:
+                c.execute('delete from commands;')
         except:
             pass
-        conn.close()
 
         return
     
     def listAdders(self, randomOrder=True, i2p=True):
         '''
             Return a list of addresses
+
+            This reads (and with randomOrder, sorts) the whole table, use sampleAdders to pick a few peers
         '''
-        conn = sqlite3.connect(self.addressDB)
-        c = conn.cursor()
-        if randomOrder:
-            addresses = c.execute('SELECT * FROM adders ORDER BY RANDOM();')
-        else:
-            addresses = c.execute('SELECT * FROM adders;')
         addressList = []
-        for i in addresses:
-            addressList.append(i[0])
-        conn.close()
+        with self._db.transaction(self.addressDB) as c:
+            if randomOrder:
+                addresses = c.execute('SELECT * FROM adders ORDER BY RANDOM();')
+            else:
+                addresses = c.execute('SELECT * FROM adders;')
+            for i in addresses:
+                addressList.append(i[0])
         return addressList
 
     def listPeers(self, randomOrder=True):
@@ -350,123 +1282,230 @@ class Core:
 
             randomOrder determines if the list should be in a random order
         '''
-        conn = sqlite3.connect(self.peerDB)
-        c = conn.cursor()
-        if randomOrder:
-            peers = c.execute('SELECT * FROM peers ORDER BY RANDOM();')
-        else:
-            peers = c.execute('SELECT * FROM peers;')
         peerList = []
-        for i in peers:
-            peerList.append(i[2])
-        conn.close()
+        with self._db.transaction(self.peerDB) as c:
+            if randomOrder:
+                peers = c.execute('SELECT ID FROM peers ORDER BY RANDOM();')
+            else:
+                peers = c.execute('SELECT ID FROM peers;')
+            for i in peers:
+                peerList.append(i[0])
 
         return peerList
 
+    def sampleAdders(self, k, filter=None):
+        '''
+            Return up to k random addresses, without reading the whole address table
+
+            filter is an optional function taking an address and returning whether it may be picked
+        '''
+        return self._sampleTable(self.addressDB, 'adders', 'address', k, filter)
+
+    def bestAdders(self, k, filter=None):
+        '''
+            Return up to k of the addresses with the highest scores (see peerScore), best first
+
+            Read in order from the addersScore index, so only as many rows as needed are looked at.
+            filter is an optional function taking an address and returning whether it may be picked
+        '''
+        best = []
+        if k <= 0:
+            return best
+        with self._db.transaction(self.addressDB) as c:
+            for row in c.execute('SELECT address FROM adders ORDER BY ' + self._peerScoreSQL + ' DESC;'):
+                if filter == None or filter(row[0]):
+                    best.append(row[0])
+                    if len(best) >= k:
+                        break
+
+        return best
+
+    def samplePeers(self, k, filter=None):
+        '''
+            Return up to k random public keys (see listPeers), without reading the whole key table
+
+            filter is an optional function taking a key and returning whether it may be picked
+        '''
+        return self._sampleTable(self.peerDB, 'peers', 'ID', k, filter)
+
+    def recordPeerRequest(self, address, succeeded, seconds):
+        '''
+            Record the outcome of a request to an address, and how long it took to answer
+
+            Successes and failures are decayed counts (older ones count for less with each request), and latency is
+            a moving average of answered requests, so the scores follow how a peer behaves now
+        '''
+        decay = self.peerScoreDecay
+        weight = self.peerAverageWeight
+        assignments = 'success = max(coalesce(success, 0), 0) * ? + ?, failure = max(coalesce(failure, 0), 0) * ? + ?'
+        params = [decay, 1 if succeeded else 0, decay, 0 if succeeded else 1]
+        if succeeded:
+            assignments += ', latency = coalesce(latency * ? + ? * ?, ?)'
+            params += [1 - weight, seconds, weight, seconds]
+        self._addressCache.update(address, assignments, params)
+
+        return
+
+    def recordPeerSpeed(self, address, size, seconds):
+        '''
+            Record a transfer of size bytes from an address, in the moving average of its speed (bytes per second)
+        '''
+        speed = size / max(seconds, 0.001)
+        self._addressCache.update(address, 'speed = coalesce(speed * ? + ? * ?, ?)', (1 - self.peerAverageWeight, speed, self.peerAverageWeight, speed))
+
+        return
+
+    def peerScore(self, address):
+        '''
+            Return how strongly to prefer an address: its estimated chance of answering divided by its average latency
+
+            Addresses without a history score as if they answered half the time, at peerDefaultLatency
+        '''
+        success = max(self.getAddressInfo(address, 'success') or 0, 0)
+        failure = max(self.getAddressInfo(address, 'failure') or 0, 0)
+        latency = self.getAddressInfo(address, 'latency') or self.peerDefaultLatency
+        reliability = (success + 1) / (success + failure + 2)
+
+        return reliability / max(latency, 0.1)
+
+    def choosePeers(self, k, filter=None):
+        '''
+            Pick up to k addresses to contact, favouring ones which answer quickly and reliably
+
+            Addresses are drawn in proportion to their score, without replacement, from a random sample (see
+            sampleAdders) together with the best scoring addresses (see bestAdders). The best are always candidates,
+            however large the table, and the random ones mean new and struggling peers are still tried now and then
+        '''
+        candidates = self.sampleAdders(k * self.peerCandidateFactor, filter)
+        for address in self.bestAdders(k * self.peerCandidateFactor, filter):
+            if address not in candidates:
+                candidates.append(address)
+        keyed = []
+        for address in candidates:
+            # Weighted sampling: the k largest random() ** (1 / weight) are a weighted sample of size k
+            keyed.append((random.random() ** (1 / self.peerScore(address)), address))
+        keyed.sort(reverse=True)
+
+        return [address for key, address in keyed[:k]]
+
+    def peerLatencyPercentile(self, fraction):
+        '''
+            Return the average latency (seconds) that fraction of the addresses which have answered are within
+
+            Returns peerDefaultLatency if no address has answered yet
+        '''
+        with self._db.transaction(self.addressDB) as c:
+            count = c.execute('SELECT count(*) FROM adders WHERE latency IS NOT NULL;').fetchone()[0]
+            if count == 0:
+                return self.peerDefaultLatency
+            # Nearest rank
+            rank = min(max(math.ceil(count * fraction), 1), count)
+            latency = c.execute('SELECT latency FROM adders WHERE latency IS NOT NULL ORDER BY latency LIMIT 1 OFFSET ?;', (rank - 1,)).fetchone()[0]
+
+        return latency
+
+    def _sampleTable(self, path, table, column, k, filter=None):
+        '''
+            Pick up to k distinct random values of a column, by looking up the first row at or after random rowids
+
+            Each pick is one index lookup, so the cost depends on k rather than the size of the table. Rows after
+            gaps left by deleted rows are a little more likely to be picked, which is fine for choosing peers.
+            Small tables, and tables where the random picks keep missing (mostly filtered out), are read whole.
+        '''
+        if k <= 0:
+            return []
+        picked = {} # rowid: value
+        with self._db.transaction(path) as c:
+            low, high = c.execute('SELECT min(rowid), max(rowid) FROM ' + table + ';').fetchone()
+            if low == None:
+                return []
+            if high - low + 1 > k * 4:
+                for attempt in range(k * 4):
+                    row = c.execute('SELECT rowid, ' + column + ' FROM ' + table + ' WHERE rowid >= ? ORDER BY rowid LIMIT 1;', (random.randint(low, high),)).fetchone()
+                    if row[0] in picked or (filter != None and not filter(row[1])):
+                        continue
+                    picked[row[0]] = row[1]
+                    if len(picked) == k:
+                        break
+            if len(picked) < k:
+                rows = [row for row in c.execute('SELECT rowid, ' + column + ' FROM ' + table + ';') if not row[0] in picked and (filter == None or filter(row[1]))]
+                for row in random.sample(rows, min(k - len(picked), len(rows))):
+                    picked[row[0]] = row[1]
+        values = list(picked.values())
+        random.shuffle(values)
+
+        return values
+
     def getPeerInfo(self, peer, info):
         '''
-            Get info about a peer from their database entry
-
-            id text             0
-            name text,          1
-            pubkey text,        2
-            adders text,        3
-            forwardKey text,    4
-            dateSeen not null,  5
-            bytesStored int,    6
-            trust int           7
-        '''
-        conn = sqlite3.connect(self.peerDB)
-        c = conn.cursor()
-        command = (peer,)
-        infoNumbers = {'id': 0, 'name': 1, 'pubkey': 2, 'adders': 3, 'forwardKey': 4, 'dateSeen': 5, 'bytesStored': 6, 'trust': 7}
-        info = infoNumbers[info]
-        iterCount = 0
-        retVal = ''
-        for row in c.execute('SELECT * from peers where id=?;', command):
-            for i in row:
-                if iterCount == info:
-                    retVal = i
-                    break
-                else:
-                    iterCount += 1
-        conn.close()
+            Get info about a peer from their database entry (kept in memory, see onionrpeercache)
 
-        return retVal
+            info is a column name: id (also pubkey), name, adders, blockDBHash, forwardKey, dateSeen, bytesStored, trust.
+            Returns '' if the peer is not known
+        '''
+        return self._peerCache.get(peer, info)
 
     def setPeerInfo(self, peer, key, data):
         '''
             Update a peer for a key
         '''
-        conn = sqlite3.connect(self.peerDB)
-        c = conn.cursor()
-        command = (data, peer)
-        # TODO: validate key on whitelist
-        if key not in ('id', 'name', 'pubkey', 'blockDBHash', 'forwardKey', 'dateSeen', 'bytesStored', 'trust'):
+        try:
+            self._peerCache.set(peer, key, data)
+        except ValueError:
             raise Exception("Got invalid database key when setting peer info")
-        c.execute('UPDATE peers SET ' + key + ' = ? WHERE id=?', command)
-        conn.commit()
-        conn.close()
         return
 
+    def incrementPeerInfo(self, peer, key, amount=1):
+        '''
+            Add to a numeric column of a peer (such as bytesStored), atomically. Returns the new value
+        '''
+        try:
+            return self._peerCache.increment(peer, key, amount)
+        except ValueError:
+            raise Exception("Got invalid database key when setting peer info")
+
     def getAddressInfo(self, address, info):
         '''
-            Get info about an address from its database entry
-
-            address text, 0
-            type int, 1
-            knownPeer text, 2
-            speed int, 3
-            success int, 4
-            DBHash text, 5
-            failure int 6
-        '''
-        conn = sqlite3.connect(self.addressDB)
-        c = conn.cursor()
-        command = (address,)
-        infoNumbers = {'address': 0, 'type': 1, 'knownPeer': 2, 'speed': 3, 'success': 4, 'DBHash': 5, 'failure': 6}
-        info = infoNumbers[info]
-        iterCount = 0
-        retVal = ''
-        for row in c.execute('SELECT * from adders where address=?;', command):
-            for i in row:
-                if iterCount == info:
-                    retVal = i
-                    break
-                else:
-                    iterCount += 1
-        conn.close()
-        return retVal
+            Get info about an address from its database entry (kept in memory, see onionrpeercache)
+
+            info is a column name: address, type, knownPeer, speed, success, DBHash, failure, blockCursor.
+            Returns '' if the address is not known
+        '''
+        return self._addressCache.get(address, info)
 
     def setAddressInfo(self, address, key, data):
         '''
             Update an address for a key
         '''
-        conn = sqlite3.connect(self.addressDB)
-        c = conn.cursor()
-        command = (data, address)
-        # TODO: validate key on whitelist
-        if key not in ('address', 'type', 'knownPeer', 'speed', 'success', 'DBHash', 'failure'):
+        try:
+            self._addressCache.set(address, key, data)
+        except ValueError:
             raise Exception("Got invalid database key when setting address info")
-        c.execute('UPDATE adders SET ' + key + ' = ? WHERE address=?', command)
-        conn.commit()
-        conn.close()
         return
 
+    def incrementAddressInfo(self, address, key, amount=1):
+        '''
+            Add to a numeric column of an address (such as success or failure), atomically. Returns the new value
+        '''
+        try:
+            return self._addressCache.increment(address, key, amount)
+        except ValueError:
+            raise Exception("Got invalid database key when setting address info")
+
     def getBlockList(self, unsaved=False):
         '''
             Get list of our blocks
         '''
-        conn = sqlite3.connect(self.blockDB)
-        c = conn.cursor()
         retData = ''
         if unsaved:
-            execute = 'SELECT hash FROM hashes WHERE dataSaved != 1;'
+            # dataSaved is only ever 0 or 1, and = can use the dataSaved index where != cannot
+            execute = 'SELECT hash FROM hashes WHERE dataSaved = 0;'
         else:
             execute = 'SELECT hash FROM hashes;'
-        for row in c.execute(execute):
-            for i in row:
-                retData += i + "\n"
+        with self._db.transaction(self.blockDB) as c:
+            for row in c.execute(execute):
+                for i in row:
+                    retData += i.hex() + "\n"
 
         return retData
 
@@ -474,14 +1513,13 @@ class Core:
         '''
             Returns a list of blocks by the type
         '''
-        conn = sqlite3.connect(self.blockDB)
-        c = conn.cursor()
         retData = ''
         execute = 'SELECT hash FROM hashes WHERE dataType=?;'
         args = (blockType,)
-        for row in c.execute(execute, args):
-            for i in row:
-                retData += i + "\n"
+        with self._db.transaction(self.blockDB) as c:
+            for row in c.execute(execute, args):
+                for i in row:
+                    retData += i.hex() + "\n"
 
         return retData.split('\n')
 
@@ -490,10 +1528,7 @@ class Core:
             Sets the type of block
         '''
 
-        conn = sqlite3.connect(self.blockDB)
-        c = conn.cursor()
-        c.execute("UPDATE hashes SET dataType='" + blockType + "' WHERE hash = '" + hash + "';")
-        conn.commit()
-        conn.close()
+        with self._db.transaction(self.blockDB) as c:
+            c.execute('UPDATE hashes SET dataType=? WHERE hash = ?;', (blockType, self._hashKey(hash)))
 
         return
@@ -59,12 +59,11 @@ class OnionrGUI:
         for i in self.myCore.getBlocksByType('txt'):
             if i.strip() == '' or i in self.listedBlocks:
                 continue
-            blockFile = open('./data/blocks/' + i + '.dat')
-            self.listbox.insert(END, str(blockFile.read().replace('-txt-', '')))
-            blockFile.close()
+            data = self.myCore.getData(i)
+            if data == False:
+                continue
+            self.listbox.insert(END, str(data.replace('-txt-', '')))
             self.listedBlocks.append(i)
             self.listbox.see(END)
-        blocksList = os.listdir('./data/blocks/') # dir is your directory path
-        number_blocks = len(blocksList)
 
         self.root.after(10000, self.update)
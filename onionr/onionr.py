@@ -21,7 +21,7 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 import sys, os, base64, random, getpass, shutil, subprocess, requests, time, platform
-import api, core, gui, config, logger, onionrplugins as plugins
+import api, core, gui, config, logger, onionrarchive, onionrplugins as plugins
 from onionrutils import OnionrUtils
 from netcontroller import NetController
 
@@ -72,6 +72,20 @@ class Onionr:
             self._developmentMode = False
             logger.set_level(logger.LEVEL_INFO)
 
+        # A running daemon locks the data directory when it exits, other commands leave it to the daemon (see start)
+        self._daemonRunning = os.path.exists('.onionr-lock')
+        self._ownsLock = False
+
+        # With storage encryption set up, only the key and the databases need decrypting before anything opens them
+        if os.path.exists(os.path.join('data', onionrarchive.keyFileName)):
+            while True:
+                print('Enter password to unlock storage:')
+                try:
+                    onionrarchive.unlockDataDirectory(getpass.getpass())
+                    break
+                except onionrarchive.ArchiveError as e:
+                    logger.error('Failed to unlock: ' + str(e))
+
         self.onionrCore = core.Core()
         self.onionrUtils = OnionrUtils(self.onionrCore)
 
@@ -93,6 +107,11 @@ class Onionr:
                 os.mkdir('data/')
                 os.mkdir('data/blocks/')
 
+        # storage.encryption is 'archive' (encrypt all of data/ into one file on exit) or 'blocks' (encrypt each block as it is stored)
+        if not self._developmentMode and onionrarchive.getStorageKey() == None and config.get('storage', {}).get('encryption', 'archive') == 'blocks':
+            password = self.onionrUtils.getPassword('Enter password to encrypt storage: ')
+            onionrarchive.setStorageKey(onionrarchive.createKeyFile(os.path.join('data', onionrarchive.keyFileName), password))
+
         if not os.path.exists(self.onionrCore.peerDB):
             self.onionrCore.createPeerDB()
             pass
@@ -146,6 +165,11 @@ class Onionr:
 
             'gui': self.openGUI,
 
+            'migrate-blocks': self.migrateBlocks,
+            'migrateblocks': self.migrateBlocks,
+            'compact-blocks': self.compactBlocks,
+            'compactblocks': self.compactBlocks,
+
             'addpeer': self.addPeer,
             'add-peer': self.addPeer,
             'add-address': self.addAddress,
@@ -168,7 +192,9 @@ class Onionr:
             'add-peer': 'Adds a peer (?)',
             'add-msg': 'Broadcasts a message to the Onionr network',
             'pm': 'Adds a private message to block',
-            'gui': 'Opens a graphical interface for Onionr'
+            'gui': 'Opens a graphical interface for Onionr',
+            'migrate-blocks': 'Moves stored blocks into the sharded directory layout, or into packfiles if storage.backend is pack',
+            'compact-blocks': 'Reclaims space left in packfiles by removed blocks'
         }
 
         command = ''
@@ -179,10 +205,17 @@ class Onionr:
         finally:
             self.execute(command)
 
-        if not self._developmentMode:
-            encryptionPassword = self.onionrUtils.getPassword('Enter password to encrypt directory: ')
-            self.onionrCore.dataDirEncrypt(encryptionPassword)
-            shutil.rmtree('data/')
+        self.onionrCore.close()
+
+        # Leave the data directory to the running daemon if this was another command, it locks it when it exits
+        if self._ownsLock or not self._daemonRunning:
+            if onionrarchive.getStorageKey() != None:
+                # Whenever a key is in use, in development mode too, as it was unlocked with it
+                self.onionrCore.dataDirLock()
+            elif not self._developmentMode:
+                encryptionPassword = self.onionrUtils.getPassword('Enter password to encrypt directory: ')
+                self.onionrCore.dataDirEncrypt(encryptionPassword)
+                shutil.rmtree('data/')
 
         return
 
@@ -277,6 +310,28 @@ class Onionr:
 
         gui.OnionrGUI(self.onionrCore)
 
+    def migrateBlocks(self):
+        '''
+            Moves blocks stored by older versions into the sharded block directory layout, or into packfiles
+        '''
+
+        logger.info('Migrating block storage...')
+        moved = self.onionrCore.migrateBlockStorage()
+        logger.info('Moved ' + str(moved) + ' blocks')
+
+        return
+
+    def compactBlocks(self):
+        '''
+            Rewrites block packfiles which are mostly made of removed blocks
+        '''
+
+        logger.info('Compacting block storage...')
+        reclaimed = self.onionrCore.compactBlockStorage()
+        logger.info('Reclaimed ' + str(reclaimed) + ' bytes')
+
+        return
+
     def listPeers(self):
         '''
             Displays a list of peers (?)
@@ -398,12 +453,15 @@ class Onionr:
         if os.path.exists('.onionr-lock'):
             logger.fatal('Cannot start. Daemon is already running, or it did not exit cleanly.\n(if you are sure that there is not a daemon running, delete .onionr-lock & try again).')
         else:
-            if not self.debug and not self._developmentMode:
+            # With storage encryption, other commands need the lock file to know the daemon will lock the data directory
+            useLockFile = not self.debug and (not self._developmentMode or onionrarchive.getStorageKey() != None)
+            if useLockFile:
                 lockFile = open('.onionr-lock', 'w')
                 lockFile.write('')
                 lockFile.close()
+                self._ownsLock = True
             self.daemon()
-            if not self.debug and not self._developmentMode:
+            if useLockFile:
                 os.remove('.onionr-lock')
 
     def daemon(self):
@@ -421,9 +479,22 @@ class Onionr:
             logger.info('Started Tor .onion service: ' + logger.colors.underline + net.myID)
             logger.info('Our Public key: ' + self.onionrCore._crypto.pubKey)
             time.sleep(1)
-            subprocess.Popen(["./communicator.py", "run", str(net.socksPort)])
+            communicator = subprocess.Popen(["./communicator.py", "run", str(net.socksPort)], stdin=subprocess.PIPE)
+            # Hand the communicator the storage key, rather than having it ask for the password again
+            storageKey = onionrarchive.getStorageKey()
+            communicator.stdin.write((storageKey.hex() if storageKey != None else '').encode() + b'\n')
+            communicator.stdin.close()
             logger.debug('Started communicator')
-        api.API(self.debug)
+        else:
+            communicator = None
+        try:
+            api.API(self.debug)
+        finally:
+            # The communicator has the databases open, so it must be gone before the data directory is locked
+            if communicator != None:
+                self.onionrCore.daemonQueueAdd('shutdown', priority=1)
+                communicator.wait()
+                logger.debug('Communicator exited')
 
         return
 
@@ -435,10 +506,11 @@ class Onionr:
         logger.warn('Killing the running daemon')
         net = NetController(config.get('client')['port'])
         try:
+            # The daemon stops the communicator itself before it exits
             self.onionrUtils.localCommand('shutdown')
         except requests.exceptions.ConnectionError:
-            pass
-        self.onionrCore.daemonQueueAdd('shutdown')
+            # No API to ask, so stop a communicator left running directly, ahead of anything else queued
+            self.onionrCore.daemonQueueAdd('shutdown', priority=1)
         net.killTor()
 
         return
@@ -0,0 +1,355 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file handles encryption of the data directory at rest, as a password encrypted archive or file by file
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import os, io, struct, shutil, tarfile, nacl.secret, nacl.pwhash, nacl.utils, nacl.exceptions
+
+# An archive is a header, then chunks of (4 byte ciphertext length, ciphertext). Each chunk is sealed with XSalsa20-Poly1305
+# under a key derived from the password with Argon2id. A chunk's nonce is the random prefix from the header, the chunk's
+# number and a final flag, so chunks can't be reordered, dropped or cut off without failing authentication.
+# Files encrypted with the storage key instead of a password use the same format, with zero limits and salt.
+magic = b'OnionrDE'
+version = 1
+header = struct.Struct('>8sBQQ16s16s') # magic, version, opslimit, memlimit, salt, nonce prefix
+chunkLength = struct.Struct('>I')
+chunkSize = 1024 * 1024 # plaintext bytes per chunk, memory use does not grow past a few of these
+
+# The storage key file holds a random key, sealed under a key derived from the password. Blocks and databases are
+# encrypted with the random key, so unlocking only derives one key and changing the password would not touch any data.
+keyFileMagic = b'OnionrDK'
+keyFileHeader = struct.Struct('>8sBQQ16s') # magic, version, opslimit, memlimit, salt, followed by the sealed key
+keyFileName = 'storage.key'
+_storageKey = None
+
+class ArchiveError(Exception):
+    pass
+
+def deriveKey(password, salt, opsLimit, memLimit):
+    '''
+        Derive the archive key from a password
+    '''
+    return nacl.pwhash.argon2id.kdf(nacl.secret.SecretBox.KEY_SIZE, password.encode(), salt, opslimit=opsLimit, memlimit=memLimit)
+
+def _nonce(prefix, counter, final):
+    return prefix + counter.to_bytes(7, 'big') + (b'\x01' if final else b'\x00')
+
+def isArchive(path):
+    '''
+        Return whether a file is an archive in this format (rather than one from older versions)
+    '''
+    with open(path, 'rb') as archiveFile:
+        return archiveFile.read(len(magic)) == magic
+
+class EncryptingWriter(io.RawIOBase):
+    '''
+        Write-only file object encrypting everything written to it into an archive file, under a password or a key
+    '''
+    def __init__(self, archiveFile, password=None, opsLimit=nacl.pwhash.argon2id.OPSLIMIT_INTERACTIVE, memLimit=nacl.pwhash.argon2id.MEMLIMIT_INTERACTIVE, key=None):
+        self._file = archiveFile
+        self._prefix = nacl.utils.random(16)
+        if key != None:
+            opsLimit = memLimit = 0
+            salt = bytes(16)
+        else:
+            salt = nacl.utils.random(16)
+            key = deriveKey(password, salt, opsLimit, memLimit)
+        self._box = nacl.secret.SecretBox(key)
+        self._buffer = bytearray()
+        self._counter = 0
+        self._file.write(header.pack(magic, version, opsLimit, memLimit, salt, self._prefix))
+
+        return
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        # Always keep something back, so the last chunk written is the final one
+        while len(self._buffer) > chunkSize:
+            self._seal(bytes(self._buffer[:chunkSize]), False)
+            del self._buffer[:chunkSize]
+
+        return len(data)
+
+    def _seal(self, chunk, final):
+        ciphertext = self._box.encrypt(chunk, _nonce(self._prefix, self._counter, final)).ciphertext
+        self._file.write(chunkLength.pack(len(ciphertext)) + ciphertext)
+        self._counter += 1
+
+        return
+
+    def close(self):
+        '''
+            Write the final chunk, the underlying file is left open
+        '''
+        if not self.closed:
+            self._seal(bytes(self._buffer), True)
+            self._buffer = bytearray()
+        super().close()
+
+        return
+
+class DecryptingReader(io.RawIOBase):
+    '''
+        Read-only file object decrypting an archive file, raises ArchiveError if it does not authenticate
+
+        Closing it closes the archive file.
+    '''
+    def __init__(self, archiveFile, password=None, key=None):
+        self._file = archiveFile
+        fields = self._file.read(header.size)
+        if len(fields) != header.size:
+            raise ArchiveError('not an encrypted archive')
+        fileMagic, fileVersion, opsLimit, memLimit, salt, self._prefix = header.unpack(fields)
+        if fileMagic != magic or fileVersion != version:
+            raise ArchiveError('not an encrypted archive, or from a newer version')
+        if opsLimit == 0:
+            if key == None:
+                raise ArchiveError('encrypted with the storage key, which is not unlocked')
+        elif password == None:
+            raise ArchiveError('encrypted with a password')
+        else:
+            key = deriveKey(password, salt, opsLimit, memLimit)
+        self._box = nacl.secret.SecretBox(key)
+        self._counter = 0
+        self._final = False
+        self._buffer = b''
+        self._offset = 0
+        self._nextLength = self._file.read(chunkLength.size)
+        # Fail on a wrong password straight away, rather than after the caller has started using the data
+        self._readChunk()
+
+        return
+
+    def readable(self):
+        return True
+
+    def _readChunk(self):
+        '''
+            Decrypt the next chunk into the buffer, returns False at the end of the archive
+        '''
+        if self._final:
+            return False
+        if len(self._nextLength) != chunkLength.size:
+            raise ArchiveError('archive is truncated')
+        ciphertext = self._file.read(chunkLength.unpack(self._nextLength)[0])
+        self._nextLength = self._file.read(chunkLength.size)
+        final = len(self._nextLength) == 0
+        try:
+            self._buffer = self._box.decrypt(ciphertext, _nonce(self._prefix, self._counter, final))
+        except nacl.exceptions.CryptoError:
+            raise ArchiveError('wrong password (or corrupted archive)')
+        self._offset = 0
+        self._counter += 1
+        self._final = final
+
+        return True
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            if self._offset >= len(self._buffer) and not self._readChunk():
+                break
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + size)
+            data.append(self._buffer[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+
+        return b''.join(data)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+        return
+
+def encryptDirectory(path, archivePath, password):
+    '''
+        Write a directory to an encrypted archive, streaming so memory use does not depend on its size
+    '''
+    tempPath = archivePath + '.tmp'
+    try:
+        with open(tempPath, 'wb') as archiveFile:
+            writer = EncryptingWriter(archiveFile, password)
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                tar.add(path)
+            writer.close()
+        # Only replace the previous archive once the new one is complete
+        os.replace(tempPath, archivePath)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+    return
+
+def decryptDirectory(archivePath, password, destination='.'):
+    '''
+        Extract an encrypted archive, raises ArchiveError on a wrong password or a damaged archive
+    '''
+    with open(archivePath, 'rb') as archiveFile:
+        reader = DecryptingReader(archiveFile, password)
+        try:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                tar.extractall(destination)
+        except tarfile.TarError as e:
+            raise ArchiveError('corrupted archive: ' + str(e))
+
+    return
+
+def createKeyFile(path, password, opsLimit=nacl.pwhash.argon2id.OPSLIMIT_INTERACTIVE, memLimit=nacl.pwhash.argon2id.MEMLIMIT_INTERACTIVE):
+    '''
+        Create a storage key file with a new random key, returns the key
+    '''
+    key = nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+    salt = nacl.utils.random(16)
+    sealed = nacl.secret.SecretBox(deriveKey(password, salt, opsLimit, memLimit)).encrypt(key)
+    tempPath = path + '.tmp'
+    with open(tempPath, 'wb') as keyFile:
+        keyFile.write(keyFileHeader.pack(keyFileMagic, version, opsLimit, memLimit, salt) + sealed)
+    os.replace(tempPath, path)
+
+    return key
+
+def readKeyFile(path, password):
+    '''
+        Return the key from a storage key file, raises ArchiveError on a wrong password
+    '''
+    with open(path, 'rb') as keyFile:
+        data = keyFile.read()
+    if len(data) <= keyFileHeader.size:
+        raise ArchiveError('not a storage key file')
+    fileMagic, fileVersion, opsLimit, memLimit, salt = keyFileHeader.unpack(data[:keyFileHeader.size])
+    if fileMagic != keyFileMagic or fileVersion != version:
+        raise ArchiveError('not a storage key file, or from a newer version')
+    try:
+        return nacl.secret.SecretBox(deriveKey(password, salt, opsLimit, memLimit)).decrypt(data[keyFileHeader.size:])
+    except nacl.exceptions.CryptoError:
+        raise ArchiveError('wrong password (or corrupted key file)')
+
+def getStorageKey():
+    '''
+        Return the unlocked storage key, or None if storage encryption is not unlocked in this process
+    '''
+    return _storageKey
+
+def setStorageKey(key):
+    '''
+        Set the storage key used to encrypt newly stored blocks and read encrypted ones
+    '''
+    global _storageKey
+    _storageKey = key
+
+    return
+
+def encryptFile(path, encryptedPath, key):
+    '''
+        Encrypt a file with the storage key, replacing encryptedPath once it is complete
+    '''
+    tempPath = encryptedPath + '.tmp'
+    try:
+        with open(path, 'rb') as plainFile, open(tempPath, 'wb') as encryptedFile:
+            writer = EncryptingWriter(encryptedFile, key=key)
+            shutil.copyfileobj(plainFile, writer, chunkSize)
+            writer.close()
+        os.replace(tempPath, encryptedPath)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+    return
+
+def decryptFile(encryptedPath, path, key):
+    '''
+        Decrypt a file encrypted with the storage key, raises ArchiveError if it does not authenticate
+    '''
+    tempPath = path + '.tmp'
+    try:
+        with open(encryptedPath, 'rb') as encryptedFile, open(tempPath, 'wb') as plainFile:
+            shutil.copyfileobj(DecryptingReader(encryptedFile, key=key), plainFile, chunkSize)
+        os.replace(tempPath, path)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+    return
+
+def _lockablePaths(dataDir, encrypted=False):
+    '''
+        Yield the files in the data directory which lockDataDirectory encrypts (or with encrypted, has encrypted)
+
+        That is everything except the configuration (needed before unlocking), the key file, plugins, and
+        block files and packfile segments (which are encrypted one block at a time as they are stored).
+    '''
+    for root, dirs, names in os.walk(dataDir):
+        relative = os.path.relpath(root, dataDir)
+        if relative == '.':
+            dirs[:] = [name for name in dirs if not name in ('blocks', 'plugins')]
+        for name in names:
+            if name.endswith('.tmp') or name.endswith('.enc') != encrypted:
+                continue
+            if relative == '.' and name in ('config.json', keyFileName):
+                continue
+            if relative == 'packs' and not name.startswith('index.db'):
+                continue
+            # Sockets (the communicator's wakeup socket, if it did not exit cleanly) are not data
+            if not os.path.isfile(os.path.join(root, name)):
+                continue
+            yield os.path.join(root, name)
+
+    return
+
+def lockDataDirectory(key, dataDir='data'):
+    '''
+        Encrypt the databases and other small files in the data directory, each to <name>.enc
+    '''
+    for path in list(_lockablePaths(dataDir)):
+        # Files can go away while we work, such as a database's -wal file when its last connection closes
+        try:
+            encryptFile(path, path + '.enc', key)
+        except FileNotFoundError:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Gone, so there is nothing to restore on unlocking
+            os.remove(path + '.enc')
+
+    return
+
+def unlockDataDirectory(password, dataDir='data'):
+    '''
+        Read the storage key with a password and decrypt the files encrypted by lockDataDirectory
+
+        Only the key is derived from the password, blocks stay encrypted and are decrypted as they are read.
+        Returns the key, and makes it the storage key of this process. Raises ArchiveError on a wrong password.
+    '''
+    key = readKeyFile(os.path.join(dataDir, keyFileName), password)
+    for path in list(_lockablePaths(dataDir, True)):
+        decryptFile(path, path[:-len('.enc')], key)
+        os.remove(path)
+    setStorageKey(key)
+
+    return key
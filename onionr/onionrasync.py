@@ -0,0 +1,219 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file handles running requests to many peers at once from the communicator
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import asyncio, functools, time, concurrent.futures, logger
+
+class Cancelled(Exception):
+    '''
+        Raised in a blocking call whose attempt was cancelled, to stop it at the next check
+    '''
+    pass
+
+class Attempt:
+    '''
+        Shared between a coroutine and the blocking call it runs on a pool thread
+
+        The call marks when its peer answered, so the coroutine can tell a slow peer from a slow transfer, and is
+        told through it to stop (asyncio can only stop waiting for a thread, not stop the thread).
+    '''
+    def __init__(self, peer):
+        self.peer = peer
+        self.created = time.monotonic()
+        self.started = None # when the call began on a thread, after waiting for the request limits
+        self.answered = False
+        self.cancelled = False
+
+        return
+
+    def begin(self):
+        '''
+            Mark the call as started
+        '''
+        self.started = time.monotonic()
+
+        return
+
+    def answer(self):
+        '''
+            Mark the peer as having answered, raises Cancelled if the attempt was cancelled
+        '''
+        self.answered = True
+        self.check()
+
+        return
+
+    def check(self):
+        '''
+            Raise Cancelled if the attempt was cancelled
+        '''
+        if self.cancelled:
+            raise Cancelled()
+
+        return
+
+class CancellableStream:
+    '''
+        Wraps a file object, reads from it raise Cancelled once the attempt is cancelled
+    '''
+    def __init__(self, stream, attempt):
+        self._stream = stream
+        self._attempt = attempt
+
+        return
+
+    def read(self, size=-1):
+        self._attempt.check()
+
+        return self._stream.read(size)
+
+class PeerRequestPool:
+    '''
+        Runs blocking peer requests from asyncio, limiting how many are in flight overall and to each peer
+
+        Requests go through requests and PySocks (Tor's SOCKS port), which block, so each one runs on a thread
+        of a pool sized to the overall limit while the event loop waits on many at once. A slow or dead peer
+        then only holds up the requests made to it.
+    '''
+    def __init__(self, maxRequests=16, maxPeerRequests=2):
+        self.maxRequests = max(1, maxRequests)
+        self.maxPeerRequests = max(1, maxPeerRequests)
+        self._loop = None
+        self._executor = None
+        self._requestLimit = None
+        self._peerLimits = {} # peer: semaphore, while it has requests waiting or in flight
+        self._peerUsers = {} # peer: requests waiting or in flight
+
+        return
+
+    def run(self, coroutine):
+        '''
+            Run a coroutine to completion on the pool's event loop, returning its result
+        '''
+        if self._loop == None:
+            self._loop = asyncio.new_event_loop()
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.maxRequests, thread_name_prefix='onionr-peer')
+            self._loop.set_default_executor(self._executor)
+
+        return self._loop.run_until_complete(coroutine)
+
+    async def call(self, peer, function, *args, **kwargs):
+        '''
+            Call a blocking function on a pool thread, once a request to peer is allowed, and return its result
+        '''
+        # Created here, on the running loop, as before Python 3.10 a semaphore is tied to the loop current when it is made
+        if self._requestLimit == None:
+            self._requestLimit = asyncio.Semaphore(self.maxRequests)
+        if peer not in self._peerLimits:
+            self._peerLimits[peer] = asyncio.Semaphore(self.maxPeerRequests)
+            self._peerUsers[peer] = 0
+        peerLimit = self._peerLimits[peer]
+        self._peerUsers[peer] += 1
+        try:
+            async with peerLimit:
+                async with self._requestLimit:
+                    return await self._loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+        finally:
+            self._peerUsers[peer] -= 1
+            if self._peerUsers[peer] == 0:
+                del self._peerUsers[peer]
+                del self._peerLimits[peer]
+
+    async def race(self, peerList, function, hedgeDelay, maxRacing=2):
+        '''
+            Call function(peer, attempt) for peers in turn until one returns a true value, and return that value
+
+            The next peer is called once the previous one failed, or if it has not answered (see Attempt.answer)
+            within hedgeDelay seconds of its call starting, with up to maxRacing calls at a time. Time spent waiting
+            for the request limits does not count, so a busy pool does not make every peer look slow. As soon as
+            one succeeds the others are cancelled. Returns False if every peer failed.
+        '''
+        loop = asyncio.get_event_loop()
+        startWaiter = [None] # future completed when a waiting call starts on a thread
+        def wake():
+            if startWaiter[0] != None and not startWaiter[0].done():
+                startWaiter[0].set_result(None)
+        def begin(peer, attempt):
+            attempt.begin()
+            try:
+                loop.call_soon_threadsafe(wake)
+            except RuntimeError:
+                # The race is over and the loop closed
+                pass
+            return function(peer, attempt)
+
+        peerList = list(peerList)
+        running = {} # task: attempt
+        try:
+            while len(peerList) > 0 or len(running) > 0:
+                nextAt = None # when to call the next peer, if another call may be started
+                waitForStart = False
+                if len(peerList) > 0 and len(running) < maxRacing:
+                    newest = max(running.values(), key=lambda attempt: attempt.created, default=None)
+                    if newest == None:
+                        nextAt = 0
+                    elif newest.started == None:
+                        waitForStart = True
+                    elif not newest.answered:
+                        nextAt = newest.started + hedgeDelay
+                if nextAt != None and nextAt <= time.monotonic():
+                    attempt = Attempt(peerList.pop(0))
+                    running[asyncio.ensure_future(self.call(attempt.peer, begin, attempt.peer, attempt))] = attempt
+                    continue
+                waitingOn = set(running)
+                timeout = None
+                if nextAt != None:
+                    timeout = nextAt - time.monotonic()
+                if waitForStart:
+                    # wake() runs on the loop, so a call starting after this check still completes the future
+                    if newest.started != None:
+                        continue
+                    startWaiter[0] = loop.create_future()
+                    waitingOn.add(startWaiter[0])
+                done = (await asyncio.wait(waitingOn, timeout=timeout, return_when=asyncio.FIRST_COMPLETED))[0]
+                if startWaiter[0] != None:
+                    done.discard(startWaiter[0])
+                    startWaiter[0] = None
+                for task in done:
+                    attempt = running.pop(task)
+                    if task.exception() != None:
+                        logger.warn('Request to ' + attempt.peer + ' failed: ' + str(task.exception()))
+                    elif task.result():
+                        return task.result()
+        finally:
+            # The threads stop at their next check, and their pool slots are freed straight away
+            for task, attempt in running.items():
+                attempt.cancelled = True
+                task.cancel()
+            if len(running) > 0:
+                await asyncio.wait(running)
+
+        return False
+
+    def close(self):
+        '''
+            Wait for requests still running and stop the pool's threads and event loop
+        '''
+        if self._loop != None:
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+            self._loop = None
+            self._executor = None
+            self._requestLimit = None
+
+        return
@@ -0,0 +1,117 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file handles the Bloom filter of known block hashes
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import os, math, struct
+
+class BloomFilter:
+    '''
+        Bloom filter over 32 byte block hash keys
+
+        check() never misses a key which was added, but may claim a key was added when it was not
+        (about falsePositiveRate of the time, until more than capacity keys have been added).
+        Block hashes are already uniformly distributed, so the bit positions are taken straight from the key.
+    '''
+    falsePositiveRate = 0.01
+    # magic, version, hash count, bit count, capacity, keys added, then the user's sequence number and key
+    _header = struct.Struct('>4sBBQQQQ32s')
+    _magic = b'OBLM'
+    _version = 1
+
+    def __init__(self, capacity, hashCount=None, bitCount=None):
+        self.capacity = max(int(capacity), 1)
+        if bitCount == None:
+            bitCount = math.ceil(-self.capacity * math.log(self.falsePositiveRate) / math.log(2) ** 2)
+        if hashCount == None:
+            hashCount = max(1, round(bitCount / self.capacity * math.log(2)))
+        self.bitCount = bitCount
+        self.hashCount = hashCount
+        self.count = 0
+        self.bits = bytearray((bitCount + 7) // 8)
+
+        return
+
+    def _positions(self, key):
+        '''
+            Return the bit positions of a key, by double hashing with two 64 bit halves of it
+        '''
+        first = int.from_bytes(key[0:8], 'big')
+        second = int.from_bytes(key[8:16], 'big') | 1
+
+        return [(first + i * second) % self.bitCount for i in range(self.hashCount)]
+
+    def add(self, key):
+        '''
+            Add a key to the filter
+        '''
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+        return
+
+    def check(self, key):
+        '''
+            Return False if the key was definitely never added, True if it may have been
+        '''
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    def isFull(self):
+        '''
+            Return whether more keys were added than the filter was sized for
+        '''
+        return self.count > self.capacity
+
+    def save(self, path, seq=0, key=bytes(32)):
+        '''
+            Write the filter to a file, along with a sequence number and key describing what it covers
+        '''
+        tempPath = path + '.tmp' + str(os.getpid())
+        with open(tempPath, 'wb') as filterFile:
+            filterFile.write(self._header.pack(self._magic, self._version, self.hashCount, self.bitCount, self.capacity, self.count, seq, key))
+            filterFile.write(self.bits)
+        # Replace the old file in one step, so a crash or another process never sees half a filter
+        os.replace(tempPath, path)
+
+        return
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Read a filter saved by save(), returns (filter, seq, key) or None if the file is missing or invalid
+        '''
+        try:
+            with open(path, 'rb') as filterFile:
+                header = filterFile.read(cls._header.size)
+                bits = filterFile.read()
+        except FileNotFoundError:
+            return None
+        if len(header) != cls._header.size:
+            return None
+        magic, version, hashCount, bitCount, capacity, count, seq, key = cls._header.unpack(header)
+        if magic != cls._magic or version != cls._version or len(bits) != (bitCount + 7) // 8 or hashCount == 0:
+            return None
+        bloomFilter = cls(capacity, hashCount, bitCount)
+        bloomFilter.count = count
+        bloomFilter.bits = bytearray(bits)
+
+        return (bloomFilter, seq, key)
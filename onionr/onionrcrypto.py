@@ -100,9 +100,9 @@ class OnionrCrypto:
         '''Salsa20 encrypt data to peer (with mac)
             this function does not accept a key, it is a wrapper for encryption with a peer
         '''
-        key = self._core.getPeerInfo(4)
+        key = self._core.getPeerInfo(peer, 'forwardKey')
         if type(key) != bytes:
-            key = self._core.getPeerInfo(2)
+            key = self._core.getPeerInfo(peer, 'pubkey')
         encrypted = self.symmetricEncrypt(data, key, encodedKey=True)
         return encrypted
 
@@ -110,9 +110,9 @@ class OnionrCrypto:
         '''Salsa20 decrypt data from peer (with mac)
         this function does not accept a key, it is a wrapper for encryption with a peer
         '''
-        key = self._core.getPeerInfo(4)
+        key = self._core.getPeerInfo(peer, 'forwardKey')
         if type(key) != bytes:
-            key = self._core.getPeerInfo(2)
+            key = self._core.getPeerInfo(peer, 'pubkey')
         decrypted = self.symmetricDecrypt(data, key, encodedKey=True)
         return decrypted
 
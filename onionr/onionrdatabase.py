@@ -0,0 +1,205 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file manages Onionr's sqlite3 database connections
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import sqlite3, threading, contextlib, logger
+
+class DatabaseManager:
+    '''
+        Keeps long-lived sqlite3 connections, one per (thread, database file)
+
+        sqlite3 connections may not be used by two threads at once, so each thread gets its own. The API server
+        handles every request in a new thread, so once a thread has exited its connections go back to a pool for
+        the next thread to take, rather than every request opening (and setting up) new ones.
+    '''
+    # Applied to every new connection. WAL lets the API, communicator and CLI read while another process writes.
+    pragmas = (
+        'PRAGMA journal_mode=WAL;',
+        'PRAGMA synchronous=NORMAL;',
+        'PRAGMA temp_store=MEMORY;',
+        'PRAGMA cache_size=-8000;'
+    )
+    busyTimeout = 30
+    maxIdleConnections = 8 # per database file, connections returned beyond this are closed
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {} # (thread ident, path): (thread, connection)
+        self._idle = {} # path: connections of exited threads, ready to reuse
+
+        return
+
+    def connect(self, path):
+        '''
+            Return this thread's connection to the database at path, opening it if needed
+        '''
+        thread = threading.current_thread()
+        key = (thread.ident, path)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and entry[0] is thread:
+                return entry[1]
+            self._pruneConnections()
+            conn = None
+            if len(self._idle.get(path, [])) > 0:
+                conn = self._idle[path].pop()
+                self._connections[key] = (thread, conn)
+        if conn != None:
+            return conn
+
+        # check_same_thread is off so connections can pass to another thread once theirs has exited, each is still only used by one thread at a time
+        conn = sqlite3.connect(path, timeout=self.busyTimeout, check_same_thread=False)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        with self._lock:
+            self._connections[key] = (thread, conn)
+
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self, path, immediate=False):
+        '''
+            Context manager yielding a cursor for the database at path
+
+            Commits when the block exits normally, rolls back if it raises.
+            immediate takes the write lock up front, for read-modify-write transactions shared between processes.
+        '''
+        conn = self.connect(path)
+        c = conn.cursor()
+        try:
+            if immediate:
+                c.execute('BEGIN IMMEDIATE;')
+            yield c
+        except:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            c.close()
+
+    def migrate(self, path, migrations):
+        '''
+            Bring the database at path up to date with the current schema
+
+            migrations is a list of functions taking a cursor, migrations[n] upgrades the schema from version n
+            to n + 1. The version is kept in sqlite's user_version, and all steps run in one transaction.
+        '''
+        conn = self.connect(path)
+        if self.getVersion(conn) >= len(migrations):
+            return
+        c = conn.cursor()
+        try:
+            # Another process may be migrating at the same time, so take the write lock and check again
+            c.execute('BEGIN IMMEDIATE;')
+            version = self.getVersion(conn)
+            for step in migrations[version:]:
+                logger.info('Upgrading ' + path + ' to schema version ' + str(version + 1) + '...')
+                step(c)
+                version += 1
+            self.setVersion(c, version)
+        except:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            c.close()
+
+        return
+
+    def getVersion(self, conn):
+        '''
+            Return the schema version of a database
+        '''
+        return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+    def setVersion(self, c, version):
+        '''
+            Record the schema version of a database, as part of the cursor's transaction
+        '''
+        c.execute('PRAGMA user_version=' + str(int(version)) + ';')
+
+        return
+
+    def closeDatabase(self, path):
+        '''
+            Close every connection to a database, for example before the file is removed or replaced
+        '''
+        with self._lock:
+            for key in [key for key in self._connections if key[1] == path]:
+                self._closeConnection(key)
+            for conn in self._idle.pop(path, []):
+                self._closeIdle(path, conn)
+
+        return
+
+    def close(self):
+        '''
+            Close all connections, called on shutdown
+        '''
+        with self._lock:
+            for key in list(self._connections):
+                self._closeConnection(key)
+            for path in list(self._idle):
+                for conn in self._idle.pop(path):
+                    self._closeIdle(path, conn)
+
+        return
+
+    def _closeConnection(self, key):
+        '''
+            Close and forget a connection (must hold self._lock)
+        '''
+        thread, conn = self._connections.pop(key)
+        self._closeIdle(key[1], conn)
+
+        return
+
+    def _closeIdle(self, path, conn):
+        '''
+            Close a connection no thread is using
+        '''
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warn('Failed to close database ' + path + ': ' + str(e))
+
+        return
+
+    def _pruneConnections(self):
+        '''
+            Return the connections of threads which have exited to the pool (must hold self._lock)
+        '''
+        for key in [key for key, entry in self._connections.items() if not entry[0].is_alive()]:
+            thread, conn = self._connections.pop(key)
+            idle = self._idle.setdefault(key[1], [])
+            try:
+                # A thread may have exited in the middle of a transaction
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error as e:
+                logger.warn('Failed to reset database connection to ' + key[1] + ': ' + str(e))
+                self._closeIdle(key[1], conn)
+                continue
+            if len(idle) < self.maxIdleConnections:
+                idle.append(conn)
+            else:
+                self._closeIdle(key[1], conn)
+
+        return
@@ -0,0 +1,96 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file handles waking the communicator when commands are queued for it
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import os, time, socket, select
+
+class WakeupChannel:
+    '''
+        A Unix datagram socket one process listens on and others poke, to wake it without polling
+
+        Wakeups carry no data and may be lost (nobody listening, or the socket buffer is full), so they only say
+        "check the queue now". The commands themselves stay in the queue database. Where Unix sockets are not
+        available, wait() just sleeps and notify() does nothing.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._socket = None
+
+        return
+
+    def listen(self):
+        '''
+            Start receiving wakeups, replacing a socket left behind by a process which did not exit cleanly
+        '''
+        if not hasattr(socket, 'AF_UNIX'):
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._socket.setblocking(False)
+
+        return
+
+    def wait(self, timeout):
+        '''
+            Wait up to timeout seconds for a wakeup, returns whether there was one
+        '''
+        timeout = max(timeout, 0)
+        if self._socket == None:
+            time.sleep(timeout)
+            return False
+        readable = select.select([self._socket], [], [], timeout)[0]
+        if not readable:
+            return False
+        # One check of the queue covers every wakeup sent so far
+        try:
+            while True:
+                self._socket.recv(64)
+        except BlockingIOError:
+            pass
+
+        return True
+
+    def notify(self):
+        '''
+            Wake the listening process, if there is one
+        '''
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self.path):
+            return
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+                sender.setblocking(False)
+                sender.sendto(b'\x01', self.path)
+        except OSError:
+            # Not listening any more, or already has wakeups waiting
+            pass
+
+        return
+
+    def close(self):
+        '''
+            Stop receiving wakeups
+        '''
+        if self._socket != None:
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+        return
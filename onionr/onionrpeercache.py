@@ -0,0 +1,234 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file handles the in-memory copy of the peer and address tables
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import os, sqlite3, threading, time, urllib.request
+
+class AddressRecord:
+    '''
+        A row of the adders table, the first slot is the primary key
+    '''
+    __slots__ = ('address', 'type', 'knownPeer', 'speed', 'success', 'DBHash', 'failure', 'blockCursor', 'latency')
+
+class PeerRecord:
+    '''
+        A row of the peers table, the first slot is the primary key
+    '''
+    __slots__ = ('ID', 'name', 'adders', 'blockDBHash', 'forwardKey', 'dateSeen', 'bytesStored', 'trust')
+
+class RecordCache:
+    '''
+        Keeps every row of a table in memory as records, writing changes through to the database
+
+        The table is read once, on first use. Rows another process adds are read when they are first looked up.
+        If any other connection changed the table (sqlite's data_version, checked at most every refreshInterval
+        seconds) each row is read again the next time it is looked up, rather than the whole table at once. Our
+        own writes count as changes too, as they go through other connections, so this keeps them cheap.
+    '''
+    refreshInterval = 1
+
+    def __init__(self, db, path, table, recordClass, aliases={}):
+        self._db = db
+        self.path = path
+        self.table = table
+        self._recordClass = recordClass
+        self._key = recordClass.__slots__[0]
+        # Column names are case insensitive in sqlite, aliases are other names accepted for a column
+        self._columns = {name.lower(): name for name in recordClass.__slots__}
+        for alias, name in aliases.items():
+            self._columns[alias.lower()] = name
+        self._select = 'SELECT ' + ', '.join(recordClass.__slots__) + ' FROM ' + table
+        self._records = None # primary key: record
+        self._fresh = None # keys of the records read since the table last changed, None if they all are
+        self._lock = threading.RLock()
+        self._versionConn = None
+        self._version = None
+        self._checked = 0
+
+        return
+
+    def column(self, name):
+        '''
+            Return the column a name refers to, raises ValueError if there is none
+        '''
+        try:
+            return self._columns[name.lower()]
+        except KeyError:
+            raise ValueError('No ' + name + ' column in ' + self.table)
+
+    def _makeRecord(self, row):
+        record = self._recordClass()
+        for name, value in zip(self._recordClass.__slots__, row):
+            setattr(record, name, value)
+
+        return record
+
+    def _dataVersion(self):
+        '''
+            Return sqlite's data_version from a connection of our own, which changes whenever another connection commits
+        '''
+        if self._versionConn == None:
+            # Read only, so that it never creates the database file
+            uri = 'file:' + urllib.request.pathname2url(self.path) + '?mode=ro'
+            try:
+                self._versionConn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                self._versionConn.execute('PRAGMA data_version;')
+            except sqlite3.OperationalError:
+                # Older sqlite versions cannot open a WAL database read only, the file exists so this will not create it
+                self._versionConn = sqlite3.connect(self.path, check_same_thread=False)
+
+        return self._versionConn.execute('PRAGMA data_version;').fetchone()[0]
+
+    def _refresh(self):
+        if self._records != None and time.monotonic() - self._checked < self.refreshInterval:
+            return
+        self._checked = time.monotonic()
+        if not os.path.exists(self.path):
+            # Not created yet, so there are no rows (and opening it would create an empty file)
+            self._records = {}
+            self._fresh = set()
+            self._version = None
+            # Checked again on every lookup until it is
+            self._checked = 0
+            return
+        version = self._dataVersion()
+        if self._records == None:
+            with self._db.transaction(self.path) as c:
+                self._records = {row[0]: self._makeRecord(row) for row in c.execute(self._select + ';')}
+            self._fresh = None
+        elif version != self._version:
+            self._fresh = set()
+        self._version = version
+
+        return
+
+    def _getRecord(self, key):
+        '''
+            Return the record for a primary key, or None if there is no such row
+        '''
+        self._refresh()
+        if self._version == None:
+            return None
+        if self._fresh == None and key in self._records:
+            return self._records[key]
+        if self._fresh != None and key in self._fresh:
+            return self._records.get(key)
+        with self._db.transaction(self.path) as c:
+            row = c.execute(self._select + ' WHERE ' + self._key + ' = ?;', (key,)).fetchone()
+        self._setRow(key, row)
+
+        return self._records.get(key)
+
+    def _setRow(self, key, row):
+        '''
+            Replace the record for a primary key with a row just read from the database (None if there is no such row)
+        '''
+        if row == None:
+            self._records.pop(key, None)
+        else:
+            self._records[key] = self._makeRecord(row)
+        if self._fresh != None:
+            self._fresh.add(key)
+
+        return
+
+    def get(self, key, name):
+        '''
+            Return one column of a row, or '' if there is no such row
+        '''
+        column = self.column(name)
+        with self._lock:
+            record = self._getRecord(key)
+            if record == None:
+                return ''
+
+            return getattr(record, column)
+
+    def set(self, key, name, value):
+        '''
+            Set one column of a row
+        '''
+        column = self.column(name)
+        with self._lock:
+            with self._db.transaction(self.path) as c:
+                c.execute('UPDATE ' + self.table + ' SET ' + column + ' = ? WHERE ' + self._key + ' = ?;', (value, key))
+            record = self._getRecord(key)
+            if record != None:
+                setattr(record, column, value)
+
+        return
+
+    def increment(self, key, name, amount=1):
+        '''
+            Add to a numeric column of a row in one statement, so concurrent increments are not lost
+
+            Returns the new value, or None if there is no such row
+        '''
+        column = self.column(name)
+        with self._lock:
+            with self._db.transaction(self.path) as c:
+                c.execute('UPDATE ' + self.table + ' SET ' + column + ' = coalesce(' + column + ', 0) + ? WHERE ' + self._key + ' = ?;', (amount, key))
+                row = c.execute('SELECT ' + column + ' FROM ' + self.table + ' WHERE ' + self._key + ' = ?;', (key,)).fetchone()
+            if row == None:
+                return None
+            record = self._getRecord(key)
+            if record != None:
+                setattr(record, column, row[0])
+
+        return row[0]
+
+    def update(self, key, assignments, params=()):
+        '''
+            Run one UPDATE on a row, assignments being the SQL after SET (with params for its placeholders)
+
+            For changes computed from the row's current values, which must not be lost to a concurrent update.
+            Returns the updated record, or None if there is no such row
+        '''
+        with self._lock:
+            with self._db.transaction(self.path) as c:
+                c.execute('UPDATE ' + self.table + ' SET ' + assignments + ' WHERE ' + self._key + ' = ?;', tuple(params) + (key,))
+                row = c.execute(self._select + ' WHERE ' + self._key + ' = ?;', (key,)).fetchone()
+            self._refresh()
+            self._setRow(key, row)
+
+        return self._records.get(key)
+
+    def forget(self, key):
+        '''
+            Drop a row from memory, after deleting it from the database
+        '''
+        with self._lock:
+            if self._records != None:
+                self._records.pop(key, None)
+            if self._fresh != None:
+                self._fresh.discard(key)
+
+        return
+
+    def close(self):
+        '''
+            Close the connection used to check for changes, the table is read again on next use
+        '''
+        with self._lock:
+            if self._versionConn != None:
+                self._versionConn.close()
+                self._versionConn = None
+            self._records = None
+            self._fresh = None
+
+        return
@@ -0,0 +1,676 @@
+'''
+    Onionr - P2P Microblogging Platform & Social network
+
+    This file handles storage of block data on disk
+'''
+'''
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+import os, io, mmap, struct, zlib, lzma, threading, collections, tempfile, logger, onionrarchive
+
+# A stored block is either the raw block, or blockHeader followed by the block in the header's codec.
+# Raw blocks which happen to start with blockMagic are stored with a 'none' header, so they are never misread.
+# With blockEncrypted set in the codec byte, what follows the header is encrypted with the storage key (see onionrarchive).
+blockHeader = struct.Struct('>4sBQ') # magic, codec, block (uncompressed) length
+blockMagic = b'\x89OBZ'
+blockCodecs = {'none': 0, 'zlib': 1, 'lzma': 2}
+blockEncrypted = 0x80
+blockCodecNames = {number: name for name, number in blockCodecs.items()}
+
+def _compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+
+    return lzma.LZMACompressor()
+
+def _decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+
+    return lzma.LZMADecompressor()
+
+def readHeader(data):
+    '''
+        Return the (codec name, block length) from the start of a stored block, or None if it is stored raw
+    '''
+    if len(data) < blockHeader.size or not data.startswith(blockMagic):
+        return None
+    magic, codec, length = blockHeader.unpack(data[:blockHeader.size])
+    if not codec & ~blockEncrypted in blockCodecNames:
+        return None
+
+    return (blockCodecNames[codec & ~blockEncrypted], length)
+
+def isEncrypted(data):
+    '''
+        Return whether a stored block (or the start of one) is encrypted
+    '''
+    return readHeader(data) != None and data[len(blockMagic)] & blockEncrypted != 0
+
+def decodeBlock(data, key=None):
+    '''
+        Return the block from its stored bytes, key is the storage key for encrypted blocks
+    '''
+    header = readHeader(data)
+    if header == None:
+        return data
+    if isEncrypted(data):
+        blockFile, length = openBlock(io.BytesIO(data), len(data), key)
+        with blockFile:
+            return blockFile.read(length)
+    if header[0] == 'none':
+        return data[blockHeader.size:]
+
+    return _decompressor(header[0]).decompress(data[blockHeader.size:])
+
+def openBlock(blockFile, storedLength, key=None):
+    '''
+        Wrap an open stored block (positioned at its start) for reading the block itself
+
+        Returns a tuple of a file object giving the block's bytes and the block's length. Raises
+        onionrarchive.ArchiveError if the block is encrypted and key is missing or wrong.
+    '''
+    start = blockFile.tell()
+    headerData = blockFile.read(blockHeader.size)
+    header = readHeader(headerData)
+    if header == None:
+        blockFile.seek(start)
+        return (blockFile, storedLength)
+    if isEncrypted(headerData):
+        try:
+            blockFile = onionrarchive.DecryptingReader(blockFile, key=key)
+        except onionrarchive.ArchiveError:
+            blockFile.close()
+            raise
+    if header[0] == 'none':
+        return (blockFile, header[1])
+
+    return (DecompressingReader(blockFile, header[0], storedLength - blockHeader.size), header[1])
+
+def isCompressible(data):
+    '''
+        Guess whether a block is worth compressing from a sample of it, already compressed data is not
+    '''
+    return len(data) >= 64 and len(zlib.compress(data, 1)) < len(data) * 0.9
+
+class BlockWriter:
+    '''
+        Writes a block to a (seekable) file in its stored form, compressing it with codec if it looks compressible
+
+        With a storage key, the block is also encrypted.
+    '''
+    sampleSize = 65536 # bytes looked at before choosing whether to compress
+
+    def __init__(self, blockFile, codec='none', key=None):
+        self._file = blockFile
+        self._output = blockFile
+        self._codec = codec
+        self._key = key
+        self._compressor = None
+        self._pending = b''
+        self._started = False
+        self.storedCodec = None # None while undecided, and for blocks stored raw without a header
+        self.length = 0
+
+        return
+
+    def write(self, chunk):
+        '''
+            Write the next part of the block
+        '''
+        self.length += len(chunk)
+        if not self._started:
+            self._pending += chunk
+            if len(self._pending) >= self.sampleSize:
+                self._start()
+            return
+        self._writeData(chunk)
+
+        return
+
+    def _start(self):
+        self._started = True
+        if self._codec != 'none' and isCompressible(self._pending[:self.sampleSize]):
+            self.storedCodec = self._codec
+            self._compressor = _compressor(self._codec)
+        elif self._pending.startswith(blockMagic) or self._key != None:
+            self.storedCodec = 'none'
+        if self.storedCodec != None:
+            # The length is filled in by close()
+            self._file.write(blockHeader.pack(blockMagic, self._codecByte(), 0))
+        if self._key != None:
+            self._output = onionrarchive.EncryptingWriter(self._file, key=self._key)
+        pending = self._pending
+        self._pending = b''
+        self._writeData(pending)
+
+        return
+
+    def _writeData(self, data):
+        if self._compressor != None:
+            data = self._compressor.compress(data)
+        self._output.write(data)
+
+        return
+
+    def _codecByte(self):
+        if self._key != None:
+            return blockCodecs[self.storedCodec] | blockEncrypted
+
+        return blockCodecs[self.storedCodec]
+
+    def close(self):
+        '''
+            Finish the block and close the file
+        '''
+        if not self._started:
+            self._start()
+        if self._compressor != None:
+            self._output.write(self._compressor.flush())
+        if self._output is not self._file:
+            self._output.close()
+        if self.storedCodec != None:
+            self._file.seek(0)
+            self._file.write(blockHeader.pack(blockMagic, self._codecByte(), self.length))
+        self._file.close()
+
+        return
+
+class DecompressingReader(io.RawIOBase):
+    '''
+        Read-only file object decompressing a stored block as it is read
+    '''
+    def __init__(self, blockFile, codec, storedLength):
+        self._file = blockFile
+        self._remaining = storedLength
+        self._decompressor = _decompressor(codec)
+        self._buffer = b''
+
+        return
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            if self._remaining <= 0:
+                break
+            chunk = self._file.read(min(65536, self._remaining))
+            if len(chunk) == 0:
+                break
+            self._remaining -= len(chunk)
+            self._buffer += self._decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+
+        return data
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+        return
+
+def readChunks(blockFile, length, chunkSize=65536):
+    '''
+        Yield up to length bytes from a file in chunks, then close it
+    '''
+    try:
+        while length > 0:
+            chunk = blockFile.read(min(chunkSize, length))
+            if len(chunk) == 0:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        blockFile.close()
+
+    return
+
+class FileBlockStore:
+    '''
+        Stores each block in its own file, fanned out by hash: <location>/ab/cd/abcd....dat
+
+        Blocks written by older versions sit directly in <location>, they are still found until
+        migrate() moves them into the sharded layout.
+    '''
+    def __init__(self, location):
+        self.location = location
+
+        return
+
+    def getPath(self, hash):
+        '''
+            Return where a block is stored in the sharded layout
+        '''
+        return os.path.join(self.location, hash[0:2], hash[2:4], hash + '.dat')
+
+    def getFlatPath(self, hash):
+        '''
+            Return where a block was stored in the old flat layout
+        '''
+        return os.path.join(self.location, hash + '.dat')
+
+    def findPath(self, hash):
+        '''
+            Return the path of a stored block in either layout, or None if it is not stored
+        '''
+        for path in (self.getPath(hash), self.getFlatPath(hash)):
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def exists(self, hash):
+        '''
+            Return whether a block is stored
+        '''
+        return self.findPath(hash) != None
+
+    def read(self, hash):
+        '''
+            Return the bytes of a block, or False if it is not stored
+        '''
+        for path in (self.getPath(hash), self.getFlatPath(hash)):
+            try:
+                with open(path, 'rb') as blockFile:
+                    return blockFile.read()
+            except FileNotFoundError:
+                pass
+
+        return False
+
+    def open(self, hash):
+        '''
+            Open a block for reading, returns a tuple of the file and the block's length, or False if it is not stored
+        '''
+        for path in (self.getPath(hash), self.getFlatPath(hash)):
+            try:
+                blockFile = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            return (blockFile, os.fstat(blockFile.fileno()).st_size)
+
+        return False
+
+    def write(self, hash, data):
+        '''
+            Store the bytes of a block
+        '''
+        tempFile, tempPath = self.createTemp()
+        with tempFile:
+            tempFile.write(data)
+        self.commitTemp(hash, tempPath)
+
+        return
+
+    def createTemp(self):
+        '''
+            Create a temporary file for a block being written, returns the open file and its path
+        '''
+        fd, tempPath = tempfile.mkstemp(prefix='tmp-', suffix='.part', dir=self.location)
+
+        return (os.fdopen(fd, 'wb'), tempPath)
+
+    def commitTemp(self, hash, tempPath):
+        '''
+            Move a finished temporary file into place as a block, readers never see a partly written block
+        '''
+        path = self.getPath(hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tempPath, path)
+
+        return
+
+    def migrate(self):
+        '''
+            Move blocks from the old flat layout into the sharded one, returns the number of blocks moved
+        '''
+        moved = 0
+        for name in os.listdir(self.location):
+            if not name.endswith('.dat') or len(name) != 68:
+                continue
+            hash = name[:-4]
+            path = self.getPath(hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.getFlatPath(hash), path)
+            moved += 1
+            if moved % 10000 == 0:
+                logger.info('Moved ' + str(moved) + ' blocks...')
+
+        return moved
+
+    def listBlocks(self):
+        '''
+            Yield the hash of every stored block, in either layout
+        '''
+        for root, dirs, names in os.walk(self.location):
+            for name in names:
+                if name.endswith('.dat') and len(name) == 68:
+                    yield name[:-4]
+
+        return
+
+    def delete(self, hash):
+        '''
+            Remove a block's file (in either layout), returns the number of bytes freed
+        '''
+        freed = 0
+        for path in (self.getPath(hash), self.getFlatPath(hash)):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+
+        return freed
+
+    def compact(self):
+        '''
+            Nothing to do, deleting a block already frees its file
+        '''
+        return 0
+
+    def close(self):
+        return
+
+class PackBlockStore:
+    '''
+        Appends blocks to large segment files (<location>/segment-00000001.pack, ...), with an sqlite index
+        from hash to (segment, offset, length). Reads go through memory maps of the segments.
+
+        Deleting a block only drops it from the index, compact() rewrites segments which are mostly dead.
+        Appends are serialized between processes by the index database's write lock.
+    '''
+    segmentSize = 256 * 1024 * 1024 # start a new segment once the current one is this large
+    compactRatio = 0.5 # compact segments where at least this fraction of bytes are deleted blocks
+
+    def __init__(self, location, db):
+        self.location = location
+        self.indexDB = os.path.join(location, 'index.db')
+        self._db = db
+        self._maps = {} # segment number: (file, mmap)
+        self._mapLock = threading.Lock()
+
+        if not os.path.exists(location):
+            os.makedirs(location)
+        if not os.path.exists(self.indexDB):
+            with self._db.transaction(self.indexDB) as c:
+                c.execute('CREATE TABLE blocks(hash blob primary key not null, segment int not null, offset int not null, length int not null);')
+                c.execute('CREATE TABLE segments(segment integer primary key, size int not null, deadBytes int not null);')
+
+        return
+
+    def getSegmentPath(self, segment):
+        '''
+            Return the path of a segment file
+        '''
+        return os.path.join(self.location, 'segment-%08d.pack' % (segment,))
+
+    def _locate(self, hash):
+        with self._db.transaction(self.indexDB) as c:
+            return c.execute('SELECT segment, offset, length FROM blocks WHERE hash = ?;', (bytes.fromhex(hash),)).fetchone()
+
+    def exists(self, hash):
+        '''
+            Return whether a block is stored
+        '''
+        return self._locate(hash) != None
+
+    def read(self, hash):
+        '''
+            Return the bytes of a block, or False if it is not stored
+        '''
+        location = self._locate(hash)
+        if location == None:
+            return False
+        segment, offset, length = location
+        if length == 0:
+            return b''
+
+        return bytes(self._map(segment, offset + length)[offset:offset + length])
+
+    def open(self, hash):
+        '''
+            Open a block for reading, returns a tuple of its segment file positioned at the block and the block's length,
+            or False if it is not stored. Read no more than the length from the file.
+        '''
+        # compact() may remove the segment between the index lookup and the open, then the block has moved
+        for attempt in range(2):
+            location = self._locate(hash)
+            if location == None:
+                return False
+            segment, offset, length = location
+            try:
+                blockFile = open(self.getSegmentPath(segment), 'rb')
+            except FileNotFoundError:
+                continue
+            blockFile.seek(offset)
+            return (blockFile, length)
+
+        return False
+
+    def _map(self, segment, minSize):
+        '''
+            Return a memory map of a segment covering at least minSize bytes, remapping it if it has grown
+        '''
+        with self._mapLock:
+            mapped = self._maps.get(segment)
+            if mapped != None and len(mapped[1]) >= minSize:
+                return mapped[1]
+            if mapped != None:
+                mapped[1].close()
+                mapped[0].close()
+            segmentFile = open(self.getSegmentPath(segment), 'rb')
+            segmentMap = mmap.mmap(segmentFile.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = (segmentFile, segmentMap)
+
+            return segmentMap
+
+    def write(self, hash, data):
+        '''
+            Append a block to the current segment
+        '''
+        key = bytes.fromhex(hash)
+        with self._db.transaction(self.indexDB, immediate=True) as c:
+            if c.execute('SELECT COUNT() FROM blocks WHERE hash = ?;', (key,)).fetchone()[0] > 0:
+                return
+            self._append(c, key, (data,))
+
+        return
+
+    def createTemp(self):
+        '''
+            Create a temporary file for a block being written, returns the open file and its path
+        '''
+        fd, tempPath = tempfile.mkstemp(prefix='tmp-', suffix='.part', dir=self.location)
+
+        return (os.fdopen(fd, 'wb'), tempPath)
+
+    def commitTemp(self, hash, tempPath):
+        '''
+            Append a finished temporary file to the current segment as a block, and remove it
+        '''
+        key = bytes.fromhex(hash)
+        try:
+            with self._db.transaction(self.indexDB, immediate=True) as c:
+                if c.execute('SELECT COUNT() FROM blocks WHERE hash = ?;', (key,)).fetchone()[0] == 0:
+                    with open(tempPath, 'rb') as tempFile:
+                        self._append(c, key, iter(lambda: tempFile.read(65536), b''))
+        finally:
+            os.remove(tempPath)
+
+        return
+
+    def _append(self, c, key, chunks):
+        '''
+            Append a block (given as an iterable of bytes) to the current segment and index it,
+            must be inside an immediate index transaction
+        '''
+        row = c.execute('SELECT segment, size FROM segments ORDER BY segment DESC LIMIT 1;').fetchone()
+        if row == None or row[1] >= self.segmentSize:
+            segment = 1 if row == None else row[0] + 1
+            c.execute('INSERT INTO segments (segment, size, deadBytes) VALUES(?, 0, 0);', (segment,))
+            offset = 0
+        else:
+            segment, offset = row
+        with open(self.getSegmentPath(segment), 'ab') as segmentFile:
+            # Anything past the indexed size is left over from a failed append, start over from there
+            segmentFile.truncate(offset)
+            length = 0
+            for chunk in chunks:
+                segmentFile.write(chunk)
+                length += len(chunk)
+            segmentFile.flush()
+            os.fsync(segmentFile.fileno())
+        c.execute('INSERT INTO blocks (hash, segment, offset, length) VALUES(?, ?, ?, ?);', (key, segment, offset, length))
+        c.execute('UPDATE segments SET size = ? WHERE segment = ?;', (offset + length, segment))
+
+        return
+
+    def delete(self, hash):
+        '''
+            Drop a block from the index, returns the number of bytes which compact() can reclaim
+        '''
+        key = bytes.fromhex(hash)
+        with self._db.transaction(self.indexDB, immediate=True) as c:
+            location = c.execute('SELECT segment, length FROM blocks WHERE hash = ?;', (key,)).fetchone()
+            if location == None:
+                return 0
+            c.execute('DELETE FROM blocks WHERE hash = ?;', (key,))
+            c.execute('UPDATE segments SET deadBytes = deadBytes + ? WHERE segment = ?;', (location[1], location[0]))
+
+        return location[1]
+
+    def compact(self):
+        '''
+            Rewrite segments made up mostly of deleted blocks, returns the number of bytes reclaimed
+        '''
+        reclaimed = 0
+        with self._db.transaction(self.indexDB, immediate=True) as c:
+            segments = c.execute('SELECT segment, size, deadBytes FROM segments ORDER BY segment;').fetchall()
+            # The newest segment is still being appended to, so leave it alone
+            for segment, size, deadBytes in segments[:-1]:
+                if size == 0 or deadBytes < size * self.compactRatio:
+                    continue
+                logger.debug('Compacting block segment ' + str(segment) + '...')
+                segmentMap = self._map(segment, size)
+                for key, offset, length in c.execute('SELECT hash, offset, length FROM blocks WHERE segment = ?;', (segment,)).fetchall():
+                    c.execute('DELETE FROM blocks WHERE hash = ?;', (key,))
+                    self._append(c, key, (segmentMap[offset:offset + length],))
+                c.execute('DELETE FROM segments WHERE segment = ?;', (segment,))
+                self._unmap(segment)
+                os.remove(self.getSegmentPath(segment))
+                reclaimed += deadBytes
+
+        return reclaimed
+
+    def _unmap(self, segment):
+        with self._mapLock:
+            mapped = self._maps.pop(segment, None)
+            if mapped != None:
+                mapped[1].close()
+                mapped[0].close()
+
+        return
+
+    def close(self):
+        '''
+            Close all segment memory maps
+        '''
+        for segment in list(self._maps):
+            self._unmap(segment)
+
+        return
+
+class BlockCache:
+    '''
+        Least recently used cache of block contents, bounded by the total size of the blocks in it
+    '''
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = collections.OrderedDict() # hash: bytes, least recently used first
+        self._lock = threading.Lock()
+
+        return
+
+    def get(self, hash):
+        '''
+            Return the cached bytes of a block, or None if it is not cached
+        '''
+        with self._lock:
+            data = self._blocks.get(hash)
+            if data == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._blocks.move_to_end(hash)
+
+        return data
+
+    def put(self, hash, data):
+        '''
+            Cache the bytes of a block, evicting the least recently used blocks to make room
+        '''
+        if len(data) > self.maxBytes:
+            return
+        with self._lock:
+            self._remove(hash)
+            self._blocks[hash] = data
+            self.size += len(data)
+            while self.size > self.maxBytes:
+                self.size -= len(self._blocks.popitem(last=False)[1])
+                self.evictions += 1
+
+        return
+
+    def invalidate(self, hash):
+        '''
+            Drop a block from the cache, for example because it was removed
+        '''
+        with self._lock:
+            self._remove(hash)
+
+        return
+
+    def clear(self):
+        '''
+            Drop every block from the cache
+        '''
+        with self._lock:
+            self._blocks.clear()
+            self.size = 0
+
+        return
+
+    def _remove(self, hash):
+        data = self._blocks.pop(hash, None)
+        if data != None:
+            self.size -= len(data)
+
+        return
+
+    def getStats(self):
+        '''
+            Return a dict of the cache's counters
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'blocks': len(self._blocks), 'bytes': self.size, 'maxBytes': self.maxBytes}
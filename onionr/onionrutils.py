@@ -18,7 +18,7 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 # Misc functions that do not fit in the main api, but are useful
-import getpass, sys, requests, os, socket, hashlib, logger, sqlite3, config
+import getpass, sys, requests, os, socket, hashlib, binascii, logger, sqlite3, config
 import nacl.signing, nacl.encoding
 
 if sys.version_info < (3, 6):
@@ -43,36 +43,45 @@ class OnionrUtils:
     
     def incrementAddressSuccess(self, address):
         '''Increase the recorded sucesses for an address'''
-        increment = self._core.getAddressInfo(address, 'success') + 1
-        self._core.setAddressInfo(address, 'success', increment)
+        self._core.incrementAddressInfo(address, 'success', 1)
         return
         
     def decrementAddressSuccess(self, address):
         '''Decrease the recorded sucesses for an address'''
-        increment = self._core.getAddressInfo(address, 'success') - 1
-        self._core.setAddressInfo(address, 'success', increment)
+        self._core.incrementAddressInfo(address, 'success', -1)
         return
 
     def mergeKeys(self, newKeyList):
-        '''Merge ed25519 key list to our database'''
-        retVal = False
-        if newKeyList != False:
-            for key in newKeyList:
-                if not key in self._core.listPeers(randomOrder=False):
-                    if self._core.addPeer(key):
-                        retVal = True
-        return retVal
+        '''
+            Merge ed25519 key list to our database, in one transaction
+
+            newKeyList may be a list, or a kex response (comma separated). Returns whether any key was new
+        '''
+        return self._core.addPeers(self._parseList(newKeyList)) > 0
 
-    
     def mergeAdders(self, newAdderList):
-        '''Merge peer adders list to our database'''
-        retVal = False
-        if newAdderList != False:
-            for adder in newAdderList:
-                if not adder in self._core.listAdders(randomOrder=False):
-                    if self._core.addAddress(adder):
-                        retVal = True
-        return retVal
+        '''
+            Merge peer adders list to our database, in one transaction
+
+            newAdderList may be a list, or a pex response (comma separated). Returns whether any address was new
+        '''
+        return self._core.addAddresses(self._parseList(newAdderList)) > 0
+
+    def _parseList(self, response):
+        '''
+            Return the entries of a comma separated list from a peer, or of a list, without blanks and duplicates
+        '''
+        if response == False or response == None:
+            return []
+        if type(response) is str:
+            response = response.split(',')
+        entries = []
+        for entry in response:
+            entry = entry.strip()
+            if entry != '' and entry != 'none':
+                entries.append(entry)
+
+        return list(dict.fromkeys(entries))
 
     def localCommand(self, command):
         '''
@@ -137,33 +146,26 @@ class OnionrUtils:
 
     def getBlockDBHash(self):
         '''
-            Return a sha3_256 hash of the blocks DB
+            Return a sha3_256 hash of the blocks DB's contents (see Core.getBlockDigest)
         '''
-        with open(self._core.blockDB, 'rb') as data:
-            data = data.read()
-        hasher = hashlib.sha3_256()
-        hasher.update(data)
-        dataHash = hasher.hexdigest()
-
-        return dataHash
+        return self._core.getBlockDigest()
 
     def hasBlock(self, hash):
         '''
             Check for new block in the list
         '''
-        conn = sqlite3.connect(self._core.blockDB)
-        c = conn.cursor()
         if not self.validateHash(hash):
             raise Exception("Invalid hash")
-        for result in c.execute("SELECT COUNT() FROM hashes where hash='" + hash + "'"):
-            if result[0] >= 1:
-                conn.commit()
-                conn.close()
-                return True
-            else:
-                conn.commit()
-                conn.close()
-                return False
+        key = self._core._hashKey(hash)
+        # Only a possible hit in the block filter needs the database
+        if not self._core._mayHaveBlock(key):
+            return False
+        with self._core._db.transaction(self._core.blockDB) as c:
+            for result in c.execute('SELECT COUNT() FROM hashes where hash=?;', (key,)):
+                if result[0] >= 1:
+                    return True
+                else:
+                    return False
 
     def validateHash(self, data, length=64):
         '''
@@ -188,7 +190,7 @@ class OnionrUtils:
         retVal = False
         try:
             nacl.signing.SigningKey(seed=key, encoder=nacl.encoding.Base32Encoder)
-        except nacl.exceptions.ValueError:
+        except (nacl.exceptions.ValueError, binascii.Error):
             pass
         else:
             retVal = True
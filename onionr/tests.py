@@ -184,6 +184,53 @@ class OnionrTests(unittest.TestCase):
             if myCore.daemonQueue() == False:
                 logger.info('Succesfully added and read command')
 
+    def testQueueWakeup(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running daemon queue wakeup test...')
+
+        import core, onionripc, time
+        myCore = core.Core()
+        listener = onionripc.WakeupChannel(myCore.queueSocket)
+        listener.listen()
+        try:
+            if listener.wait(0):
+                self.assertTrue(False)
+            # Queueing a command wakes the listener straight away, several wakeups are taken at once
+            startTime = time.monotonic()
+            myCore.daemonQueueAdd('testCommand', 'wakeup')
+            myCore.daemonQueueAdd('testCommand', 'wakeup')
+            if not listener.wait(5) or time.monotonic() - startTime > 1 or listener.wait(0):
+                self.assertTrue(False)
+            while myCore.daemonQueue() != False:
+                pass
+        finally:
+            listener.close()
+        # With nobody listening, commands are still queued
+        myCore.daemonQueueAdd('testCommand', 'wakeup')
+        if os.path.exists(myCore.queueSocket) or myCore.daemonQueue()[1] != 'wakeup':
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testQueueBatch(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running daemon queue batch test...')
+
+        import core
+        myCore = core.Core()
+        myCore.clearDaemonQueue()
+        for i in range(5):
+            myCore.daemonQueueAdd('testCommand', str(i))
+        myCore.daemonQueueAdd('shutdown', priority=1)
+
+        # Higher priorities first, then in the order added
+        commands = myCore.daemonQueueBatch(4)
+        if [command[0] for command in commands] != ['shutdown', 'testCommand', 'testCommand', 'testCommand'] or [command[1] for command in commands[1:]] != ['0', '1', '2']:
+            self.assertTrue(False)
+        commands = myCore.daemonQueueBatch(4)
+        if [command[1] for command in commands] != ['3', '4'] or myCore.daemonQueueBatch(4) != [] or myCore.daemonQueue() != False:
+            self.assertTrue(False)
+        self.assertTrue(True)
+
     def testHashValidation(self):
         logger.debug('-'*26 + '\n')
         logger.info('Running hash validation test...')
@@ -195,6 +242,505 @@ class OnionrTests(unittest.TestCase):
         else:
             self.assertTrue(False)
 
+    def testBlockHashStorage(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running binary block hash storage test...')
+
+        import core
+        myCore = core.Core()
+        blockHash = 'f2ca1bb6c7e907d06dafe4687e579fce76b37e4e93b7605022da52e6ccc26fd2'
+        myCore.addToBlockDB(blockHash)
+        stored = myCore._db.connect(myCore.blockDB).execute('SELECT hash FROM hashes WHERE hash=?;', (bytes.fromhex(blockHash),)).fetchone()
+        if stored is None or len(stored[0]) != 32:
+            self.assertTrue(False)
+        if myCore._utils.hasBlock(blockHash.upper()) and blockHash in myCore.getBlockList().split('\n'):
+            self.assertTrue(True)
+        else:
+            self.assertTrue(False)
+
+    def testBlockDigest(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block digest test...')
+
+        import core, gc
+        hashes = ['f2ca1bb6c7e907d06dafe4687e579fce76b37e4e93b7605022da52e6ccc26fd2', '5feceb66ffc86f38d952786c6d696c79c2dbc239dd4e91b46729d73a27fb57e9']
+        # Close connections left open by earlier tests before moving the block database
+        gc.collect()
+        if os.path.exists('data/blocks.db'):
+            os.rename('data/blocks.db', 'data/blocks-backup.db')
+
+        # The digest only depends on the set of hashes, not the insertion order
+        digests = []
+        for order in (hashes, list(reversed(hashes)) + hashes):
+            myCore = core.Core()
+            for i in order:
+                myCore.addToBlockDB(i)
+            digests.append(myCore.getBlockDigest())
+            myCore.close()
+            os.remove('data/blocks.db')
+
+        if os.path.exists('data/blocks-backup.db'):
+            os.rename('data/blocks-backup.db', 'data/blocks.db')
+        if digests[0] == digests[1] and myCore._utils.validateHash(digests[0]):
+            self.assertTrue(True)
+        else:
+            self.assertTrue(False)
+
+    def testBlockTree(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block reconciliation tree test...')
+
+        import core
+        myCore = core.Core()
+        hashes = ['f2ca1bb6c7e907d06dafe4687e579fce76b37e4e93b7605022da52e6ccc26fd2', 'f2cb1bb6c7e907d06dafe4687e579fce76b37e4e93b7605022da52e6ccc26fd2', '5feceb66ffc86f38d952786c6d696c79c2dbc239dd4e91b46729d73a27fb57e9']
+        for i in hashes:
+            myCore.addToBlockDB(i)
+
+        # Nodes above blockTreeDepth come from the buckets table, deeper ones from the hashes, they must agree
+        if sum(count for digest, count in myCore.getBlockTree('')) != len(myCore.getBlockList().strip().split('\n')):
+            self.assertTrue(False)
+        deeper = myCore.getBlockTree('f2c')
+        if sum(count for digest, count in myCore.getBlockTree('f2')) != myCore.getBlockTree('f')[2][1] or deeper[10][1] != 1 or deeper[11][1] != 1:
+            self.assertTrue(False)
+        if sorted(myCore.getBlocksByPrefix('f2c')) != sorted(hashes[:2]):
+            self.assertTrue(False)
+        try:
+            myCore.getBlockTree('0x')
+        except ValueError:
+            self.assertTrue(True)
+        else:
+            self.assertTrue(False)
+
+    def testBlocksSince(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block cursor test...')
+
+        import core
+        myCore = core.Core()
+        hashes, cursor, head = myCore.getBlocksSince(0, 1000000)
+        newHash = '8a5edab282632443219e051e4ade2d1d5bbc671c781051bf1437897cbdfea0f1'
+        myCore.addToBlockDB(newHash)
+        myCore.addToBlockDB(newHash)
+        newHashes, newCursor, newHead = myCore.getBlocksSince(cursor, 1000)
+        if newHashes == [newHash] and newCursor == newHead == head + 1 and myCore.getBlocksSince(newCursor, 1000)[0] == []:
+            self.assertTrue(True)
+        else:
+            self.assertTrue(False)
+
+    def testBlockStorage(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running sharded block storage test...')
+
+        import core
+        myCore = core.Core()
+        dataHash = myCore.setData('-txt-sharded storage test')
+        if not os.path.exists('data/blocks/' + dataHash[0:2] + '/' + dataHash[2:4] + '/' + dataHash + '.dat'):
+            self.assertTrue(False)
+
+        # Blocks in the old flat layout are still found, and moved by the migration
+        os.rename(myCore._storage.getPath(dataHash), 'data/blocks/' + dataHash + '.dat')
+        if myCore.getData(dataHash) != '-txt-sharded storage test' or myCore.getData('../' * 10 + 'etc/passwd') != False:
+            self.assertTrue(False)
+        myCore.migrateBlockStorage()
+        if os.path.exists('data/blocks/' + dataHash + '.dat') or myCore.getData(dataHash) != '-txt-sharded storage test':
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testPackStorage(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running packfile block storage test...')
+
+        import core, config, onionrstorage
+        config.set('storage', {'backend': 'pack'})
+        try:
+            myCore = core.Core()
+        finally:
+            config.set('storage', None)
+        if not isinstance(myCore._storage, onionrstorage.PackBlockStore):
+            self.assertTrue(False)
+        myCore._storage.segmentSize = 64
+
+        # Blocks saved by the file backend are still found, and moved into the packfiles by the migration
+        fileHash = myCore.setData('-txt-pack test old')
+        myCore._storage.delete(fileHash)
+        myCore._fileStorage.write(fileHash, b'-txt-pack test old')
+        if myCore.getData(fileHash) != '-txt-pack test old':
+            self.assertTrue(False)
+        myCore.migrateBlockStorage()
+        if myCore._fileStorage.exists(fileHash) or not myCore._storage.exists(fileHash):
+            self.assertTrue(False)
+
+        hashes = []
+        for i in range(10):
+            hashes.append(myCore.setData('-txt-pack test ' + str(i) + ' ' + 'x' * 20))
+            myCore.addToBlockDB(hashes[-1])
+        segments = os.listdir(myCore.blockPackLocation)
+        for i in range(8):
+            myCore.removeBlock(hashes[i])
+        if myCore.getData(hashes[0]) != False or myCore._utils.hasBlock(hashes[0]):
+            self.assertTrue(False)
+        if myCore.compactBlockStorage() == 0 or len(os.listdir(myCore.blockPackLocation)) >= len(segments):
+            self.assertTrue(False)
+        for i in (8, 9):
+            if myCore.getData(hashes[i]) != '-txt-pack test ' + str(i) + ' ' + 'x' * 20:
+                self.assertTrue(False)
+        if myCore.getData(fileHash) != '-txt-pack test old':
+            self.assertTrue(False)
+        myCore.close()
+        self.assertTrue(True)
+
+    def testBulkBlockInsert(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running bulk block insert test...')
+
+        import core, hashlib, time
+        myCore = core.Core()
+        known = hashlib.sha3_256(b'bulk insert known').hexdigest()
+        myCore.addToBlockDB(known)
+        hashes = [hashlib.sha3_256(b'bulk insert ' + str(i).encode()).hexdigest() for i in range(10000)]
+        head = myCore.getBlocksSince(0, 0)[2]
+        startTime = time.time()
+        added = myCore.addBlocksToDB(hashes + [known, hashes[0].upper(), 'invalid', '0x' + '0' * 62])
+        elapsed = time.time() - startTime
+        logger.debug('Added ' + str(len(added)) + ' hashes in ' + str(elapsed) + ' seconds')
+        if added != hashes or myCore.addBlocksToDB(hashes[:100]) != []:
+            self.assertTrue(False)
+
+        # Sequence numbers follow on, and the digest matches one computed from scratch
+        if myCore.getBlocksSince(head, 20000)[0] != hashes:
+            self.assertTrue(False)
+        with myCore._db.transaction(myCore.blockDB) as c:
+            keys = [row[0] for row in c.execute('SELECT hash FROM hashes;')]
+        if myCore.getBlockDigest() != myCore._digestHash(sum(int.from_bytes(key, 'big') for key in keys), len(keys)):
+            self.assertTrue(False)
+        self.assertTrue(elapsed < 10)
+
+    def testBlockCache(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block cache test...')
+
+        import core, onionrstorage
+        cache = onionrstorage.BlockCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        cache.put('c', b'1234')
+        cache.put('d', b'12345678901')
+        if cache.get('b') != None or cache.get('a') != b'1234' or cache.get('d') != None or cache.size != 8:
+            self.assertTrue(False)
+        if cache.getStats()['evictions'] != 1 or cache.hits != 2 or cache.misses != 2:
+            self.assertTrue(False)
+
+        # Blocks removed by another process are dropped on the next refresh
+        myCore = core.Core()
+        otherCore = core.Core()
+        myCore.enableBlockCache(1024)
+        myCore.blockFilterRefresh = 0
+        dataHash = myCore.setData('-txt-block cache test')
+        myCore.addToBlockDB(dataHash)
+        if myCore.getData(dataHash) != '-txt-block cache test' or myCore.getData(dataHash) != '-txt-block cache test' or myCore._blockCache.hits != 1:
+            self.assertTrue(False)
+        otherCore.removeBlock(dataHash)
+        if myCore.getData(dataHash) != False:
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testBlockStreaming(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block streaming test...')
+
+        import core, config, onionrstorage, api, flask
+        myCore = core.Core()
+        config.set('storage', {'backend': 'pack'})
+        try:
+            packCore = core.Core()
+        finally:
+            config.set('storage', None)
+        app = flask.Flask(__name__)
+        for testCore in (myCore, packCore):
+            hashes = [testCore.setData('-txt-streaming test ' + str(i) + ' ' + 'y' * 100000) for i in range(3)]
+            opened = testCore.openData(hashes[1])
+            if opened == False or opened[1] != len('-txt-streaming test 1 ' + 'y' * 100000):
+                self.assertTrue(False)
+            with app.test_request_context('/public/'):
+                resp = api.API.blockResponse(None, *opened)
+                body = b''.join(resp.response)
+            if body.decode() != '-txt-streaming test 1 ' + 'y' * 100000 or resp.headers['Content-Length'] != str(opened[1]):
+                self.assertTrue(False)
+            if testCore.openData('0' * 64) != False:
+                self.assertTrue(False)
+
+        # Small blocks come from the block cache when it is on
+        myCore.enableBlockCache(1024 * 1024)
+        dataHash = myCore.setData('-txt-streaming test small')
+        myCore.openData(dataHash)[0].close()
+        if myCore.openData(dataHash)[0].read() != b'-txt-streaming test small' or myCore._blockCache.hits != 1:
+            self.assertTrue(False)
+        packCore.close()
+        self.assertTrue(True)
+
+    def testBinaryBlockStorage(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running binary block storage test...')
+
+        import core, config, io, hashlib
+        myCore = core.Core()
+        config.set('storage', {'backend': 'pack'})
+        try:
+            packCore = core.Core()
+        finally:
+            config.set('storage', None)
+        data = b'-bin-' + bytes(range(256)) * 1000
+        for testCore, location in ((myCore, myCore.blockDataLocation), (packCore, packCore.blockPackLocation)):
+            dataHash = testCore.setData(data)
+            if dataHash != hashlib.sha3_256(data).hexdigest() or testCore.getDataBytes(dataHash) != data:
+                self.assertTrue(False)
+
+            # Streamed blocks are only kept if they match the expected hash and size limit
+            other = b'-bin-stream ' + location.encode() + data
+            otherHash = hashlib.sha3_256(other).hexdigest()
+            if testCore.setDataStream(io.BytesIO(other), expectedHash='0' * 64) != False or testCore.getDataBytes(otherHash) != False:
+                self.assertTrue(False)
+            if testCore.setDataStream(io.BytesIO(other), maxSize=len(other) - 1) != False:
+                self.assertTrue(False)
+            if testCore.setDataStream(io.BytesIO(other), expectedHash=otherHash.upper(), maxSize=len(other)) != otherHash or testCore.getDataBytes(otherHash) != other:
+                self.assertTrue(False)
+            if [name for name in os.listdir(location) if name.endswith('.part')] != []:
+                self.assertTrue(False)
+        packCore.close()
+        self.assertTrue(True)
+
+    def testBlockCompression(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block compression test...')
+
+        import core, config, onionrstorage, api, flask, hashlib, zlib
+        text = ('-txt-compression test ' + 'lorem ipsum dolor sit amet ' * 10000).encode()
+        binary = b'-bin-' + os.urandom(100000)
+        magic = onionrstorage.blockMagic + b' raw block which looks like a header'
+        for codec in ('zlib', 'lzma'):
+            config.set('storage', {'compression': codec})
+            try:
+                myCore = core.Core()
+            finally:
+                config.set('storage', None)
+            for data in (text + codec.encode(), binary, magic):
+                dataHash = myCore.setData(data)
+                if dataHash != hashlib.sha3_256(data).hexdigest() or myCore.getDataBytes(dataHash) != data:
+                    self.assertTrue(False)
+                blockFile, length = myCore.openData(dataHash)
+                with blockFile:
+                    if length != len(data) or b''.join(onionrstorage.readChunks(blockFile, length, 1000)) != data:
+                        self.assertTrue(False)
+            stored = myCore._storage.read(hashlib.sha3_256(text + codec.encode()).hexdigest())
+            if len(stored) > len(text) / 10 or onionrstorage.readHeader(stored) != (codec, len(text) + len(codec)):
+                self.assertTrue(False)
+            # Incompressible blocks are stored as they are
+            if myCore._storage.read(hashlib.sha3_256(binary).hexdigest()) != binary:
+                self.assertTrue(False)
+
+        # zlib blocks can be sent compressed as they are stored, as deflate
+        dataHash = hashlib.sha3_256(text + b'zlib').hexdigest()
+        opened = myCore.openCompressedData(dataHash, 'zlib')
+        if opened == False or myCore.openCompressedData(hashlib.sha3_256(binary).hexdigest(), 'zlib') != False:
+            self.assertTrue(False)
+        with flask.Flask(__name__).test_request_context('/public/'):
+            body = b''.join(api.API.blockResponse(None, *opened).response)
+        if zlib.decompress(body) != text + b'zlib':
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testBlockRetention(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block retention test...')
+
+        import core, hashlib
+        myCore = core.Core()
+        myCore.quotaLowWatermark = 1
+        hashes = []
+        for i in range(10):
+            data = '-txt-retention test ' + str(i) + ' ' + os.urandom(500).hex()
+            if i == 0:
+                hashes.append(myCore.setData(data))
+                myCore.addToBlockDB(hashes[-1], selfInsert=True)
+            else:
+                hashes.append(hashlib.sha3_256(data.encode()).hexdigest())
+                myCore.addToBlockDB(hashes[-1])
+                myCore.setData(data)
+        # The oldest reads go first, except for our own block
+        if myCore.enforceBlockQuota(2 ** 62) != (0, 0):
+            self.assertTrue(False)
+        with myCore._db.transaction(myCore.blockDB) as c:
+            for i in range(10):
+                c.execute('UPDATE hashes SET lastAccessed = ? WHERE hash = ?;', (i, myCore._hashKey(hashes[i])))
+            c.execute('UPDATE hashes SET lastAccessed = 1000 WHERE hash NOT IN (' + ','.join('?' * 10) + ');', [myCore._hashKey(i) for i in hashes])
+            total = c.execute('SELECT sum(dataSize) FROM hashes WHERE dataSaved = 1;').fetchone()[0]
+        myCore.getData(hashes[1])
+        myCore.flushBlockAccesses()
+        evicted, reclaimed = myCore.enforceBlockQuota(total - 1500)
+        if evicted != 2 or reclaimed < 1500:
+            self.assertTrue(False)
+        for i in range(10):
+            if myCore._utils.hasBlock(hashes[i]) != (not i in (2, 3)) or (myCore.getData(hashes[i]) == False) != (i in (2, 3)):
+                self.assertTrue(False)
+
+        # Evicted blocks are not added back when peers advertise them
+        if myCore.addBlocksToDB(hashes) != [] or myCore.enforceBlockQuota(total) != (0, 0):
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testDataDirArchive(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running data dir archive test...')
+
+        import onionrarchive, tempfile, shutil
+        workDir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(workDir, 'source')
+            os.makedirs(os.path.join(source, 'blocks'))
+            files = {'small.txt': b'hello', os.path.join('blocks', 'large.dat'): os.urandom(onionrarchive.chunkSize * 2 + 1000)}
+            for name, data in files.items():
+                with open(os.path.join(source, name), 'wb') as dataFile:
+                    dataFile.write(data)
+            archive = os.path.join(workDir, 'archive.dat')
+            onionrarchive.encryptDirectory(source, archive, 'password')
+            if not onionrarchive.isArchive(archive) or os.path.exists(archive + '.tmp'):
+                self.assertTrue(False)
+            onionrarchive.decryptDirectory(archive, 'password', os.path.join(workDir, 'out'))
+            for name, data in files.items():
+                with open(os.path.join(workDir, 'out', source.lstrip('/'), name), 'rb') as dataFile:
+                    if dataFile.read() != data:
+                        self.assertTrue(False)
+
+            # Wrong passwords, and archives which were cut short, are refused
+            try:
+                onionrarchive.decryptDirectory(archive, 'wrong', os.path.join(workDir, 'wrong'))
+                self.assertTrue(False)
+            except onionrarchive.ArchiveError:
+                pass
+            if os.path.exists(os.path.join(workDir, 'wrong')):
+                self.assertTrue(False)
+            with open(archive, 'rb') as archiveFile:
+                data = archiveFile.read()
+            with open(archive, 'wb') as archiveFile:
+                archiveFile.write(data[:onionrarchive.header.size + onionrarchive.chunkLength.size + onionrarchive.chunkSize + 16])
+            try:
+                onionrarchive.decryptDirectory(archive, 'password', os.path.join(workDir, 'cut'))
+                self.assertTrue(False)
+            except onionrarchive.ArchiveError:
+                pass
+        finally:
+            shutil.rmtree(workDir)
+        self.assertTrue(True)
+
+    def testStorageEncryption(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running storage encryption test...')
+
+        import core, onionrarchive, onionrstorage, tempfile, shutil, hashlib
+        workDir = tempfile.mkdtemp()
+        try:
+            keyPath = os.path.join(workDir, onionrarchive.keyFileName)
+            key = onionrarchive.createKeyFile(keyPath, 'password')
+            if onionrarchive.readKeyFile(keyPath, 'password') != key:
+                self.assertTrue(False)
+            try:
+                onionrarchive.readKeyFile(keyPath, 'wrong')
+                self.assertTrue(False)
+            except onionrarchive.ArchiveError:
+                pass
+
+            # Databases and keys are locked file by file, blocks and the configuration are left alone
+            for name in ('blocks.db', 'config.json', os.path.join('hs', 'private_key'), os.path.join('blocks', 'ab.dat')):
+                os.makedirs(os.path.dirname(os.path.join(workDir, name)), exist_ok=True)
+                with open(os.path.join(workDir, name), 'wb') as dataFile:
+                    dataFile.write(b'plain ' + name.encode())
+            onionrarchive.lockDataDirectory(key, workDir)
+            for name, locked in (('blocks.db', True), ('config.json', False), (os.path.join('hs', 'private_key'), True), (os.path.join('blocks', 'ab.dat'), False)):
+                if os.path.exists(os.path.join(workDir, name + '.enc')) != locked or os.path.exists(os.path.join(workDir, name)) == locked:
+                    self.assertTrue(False)
+            onionrarchive.unlockDataDirectory('password', workDir)
+            with open(os.path.join(workDir, 'hs', 'private_key'), 'rb') as dataFile:
+                if dataFile.read() != b'plain ' + os.path.join('hs', 'private_key').encode() or onionrarchive.getStorageKey() != key:
+                    self.assertTrue(False)
+
+            # A file removed by another process while locking (a database's -wal file, say) is skipped
+            with open(os.path.join(workDir, 'blocks.db-wal'), 'wb') as dataFile:
+                dataFile.write(b'wal')
+            encryptFile = onionrarchive.encryptFile
+            def removeFirst(path, encryptedPath, key):
+                if path.endswith('-wal'):
+                    os.remove(path)
+                return encryptFile(path, encryptedPath, key)
+            onionrarchive.encryptFile = removeFirst
+            try:
+                onionrarchive.lockDataDirectory(key, workDir)
+            finally:
+                onionrarchive.encryptFile = encryptFile
+            if os.path.exists(os.path.join(workDir, 'blocks.db-wal.enc')) or not os.path.exists(os.path.join(workDir, 'blocks.db.enc')):
+                self.assertTrue(False)
+            onionrarchive.unlockDataDirectory('password', workDir)
+
+            # Blocks stored while unlocked are encrypted (and compressed first if that helps), and read back
+            myCore = core.Core()
+            myCore.blockCompression = 'zlib'
+            text = b'storage encryption test ' * 1000
+            binary = os.urandom(100000)
+            for data in (text, binary):
+                blockHash = myCore.setData(data)
+                stored = myCore._storage.read(blockHash)
+                if not onionrstorage.isEncrypted(stored) or text[:64] in stored or myCore.getDataBytes(blockHash) != data:
+                    self.assertTrue(False)
+                blockFile, length = myCore.openData(blockHash)
+                with blockFile:
+                    if length != len(data) or blockFile.read(length) != data:
+                        self.assertTrue(False)
+                if myCore.openCompressedData(blockHash, 'zlib') != False:
+                    self.assertTrue(False)
+
+            # Without the key they can't be read
+            onionrarchive.setStorageKey(None)
+            if myCore.getDataBytes(blockHash) != False or myCore.openData(blockHash) != False:
+                self.assertTrue(False)
+            myCore.close()
+        finally:
+            onionrarchive.setStorageKey(None)
+            shutil.rmtree(workDir)
+        self.assertTrue(True)
+
+    def testBlockFilter(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block filter test...')
+
+        import core, hashlib
+        myCore = core.Core()
+        blockHash = hashlib.sha3_256(b'block filter test').hexdigest()
+        myCore.addToBlockDB(blockHash)
+        if not myCore._utils.hasBlock(blockHash) or myCore._utils.hasBlock('0' * 64):
+            self.assertTrue(False)
+
+        # A saved filter is loaded and caught up with blocks added since, a filter for another database is rebuilt
+        myCore.saveBlockFilter()
+        otherHash = hashlib.sha3_256(b'block filter test 2').hexdigest()
+        myCore.addToBlockDB(otherHash)
+        otherCore = core.Core()
+        if not otherCore._blockFilter.check(otherCore._hashKey(otherHash)) or otherCore.getBlocksSince(0, 0)[2] != otherCore._blockFilterSeq:
+            self.assertTrue(False)
+        with open(myCore.blockFilterFile, 'r+b') as filterFile:
+            filterFile.seek(-len(myCore._blockFilter.bits) - 32, 2)
+            filterFile.write(bytes(32))
+        otherCore = core.Core()
+        if not otherCore._blockFilter.check(otherCore._hashKey(blockHash)):
+            self.assertTrue(False)
+
+        # Blocks added by another process are found after the next refresh
+        thirdHash = hashlib.sha3_256(b'block filter test 3').hexdigest()
+        otherCore.addToBlockDB(thirdHash)
+        myCore.blockFilterRefresh = 0
+        if not myCore._utils.hasBlock(thirdHash):
+            self.assertTrue(False)
+        self.assertTrue(True)
+
     def testAddAdder(self):
         logger.debug('-'*26 + '\n')
         logger.info('Running address add+remove test')
@@ -211,4 +757,507 @@ class OnionrTests(unittest.TestCase):
         else:
             self.assertTrue(False)
 
+    def testMergeAdders(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running address and key merge test')
+
+        import core, onionrutils, base64
+        myCore = core.Core()
+        utils = onionrutils.OnionrUtils(myCore)
+        if not os.path.exists('data/address.db'):
+            myCore.createAddressDB()
+        if not os.path.exists('data/peers.db'):
+            myCore.createPeerDB()
+        addresses = ['a' * 16 + '.onion', 'b' * 16 + '.onion', 'c' * 16 + '.onion']
+        for address in addresses:
+            myCore.removeAddress(address)
+
+        # A pex response is parsed once, invalid and repeated entries are skipped
+        if not utils.mergeAdders(','.join(addresses + ['invalid', addresses[0], ''])) or utils.mergeAdders(addresses[1:]):
+            self.assertTrue(False)
+        known = myCore.listAdders(randomOrder=False)
+        if not all(address in known for address in addresses) or 'invalid' in known or utils.mergeAdders('none') or utils.mergeAdders(False):
+            self.assertTrue(False)
+        for address in addresses:
+            myCore.removeAddress(address)
+
+        keys = [base64.b32encode(os.urandom(32)).decode() for i in range(3)]
+        if not utils.mergeKeys(','.join(keys + ['invalid'])) or utils.mergeKeys(keys) or myCore.addPeers(keys + ['invalid']) != 0:
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testPeerSampling(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running peer sampling test')
+
+        import core, base64
+        myCore = core.Core()
+        if not os.path.exists('data/address.db'):
+            myCore.createAddressDB()
+        addresses = [base64.b32encode(os.urandom(10)).decode().lower() + '.onion' for i in range(200)]
+        myCore.addAddresses(addresses)
+        known = set(myCore.listAdders(randomOrder=False))
+
+        # Samples are distinct known addresses, a filter is applied, asking for more than there are gives them all
+        sample = myCore.sampleAdders(10)
+        if len(sample) != 10 or len(set(sample)) != 10 or not set(sample) <= known:
+            self.assertTrue(False)
+        sample = myCore.sampleAdders(10, lambda address: address in addresses[:5])
+        if sorted(sample) != sorted(addresses[:5]):
+            self.assertTrue(False)
+        if sorted(myCore.sampleAdders(len(known) + 10)) != sorted(known) or myCore.sampleAdders(0) != []:
+            self.assertTrue(False)
+        for address in addresses:
+            myCore.removeAddress(address)
+
+        if not os.path.exists('data/peers.db'):
+            myCore.createPeerDB()
+        keys = [base64.b32encode(os.urandom(32)).decode() for i in range(3)]
+        myCore.addPeers(keys)
+        if not set(keys) <= set(myCore.samplePeers(1000)) or not set(keys) <= set(myCore.listPeers()):
+            self.assertTrue(False)
+        self.assertTrue(True)
+
+    def testAddressCache(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running peer and address cache test')
+
+        import core, onionrutils
+        myCore = core.Core()
+        otherCore = core.Core()
+        utils = onionrutils.OnionrUtils(myCore)
+        if not os.path.exists('data/address.db'):
+            myCore.createAddressDB()
+        address = 'cachetestaddress.onion'
+        otherAddress = 'cachetestaddres2.onion'
+        myCore.addAddresses([address, otherAddress])
+
+        # Columns are read by name, writes go through to the database
+        myCore.setAddressInfo(address, 'DBHash', 'abc')
+        myCore.setAddressInfo(address, 'success', 5)
+        utils.incrementAddressSuccess(address)
+        utils.incrementAddressSuccess(address)
+        utils.decrementAddressSuccess(address)
+        if myCore.getAddressInfo(address, 'DBHash') != 'abc' or myCore.getAddressInfo(address, 'success') != 6 or myCore.getAddressInfo(address, 'speed') != None:
+            self.assertTrue(False)
+        if otherCore.getAddressInfo(address, 'success') != 6 or myCore.incrementAddressInfo(address, 'failure') != 1:
+            self.assertTrue(False)
+        if myCore.getAddressInfo('unknownaddress1.onion', 'success') != '' or myCore.incrementAddressInfo('unknownaddress1.onion', 'failure') != None:
+            self.assertTrue(False)
+        try:
+            myCore.setAddressInfo(address, 'nonexistent', 1)
+            self.assertTrue(False)
+        except Exception as e:
+            if not 'invalid database key' in str(e):
+                self.assertTrue(False)
+
+        # Changes made by another connection are picked up once the refresh interval has passed
+        otherCore._addressCache.refreshInterval = 0
+        myCore.setAddressInfo(address, 'DBHash', 'def')
+        if otherCore.getAddressInfo(address, 'DBHash') != 'def':
+            self.assertTrue(False)
+        # After a change only the rows looked up are read again, not the whole table
+        reads = []
+        makeRecord = otherCore._addressCache._makeRecord
+        otherCore._addressCache._makeRecord = lambda row: reads.append(row[0]) or makeRecord(row)
+        otherCore.setAddressInfo(address, 'speed', 10)
+        myCore.setAddressInfo(address, 'DBHash', 'ghi')
+        if otherCore.getAddressInfo(address, 'speed') != 10 or otherCore.getAddressInfo(address, 'DBHash') != 'ghi' or set(reads) != {address}:
+            self.assertTrue(False)
+        myCore.removeAddress(address)
+        myCore.removeAddress(otherAddress)
+        if myCore.getAddressInfo(address, 'DBHash') != '':
+            self.assertTrue(False)
+
+        if not os.path.exists('data/peers.db'):
+            myCore.createPeerDB()
+        peer = '6M5MXL237OK57ITHVYN5WGHANPGOMKS5C3PJLHBBNKFFJQOIDOJA===='
+        myCore.addPeer(peer)
+        myCore.setPeerInfo(peer, 'trust', 2)
+        if myCore.getPeerInfo(peer, 'pubkey') != peer or myCore.getPeerInfo(peer, 'id') != peer or myCore.getPeerInfo(peer, 'trust') != 2:
+            self.assertTrue(False)
+
+        # Looking up rows of a database which does not exist yet does not create it
+        import onionrpeercache, sqlite3
+        missingDB = 'data/cache-missing.db'
+        if os.path.exists(missingDB):
+            os.remove(missingDB)
+        cache = onionrpeercache.RecordCache(myCore._db, missingDB, 'adders', onionrpeercache.AddressRecord)
+        if cache.get(address, 'success') != '' or os.path.exists(missingDB):
+            self.assertTrue(False)
+        conn = sqlite3.connect(missingDB)
+        conn.execute('CREATE TABLE adders(address text primary key, type int, knownPeer text, speed int, success int, DBHash text, failure int, blockCursor int, latency real);')
+        conn.execute('INSERT INTO adders (address, success) VALUES(?, ?);', (address, 3))
+        conn.commit()
+        conn.close()
+        if cache.get(address, 'success') != 3:
+            self.assertTrue(False)
+        cache.close()
+        myCore._db.closeDatabase(missingDB)
+        os.remove(missingDB)
+        myCore.close()
+        otherCore.close()
+        self.assertTrue(True)
+
+    def testPeerScoring(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running peer scoring test')
+
+        import core
+        myCore = core.Core()
+        if not os.path.exists('data/address.db'):
+            myCore.createAddressDB()
+        fast, slow, failing, unknown = 'fastpeeraaaaaaaa.onion', 'slowpeeraaaaaaaa.onion', 'failpeeraaaaaaaa.onion', 'newpeeraaaaaaaaa.onion'
+        peers = [fast, slow, failing, unknown]
+        myCore.addAddresses(peers)
+        for i in range(10):
+            myCore.recordPeerRequest(fast, True, 1)
+            myCore.recordPeerRequest(slow, True, 20)
+            myCore.recordPeerRequest(failing, False, 30)
+        myCore.recordPeerSpeed(fast, 100000, 2)
+
+        # Outcomes are decayed counts, latency and speed moving averages
+        success = myCore.getAddressInfo(fast, 'success')
+        if abs(success - sum(0.95 ** i for i in range(10))) > 0.001 or myCore.getAddressInfo(fast, 'failure') != 0:
+            self.assertTrue(False)
+        if myCore.getAddressInfo(slow, 'latency') != 20 or myCore.getAddressInfo(fast, 'speed') != 50000 or myCore.getAddressInfo(failing, 'latency') != None:
+            self.assertTrue(False)
+        if not myCore.peerScore(fast) > myCore.peerScore(unknown) > myCore.peerScore(slow) > myCore.peerScore(failing):
+            self.assertTrue(False)
+        if myCore.peerLatencyPercentile(0) > 1 or myCore.peerLatencyPercentile(1) < 20:
+            self.assertTrue(False)
+
+        # Better peers are picked more often, but every peer is still picked now and then
+        picked = {peer: 0 for peer in peers}
+        inPeers = lambda address: address in peers
+        for i in range(1000):
+            for peer in myCore.choosePeers(1, inPeers):
+                picked[peer] += 1
+        if not picked[fast] > picked[unknown] > picked[failing] or min(picked.values()) == 0:
+            self.assertTrue(False)
+        if sorted(myCore.choosePeers(10, inPeers)) != sorted(peers):
+            self.assertTrue(False)
+
+        # Among many addresses without a history the best are still found, rather than only within a random sample
+        import base64
+        crowd = [base64.b32encode(b'\xff\xff\xff' + i.to_bytes(7, 'big')).decode().lower() + '.onion' for i in range(2000)]
+        myCore.addAddresses(crowd)
+        try:
+            if myCore.bestAdders(1) != [fast]:
+                self.assertTrue(False)
+            picked = {fast: 0, failing: 0}
+            for i in range(200):
+                for peer in myCore.choosePeers(3):
+                    if peer in picked:
+                        picked[peer] += 1
+            if picked[fast] < 100 or picked[failing] > 10:
+                self.assertTrue(False)
+        finally:
+            with myCore._db.transaction(myCore.addressDB) as c:
+                c.executemany('DELETE FROM adders WHERE address = ?;', [(address,) for address in crowd])
+            for address in crowd:
+                myCore._addressCache.forget(address)
+        for peer in peers:
+            myCore.removeAddress(peer)
+        self.assertTrue(True)
+
+    def testPeerRequestPool(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running peer request pool test...')
+
+        import onionrasync, asyncio, threading, time
+        pool = onionrasync.PeerRequestPool(maxRequests=4, maxPeerRequests=1)
+        lock = threading.Lock()
+        inFlight = {'all': 0, 'most': 0}
+        peerInFlight = {}
+        def request(peer, seconds):
+            with lock:
+                inFlight['all'] += 1
+                inFlight['most'] = max(inFlight['most'], inFlight['all'])
+                peerInFlight[peer] = peerInFlight.get(peer, 0) + 1
+                if peerInFlight[peer] > 1:
+                    inFlight['most'] = 100
+            time.sleep(seconds)
+            with lock:
+                inFlight['all'] -= 1
+                peerInFlight[peer] -= 1
+            if seconds == 0:
+                raise ValueError('failed')
+            return peer
+        async def requestAll(calls):
+            return await asyncio.gather(*[pool.call(peer, request, peer, seconds) for peer, seconds in calls], return_exceptions=True)
+
+        try:
+            # Eight requests to four peers take two rounds, not eight
+            calls = [(peer, 0.2) for peer in ('a', 'b', 'c', 'd')] * 2
+            startTime = time.monotonic()
+            results = pool.run(requestAll(calls))
+            elapsed = time.monotonic() - startTime
+            if results != [peer for peer, seconds in calls] or inFlight['most'] != 4 or not 0.35 < elapsed < 1.2:
+                self.assertTrue(False)
+            # A slow peer only holds up its own requests, failures are returned to the caller
+            startTime = time.monotonic()
+            results = pool.run(requestAll([('slow', 1), ('a', 0.1), ('b', 0), ('a', 0.1)]))
+            if results[0] != 'slow' or not isinstance(results[2], ValueError) or results[3] != 'a' or time.monotonic() - startTime > 1.5:
+                self.assertTrue(False)
+        finally:
+            pool.close()
+        self.assertTrue(True)
+
+    def testPeerRace(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running peer request race test...')
+
+        import onionrasync, asyncio, time
+        pool = onionrasync.PeerRequestPool()
+        called = []
+        cancelled = []
+        # peer name: (seconds before answering, seconds transferring, succeeds)
+        behaviour = {'fast': (0.05, 0, True), 'dead': (1, 0, True), 'bad': (0, 0, False), 'slowTransfer': (0, 0.5, True)}
+        def fetch(peer, attempt):
+            called.append(peer)
+            answerAt, transfer, succeeds = behaviour[peer]
+            time.sleep(answerAt)
+            try:
+                attempt.answer()
+                for i in range(int(transfer * 100)):
+                    time.sleep(0.01)
+                    attempt.check()
+            except onionrasync.Cancelled:
+                cancelled.append(peer)
+                return False
+            return succeeds and peer
+        def race(peerList):
+            del called[:]
+            startTime = time.monotonic()
+            result = pool.run(pool.race(peerList, fetch, 0.2))
+            return (result, time.monotonic() - startTime)
+
+        try:
+            # Stops at the first valid copy
+            result, elapsed = race(['fast', 'bad', 'dead'])
+            if result != 'fast' or called != ['fast']:
+                self.assertTrue(False)
+            # A failure moves straight on to the next peer
+            result, elapsed = race(['bad', 'fast'])
+            if result != 'fast' or called != ['bad', 'fast'] or elapsed > 0.15:
+                self.assertTrue(False)
+            # A peer which has not answered in time is raced against the next one, and the loser is cancelled
+            result, elapsed = race(['dead', 'fast', 'bad'])
+            if result != 'fast' or called != ['dead', 'fast'] or not 0.2 < elapsed < 0.6:
+                self.assertTrue(False)
+            time.sleep(1)
+            if cancelled != ['dead']:
+                self.assertTrue(False)
+            # A peer which answered but is still sending is not raced
+            result, elapsed = race(['slowTransfer', 'fast'])
+            if result != 'slowTransfer' or called != ['slowTransfer']:
+                self.assertTrue(False)
+            if race(['bad', 'bad'])[0] != False:
+                self.assertTrue(False)
+        finally:
+            pool.close()
+
+        # Waiting for the request limits is not counted as a peer being slow to answer
+        pool = onionrasync.PeerRequestPool(maxRequests=2)
+        contendedCalls = []
+        def answerSoon(peer, attempt):
+            contendedCalls.append(peer)
+            time.sleep(0.3)
+            attempt.answer()
+            return True
+        async def raceAll():
+            return await asyncio.gather(*[pool.race(['peer' + str(i) + 'a', 'peer' + str(i) + 'b'], answerSoon, 0.5) for i in range(8)])
+        try:
+            if pool.run(raceAll()) != [True] * 8 or len(contendedCalls) != 8:
+                self.assertTrue(False)
+        finally:
+            pool.close()
+        self.assertTrue(True)
+
+    def testLookupBlocks(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running block lookup test...')
+
+        import core, communicator, onionrutils, onionrasync, hashlib
+        myCore = core.Core()
+        comm = communicator.OnionrCommunicate.__new__(communicator.OnionrCommunicate)
+        comm._core = myCore
+        comm._utils = onionrutils.OnionrUtils(myCore)
+        comm.concurrent = False
+        comm.maxSyncPages = 2
+        comm.peerData = {}
+        peer = 'lookuppeeraaaaaa.onion'
+        remoteHashes = [hashlib.sha3_256(('lookup test ' + str(i)).encode()).hexdigest() for i in range(5)]
+        remoteDigest = hashlib.sha3_256(b'lookup test digest').hexdigest()
+        def performGet(action, peer, data=None, **kwargs):
+            if action == 'getDBHash':
+                return remoteDigest
+            if action == 'getBlockHashesSince':
+                # One hash per page
+                cursor = int(data.split(',')[0])
+                return str(cursor + 1) + ' ' + str(len(remoteHashes)) + '\n' + remoteHashes[cursor]
+            return False
+        comm.performGet = performGet
+        myCore.addAddresses([peer])
+        myCore.setAddressInfo(peer, 'blockCursor', 0)
+        try:
+            # Stopping at maxSyncPages leaves the digest unsaved, so the rest is fetched next time
+            comm.lookupBlocks([peer])
+            if myCore.getAddressInfo(peer, 'blockCursor') != 2 or myCore.getAddressInfo(peer, 'DBHash') != None:
+                self.assertTrue(False)
+            comm.lookupBlocks([peer])
+            comm.lookupBlocks([peer])
+            if myCore.getAddressInfo(peer, 'blockCursor') != 5 or myCore.getAddressInfo(peer, 'DBHash') != remoteDigest:
+                self.assertTrue(False)
+            blockList = myCore.getBlockList().split('\n')
+            if not all(i in blockList for i in remoteHashes):
+                self.assertTrue(False)
+        finally:
+            myCore.removeAddress(peer)
+            for i in remoteHashes:
+                myCore.removeBlock(i)
+        self.assertTrue(True)
+
+    def testProcessBlocks(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running concurrent block download test...')
+
+        import core, communicator, onionrutils, onionrasync, hashlib, io
+        myCore = core.Core()
+        comm = communicator.OnionrCommunicate.__new__(communicator.OnionrCommunicate)
+        comm._core = myCore
+        comm._utils = onionrutils.OnionrUtils(myCore)
+        comm.concurrent = True
+        comm.requestPool = onionrasync.PeerRequestPool()
+        comm.downloadPeerCount = 3
+        comm.maxBlockSize = 10000000
+        comm.minSpeedSample = 16384
+        comm.hedgePercentile = 0.9
+        comm.maxRacingDownloads = 2
+        comm.peerData = {}
+        peers = ['processpeeraaaaa.onion', 'processpeerbbbbb.onion']
+        blocks = {}
+        for i in range(3):
+            data = ('-txt-processBlocks test ' + str(i) + ' ' + str(os.urandom(8))).encode()
+            blocks[hashlib.sha3_256(data).hexdigest()] = data
+        class Response:
+            def __init__(self, data):
+                self.raw = io.BytesIO(data)
+            def close(self):
+                pass
+        def performGet(action, peer, data=None, **kwargs):
+            if action == 'getData' and data in blocks:
+                return Response(blocks[data])
+            if action == 'getData' and data == 'f' * 64:
+                return Response(b'not the block')
+            return False
+        comm.performGet = performGet
+        myCore.addAddresses(peers)
+        try:
+            # Nothing to download
+            for i in myCore.getBlockList(True).split('\n'):
+                if i != '':
+                    myCore.removeBlock(i)
+            comm.processBlocks()
+            myCore.addBlocksToDB(list(blocks))
+            comm.processBlocks()
+            for i in blocks:
+                if myCore.getDataBytes(i) != blocks[i]:
+                    self.assertTrue(False)
+            if myCore.getBlockList(True).strip() != '':
+                self.assertTrue(False)
+            # Each download is recorded once, by fetchBlock, as performGet leaves streamed requests to it
+            if sum(myCore.getAddressInfo(peer, 'success') or 0 for peer in peers) == 0:
+                self.assertTrue(False)
+            if any(myCore.getAddressInfo(peer, 'failure') for peer in peers):
+                self.assertTrue(False)
+            if comm.fetchBlock(peers[0], 'f' * 64) or not myCore.getAddressInfo(peers[0], 'failure'):
+                self.assertTrue(False)
+        finally:
+            comm.requestPool.close()
+            for peer in peers:
+                myCore.removeAddress(peer)
+            for i in blocks:
+                myCore.removeBlock(i)
+        self.assertTrue(True)
+
+    def testDatabaseTransaction(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running database transaction test...')
+
+        import core, threading
+        myCore = core.Core()
+        if not os.path.exists('data/address.db'):
+            myCore.createAddressDB()
+        try:
+            with myCore._db.transaction(myCore.addressDB) as c:
+                c.execute('INSERT INTO adders (address, type) VALUES(?, ?);', ('facebookcorewwwi.onion', 1))
+                raise ValueError
+        except ValueError:
+            pass
+        if 'facebookcorewwwi.onion' in myCore.listAdders():
+            self.assertTrue(False)
+
+        # Each thread gets its own connection, and it is reused within the thread
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(myCore._db.connect(myCore.addressDB)))
+        thread.start()
+        thread.join()
+        if connections[0] is myCore._db.connect(myCore.addressDB) or myCore._db.connect(myCore.addressDB) is not myCore._db.connect(myCore.addressDB):
+            self.assertTrue(False)
+        # Once a thread has exited, the next thread (such as the API's next request) takes its connection
+        def request():
+            with myCore._db.transaction(myCore.addressDB) as c:
+                c.execute('SELECT count(*) FROM adders;')
+            connections.append(myCore._db.connect(myCore.addressDB))
+        for i in range(3):
+            thread = threading.Thread(target=request)
+            thread.start()
+            thread.join()
+        if not connections[0] is connections[1] is connections[2] is connections[3]:
+            self.assertTrue(False)
+
+        myCore.close()
+        self.assertTrue(True)
+
+    def testDatabaseMigration(self):
+        logger.debug('-'*26 + '\n')
+        logger.info('Running database migration test...')
+
+        import core, sqlite3
+        myCore = core.Core()
+        legacyDB = 'data/legacy-address.db'
+        if os.path.exists(legacyDB):
+            os.remove(legacyDB)
+        conn = sqlite3.connect(legacyDB)
+        conn.execute('CREATE TABLE adders(address text, type int, knownPeer text, speed int, success int, DBHash text, failure int);')
+        conn.executemany('INSERT INTO adders (address, type) VALUES(?, ?);', [('facebookcorewwwi.onion', 1), ('facebookcorewwwi.onion', 1), ('duckduckgogg42xjoc72x3sjasowoarfbgcmvfimaftt6twagswzczad.onion', 1)])
+        conn.commit()
+        conn.close()
+
+        myCore._db.migrate(legacyDB, myCore._migrations[myCore.addressDB])
+        conn = myCore._db.connect(legacyDB)
+        if conn.execute('SELECT COUNT(*) FROM adders;').fetchone()[0] != 2 or myCore._db.getVersion(conn) != len(myCore._migrations[myCore.addressDB]):
+            self.assertTrue(False)
+        try:
+            with myCore._db.transaction(legacyDB) as c:
+                c.execute('INSERT INTO adders (address, type) VALUES(?, ?);', ('facebookcorewwwi.onion', 1))
+        except sqlite3.IntegrityError:
+            self.assertTrue(True)
+        else:
+            self.assertTrue(False)
+
+        # Older versions could leave a queue database with no table
+        legacyQueue = 'data/legacy-queue.db'
+        if os.path.exists(legacyQueue):
+            os.remove(legacyQueue)
+        sqlite3.connect(legacyQueue).close()
+        myCore._db.migrate(legacyQueue, myCore._migrations[myCore.queueDB])
+        with myCore._db.transaction(legacyQueue) as c:
+            c.execute('INSERT INTO commands (command, data, date) VALUES(?, ?, ?);', ('testCommand', '', '0'))
+            if c.execute('SELECT priority FROM commands;').fetchone()[0] != 0:
+                self.assertTrue(False)
+        myCore.close()
+
 unittest.main()